@@ -0,0 +1,155 @@
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+FIRST_NAMES = ["Ava", "Ben", "Chloe", "Diego", "Emma", "Farah", "George", "Hana", "Ivan", "Julia", "Kenji", "Lena", "Mateo", "Nora", "Omar", "Priya"]
+LAST_NAMES = ["Smith", "Jones", "Garcia", "Nguyen", "Patel", "Kim", "Müller", "Rossi", "Silva", "Cohen", "Okafor", "Larsen"]
+EMAIL_DOMAINS = ["example.com", "mail.test", "shop.test"]
+CUSTOMER_TAGS = ["vip", "wholesale", "newsletter", "returning", "b2b", "influencer"]
+ORDER_TAGS = ["gift", "priority", "subscription", "preorder", "bundle"]
+CURRENCIES = ["USD", "USD", "USD", "CAD", "EUR", "GBP"]
+# Roughly what a live store looks like: mostly paid, a long tail of the rest
+FINANCIAL_STATUSES = [("paid", 70), ("pending", 8), ("authorized", 5), ("partially_refunded", 5), ("refunded", 6), ("voided", 3), ("partially_paid", 3)]
+FULFILLMENT_STATUSES = [(None, 30), ("fulfilled", 60), ("partial", 10)]
+CANCEL_REASONS = ["customer", "fraud", "inventory", "declined", "other"]
+
+
+def iso(value: datetime) -> str:
+    return value.isoformat(timespec="seconds")
+
+
+def weighted(rng: random.Random, choices: list[tuple]):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+
+def money(value: float) -> str:
+    return f"{value:.2f}"
+
+
+@dataclass
+class Dataset:
+    orders: list[dict]
+    customers: list[dict]
+    orders_by_id: dict[int, dict] = field(init=False)
+    customers_by_id: dict[int, dict] = field(init=False)
+
+    def __post_init__(self):
+        self.orders_by_id = {order["id"]: order for order in self.orders}
+        self.customers_by_id = {customer["id"]: customer for customer in self.customers}
+
+
+def generate_customers(rng: random.Random, count: int, start: datetime) -> list[dict]:
+    customers = []
+    for index in range(count):
+        first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        created_at = start + timedelta(seconds=rng.randrange(365 * 86400))
+        accepts_marketing = rng.random() < 0.4
+        customers.append({
+            "id": 6000000000 + index,
+            "email": f"{first_name.lower()}.{last_name.lower()}{index}@{rng.choice(EMAIL_DOMAINS)}",
+            "first_name": first_name,
+            "last_name": last_name,
+            "accepts_marketing": accepts_marketing,
+            "created_at": iso(created_at),
+            "updated_at": iso(created_at),
+            "orders_count": 0,
+            "state": weighted(rng, [("enabled", 80), ("disabled", 15), ("invited", 5)]),
+            "total_spent": "0.00",
+            "last_order_id": None,
+            "last_order_name": None,
+            "note": rng.choice([None, None, None, "Prefers email contact", "Call before delivery"]),
+            "verified_email": rng.random() < 0.9,
+            "tags": ", ".join(rng.sample(CUSTOMER_TAGS, rng.randrange(3))),
+            "accepts_marketing_updated_at": iso(created_at),
+            "marketing_opt_in_level": "single_opt_in" if accepts_marketing else None,
+            "email_marketing_consent": {
+                "state": "subscribed" if accepts_marketing else "not_subscribed",
+                "opt_in_level": "single_opt_in",
+                "consent_updated_at": iso(created_at),
+            },
+            "sms_marketing_consent": None,
+        })
+    return customers
+
+
+def generate_order(rng: random.Random, index: int, customer: dict | None, created_at: datetime) -> dict:
+    line_items_price = round(rng.lognormvariate(3.8, 0.7), 2)
+    discounts = round(line_items_price * rng.choice([0, 0, 0, 0.1, 0.15]), 2)
+    subtotal = line_items_price - discounts
+    tax = round(subtotal * 0.08, 2)
+    total = subtotal + tax
+    financial_status = weighted(rng, FINANCIAL_STATUSES)
+    cancelled = financial_status == "voided" or rng.random() < 0.02
+    fulfillment_status = None if cancelled else weighted(rng, FULFILLMENT_STATUSES)
+    closed = fulfillment_status == "fulfilled" and rng.random() < 0.8
+    refunded = 0.0
+    refunds = []
+    if financial_status in ("refunded", "partially_refunded"):
+        refunded = total if financial_status == "refunded" else round(total * rng.uniform(0.1, 0.6), 2)
+        refunds.append({
+            "id": 8000000000 + index,
+            "created_at": iso(created_at + timedelta(days=rng.randrange(1, 20))),
+            "transactions": [{"kind": "refund", "status": "success", "amount": money(refunded)}],
+        })
+    updated_at = created_at + timedelta(hours=rng.randrange(0, 72))
+    return {
+        "id": 5000000000 + index,
+        "name": f"#{1001 + index}",
+        "customer": None if customer is None else {key: customer[key] for key in ("id", "email", "first_name", "last_name")},
+        "buyer_accepts_marketing": bool(customer and customer["accepts_marketing"]),
+        "cancel_reason": rng.choice(CANCEL_REASONS) if cancelled else None,
+        "cancelled_at": iso(updated_at) if cancelled else None,
+        "closed_at": iso(updated_at) if closed else None,
+        "confirmed": True,
+        "created_at": iso(created_at),
+        "processed_at": iso(created_at),
+        "updated_at": iso(updated_at),
+        "currency": rng.choice(CURRENCIES),
+        "current_subtotal_price": money(subtotal - refunded),
+        "current_total_discounts": money(discounts),
+        "current_total_duties_set": None,
+        "current_total_price": money(total - refunded),
+        "current_total_tax": money(tax),
+        "discount_codes": [{"code": "SAVE10", "amount": money(discounts), "type": "percentage"}] if discounts else [],
+        "estimated_taxes": False,
+        "financial_status": financial_status,
+        "fulfillment_status": fulfillment_status,
+        "note": rng.choice([None, None, None, None, "Leave at the door"]),
+        "source_url": None,
+        "subtotal_price": money(subtotal),
+        "tags": ", ".join(rng.sample(ORDER_TAGS, rng.randrange(2))),
+        "taxes_included": False,
+        "total_discounts": money(discounts),
+        "total_line_items_price": money(line_items_price),
+        "total_outstanding": money(total) if financial_status in ("pending", "authorized") else "0.00",
+        "total_price": money(total),
+        "total_tax": money(tax),
+        "total_tip_received": "0.00",
+        "total_weight": rng.randrange(100, 5000),
+        "refunds": refunds,
+    }
+
+
+def generate_dataset(orders: int = 5000, customers: int = 1000, seed: int = 1) -> Dataset:
+    # Seeded, so every run benchmarks exactly the same store
+    rng = random.Random(seed)
+    start = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    customer_records = generate_customers(rng, customers, start)
+    offsets = sorted(rng.randrange(365 * 86400) for _ in range(orders))
+    order_records = []
+    for index, offset in enumerate(offsets):
+        # A few repeat buyers account for most orders; some checkouts are guests
+        if rng.random() < 0.05:
+            customer = None
+        else:
+            customer = customer_records[int(rng.paretovariate(1.2) * 7) % len(customer_records)]
+        order = generate_order(rng, index, customer, start + timedelta(seconds=offset))
+        order_records.append(order)
+        if customer is not None:
+            customer["orders_count"] += 1
+            customer["total_spent"] = money(float(customer["total_spent"]) + float(order["total_price"]))
+            customer["last_order_id"] = order["id"]
+            customer["last_order_name"] = order["name"]
+            customer["updated_at"] = max(customer["updated_at"], order["updated_at"])
+    return Dataset(order_records, customer_records)
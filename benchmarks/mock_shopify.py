@@ -0,0 +1,494 @@
+import asyncio
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+from benchmarks.datasets import Dataset
+from services.metrics import endpoint_template
+
+API_PATH = "/admin/api/{version}"
+ORDER_STATUSES = {
+    "open": lambda order: order["closed_at"] is None and order["cancelled_at"] is None,
+    "closed": lambda order: order["closed_at"] is not None,
+    "cancelled": lambda order: order["cancelled_at"] is not None,
+    "any": lambda order: True,
+}
+FINANCIAL_STATUS_GROUPS = {
+    "authorized": {"authorized"},
+    "pending": {"pending"},
+    "paid": {"paid"},
+    "partially_paid": {"partially_paid"},
+    "refunded": {"refunded"},
+    "voided": {"voided"},
+    "partially_refunded": {"partially_refunded"},
+    "unpaid": {"authorized", "pending"},
+}
+FULFILLMENT_STATUS_GROUPS = {
+    "shipped": {"fulfilled"},
+    "partial": {"partial"},
+    "unshipped": {None},
+    "unfulfilled": {None, "partial"},
+}
+SEARCH_TERM = re.compile(r'(\w+):("[^"]*"|\S+)|(\S+)')
+# GraphQL search syntax, as the plugin writes it: created_at:>='2023-01-01T00:00:00', (id:1 OR id:2)
+ORDER_SEARCH_TERM = re.compile(r"(\w+):(>=|<=|>)?('(?:[^'\\]|\\.)*'|[^\s()]+)")
+NODE_LOOKUP = re.compile(r'(\w+): (order|customer)\(id: "gid://shopify/\w+/(\d+)"\)')
+CONNECTION = re.compile(r"\b(orders|customers)\(first: (\d+)([^)]*)\)")
+NESTED_OBJECT = re.compile(r"\b(?:customer|refunds) \{")
+SEARCH_BOUNDS = {">=": "_min", "<=": "_max"}
+CUSTOMER_SORT_FIELDS = {
+    "CREATED_AT": "created_at",
+    "ID": "id",
+    "NAME": "last_name",
+    "ORDERS_COUNT": "orders_count",
+    "TOTAL_SPENT": "total_spent",
+    "UPDATED_AT": "updated_at",
+}
+FULFILLMENT_DISPLAY_STATUSES = {None: "UNFULFILLED", "partial": "PARTIALLY_FULFILLED", "fulfilled": "FULFILLED"}
+
+
+@dataclass
+class MockSettings:
+    latency: float = 0.05
+    jitter: float = 0.02
+    # Shopify's standard REST bucket: 40 calls, leaking 2 per second
+    bucket_size: int = 40
+    leak_rate: float = 2.0
+    # Share of calls answered 429 regardless of the bucket, to exercise retries
+    throttle_rate: float = 0.0
+    # Shopify's standard GraphQL cost bucket: 1000 points, restoring 50 per second
+    graphql_bucket_size: int = 1000
+    graphql_restore_rate: float = 50.0
+    seed: int = 1
+
+
+class CallLimitBucket:
+    def __init__(self, size: int, leak_rate: float):
+        self.size = size
+        self.leak_rate = leak_rate
+        self.used = 0.0
+        self.updated_at = time.monotonic()
+
+    def take(self, cost: int = 1) -> bool:
+        now = time.monotonic()
+        self.used = max(0.0, self.used - (now - self.updated_at) * self.leak_rate)
+        self.updated_at = now
+        if self.used + cost > self.size:
+            return False
+        self.used += cost
+        return True
+
+    @property
+    def throttle_status(self) -> dict:
+        return {
+            "maximumAvailable": float(self.size),
+            "currentlyAvailable": int(self.size - self.used),
+            "restoreRate": float(self.leak_rate),
+        }
+
+    @property
+    def header(self) -> str:
+        return f"{int(self.used)}/{self.size}"
+
+
+def parse_time(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    # The plugin sends naive datetimes as they were given; treat them as UTC
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def select_fields(record: dict, fields: str | None) -> dict:
+    if not fields:
+        return record
+    return {field: record[field] for field in fields.split(",") if field in record}
+
+
+def filter_dates(records: list[dict], params, fields: tuple) -> list[dict]:
+    for field in fields:
+        if f"{field}_min" in params:
+            bound = parse_time(params[f"{field}_min"])
+            records = [record for record in records if parse_time(record[field]) >= bound]
+        if f"{field}_max" in params:
+            bound = parse_time(params[f"{field}_max"])
+            records = [record for record in records if parse_time(record[field]) <= bound]
+    return records
+
+
+def filter_orders(orders: list[dict], params) -> list[dict]:
+    matches = ORDER_STATUSES.get(params.get("status", "open"), ORDER_STATUSES["any"])
+    selected = [order for order in orders if matches(order)]
+
+    financial_status = params.get("financial_status", "any")
+    if financial_status in FINANCIAL_STATUS_GROUPS:
+        statuses = FINANCIAL_STATUS_GROUPS[financial_status]
+        selected = [order for order in selected if order["financial_status"] in statuses]
+    fulfillment_status = params.get("fulfillment_status", "any")
+    if fulfillment_status in FULFILLMENT_STATUS_GROUPS:
+        statuses = FULFILLMENT_STATUS_GROUPS[fulfillment_status]
+        selected = [order for order in selected if order["fulfillment_status"] in statuses]
+
+    selected = filter_dates(selected, params, ("created_at", "updated_at", "processed_at"))
+    if "since_id" in params:
+        since_id = int(params["since_id"])
+        selected = [order for order in selected if order["id"] > since_id]
+    return selected
+
+
+def search_customers(customers: list[dict], query: str | None) -> list[dict]:
+    selected = customers
+    for field, value, text in SEARCH_TERM.findall(query or ""):
+        if field:
+            value = value.strip('"').lower()
+            field = "tags" if field == "tag" else field
+            selected = [customer for customer in selected if value in str(customer.get(field) or "").lower()]
+        else:
+            text = text.lower()
+            selected = [
+                customer for customer in selected
+                if any(text in str(customer.get(key) or "").lower() for key in ("email", "first_name", "last_name", "tags"))
+            ]
+    return selected
+
+
+def sort_customers(customers: list[dict], order: str | None) -> list[dict]:
+    field, _, direction = (order or "last_order_date DESC").partition(" ")
+    # last_order_date isn't a customer field; the last order's id grows with its date
+    key = "last_order_id" if field == "last_order_date" else field
+    return sorted(customers, key=lambda customer: (customer.get(key) is not None, customer.get(key) or 0), reverse=direction.upper() != "ASC")
+
+
+def search_orders(orders: list[dict], query: str | None) -> list[dict]:
+    # Translated back into the REST filters, so both backends see the same store
+    params, ids = {"status": "any"}, []
+    for field, operator, value in ORDER_SEARCH_TERM.findall(query or ""):
+        value = value.strip("'")
+        if field == "id":
+            if operator == ">":
+                params["since_id"] = value
+            else:
+                ids.append(int(value))
+        elif operator:
+            params[field + SEARCH_BOUNDS[operator]] = value
+        else:
+            params[field] = value
+    selected = filter_orders(orders, params)
+    if ids:
+        selected = [order for order in selected if order["id"] in ids]
+    return selected
+
+
+def customer_sort_key(field: str):
+    if field == "total_spent":
+        return lambda customer: float(customer[field])
+    return lambda customer: (customer[field] is not None, customer[field] or 0)
+
+
+def gid(resource: str, record_id: int | None) -> str | None:
+    return None if record_id is None else f"gid://shopify/{resource}/{record_id}"
+
+
+def upper(value):
+    return value.upper() if isinstance(value, str) else value
+
+
+def money_set(amount: str | None) -> dict | None:
+    return None if amount is None else {"shopMoney": {"amount": amount}}
+
+
+def tag_list(tags: str | None) -> list[str]:
+    return [tag for tag in (tags or "").split(", ") if tag]
+
+
+def marketing_consent(consent: dict | None) -> dict | None:
+    if consent is None:
+        return None
+    return {
+        "marketingState": upper(consent.get("state")),
+        "marketingOptInLevel": upper(consent.get("opt_in_level")),
+        "consentUpdatedAt": consent.get("consent_updated_at"),
+    }
+
+
+def customer_node(customer: dict) -> dict:
+    # Every field the plugin can select; it reads back only the ones it asked for
+    return {
+        "id": gid("Customer", customer["id"]),
+        "email": customer["email"],
+        "acceptsMarketing": customer["accepts_marketing"],
+        "acceptsMarketingUpdatedAt": customer["accepts_marketing_updated_at"],
+        "createdAt": customer["created_at"],
+        "updatedAt": customer["updated_at"],
+        "numberOfOrders": str(customer["orders_count"]),
+        "state": upper(customer["state"]),
+        "amountSpent": {"amount": customer["total_spent"]},
+        "lastOrder": None if customer["last_order_id"] is None else {
+            "id": gid("Order", customer["last_order_id"]),
+            "name": customer["last_order_name"],
+        },
+        "note": customer["note"],
+        "verifiedEmail": customer["verified_email"],
+        "tags": tag_list(customer["tags"]),
+        "marketingOptInLevel": upper(customer["marketing_opt_in_level"]),
+        "emailMarketingConsent": marketing_consent(customer["email_marketing_consent"]),
+        "smsMarketingConsent": marketing_consent(customer["sms_marketing_consent"]),
+    }
+
+
+def order_node(order: dict, customers_by_id: dict[int, dict]) -> dict:
+    customer = order["customer"] and customers_by_id.get(order["customer"]["id"])
+    return {
+        "id": gid("Order", order["id"]),
+        "name": order["name"],
+        "customerAcceptsMarketing": order["buyer_accepts_marketing"],
+        "cancelReason": upper(order["cancel_reason"]),
+        "cancelledAt": order["cancelled_at"],
+        "closedAt": order["closed_at"],
+        "confirmed": order["confirmed"],
+        "createdAt": order["created_at"],
+        "currencyCode": order["currency"],
+        "currentSubtotalPriceSet": money_set(order["current_subtotal_price"]),
+        "currentTotalDiscountsSet": money_set(order["current_total_discounts"]),
+        "currentTotalDutiesSet": money_set(order["current_total_duties_set"]),
+        "currentTotalPriceSet": money_set(order["current_total_price"]),
+        "currentTotalTaxSet": money_set(order["current_total_tax"]),
+        "discountCodes": [code["code"] for code in order["discount_codes"]],
+        "estimatedTaxes": order["estimated_taxes"],
+        "displayFinancialStatus": upper(order["financial_status"]),
+        "displayFulfillmentStatus": FULFILLMENT_DISPLAY_STATUSES[order["fulfillment_status"]],
+        "note": order["note"],
+        "processedAt": order["processed_at"],
+        "subtotalPriceSet": money_set(order["subtotal_price"]),
+        "tags": tag_list(order["tags"]),
+        "taxesIncluded": order["taxes_included"],
+        "totalDiscountsSet": money_set(order["total_discounts"]),
+        "totalOutstandingSet": money_set(order["total_outstanding"]),
+        "totalPriceSet": money_set(order["total_price"]),
+        "totalTaxSet": money_set(order["total_tax"]),
+        "totalTipReceivedSet": money_set(order["total_tip_received"]),
+        "totalWeight": str(order["total_weight"]),
+        "updatedAt": order["updated_at"],
+        "refunds": [
+            {"id": gid("Refund", refund["id"]), "createdAt": refund["created_at"], "note": refund.get("note")}
+            for refund in order["refunds"]
+        ],
+        "customer": None if customer is None else customer_node(customer),
+    }
+
+
+class MockShopify:
+    def __init__(self, dataset: Dataset, settings: MockSettings = None):
+        self.dataset = dataset
+        self.settings = settings or MockSettings()
+        self.calls: Counter = Counter()
+        self.throttled = 0
+        self.not_modified = 0
+        self._rng = random.Random(self.settings.seed)
+        self._bucket = CallLimitBucket(self.settings.bucket_size, self.settings.leak_rate)
+        self._cost_bucket = CallLimitBucket(self.settings.graphql_bucket_size, self.settings.graphql_restore_rate)
+        self.app = self.create_app()
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def reset(self):
+        self.calls.clear()
+        self.throttled = 0
+        self.not_modified = 0
+        self._bucket = CallLimitBucket(self.settings.bucket_size, self.settings.leak_rate)
+        self._cost_bucket = CallLimitBucket(self.settings.graphql_bucket_size, self.settings.graphql_restore_rate)
+
+    async def respond(self, request: Request, content) -> JSONResponse:
+        self.calls[endpoint_template(request.url.path)] += 1
+        settings = self.settings
+        await asyncio.sleep(max(0.0, self._rng.gauss(settings.latency, settings.jitter)))
+        throttled = not self._bucket.take() or self._rng.random() < settings.throttle_rate
+        headers = {"X-Shopify-Shop-Api-Call-Limit": self._bucket.header}
+        if throttled:
+            self.throttled += 1
+            headers["Retry-After"] = str(1 / settings.leak_rate)
+            return JSONResponse({"errors": "Exceeded 2 calls per second for api client. Reduce request rates to resume uninterrupted service."}, 429, headers)
+        if content is None:
+            return JSONResponse({"errors": "Not Found"}, 404, headers)
+        if callable(content):
+            content = content(headers)
+        response = JSONResponse(content, headers=headers)
+        # Conditional GETs, so the plugin's ETag cache has something to work with
+        etag = f'"{hashlib.md5(response.body).hexdigest()}"'
+        if request.headers.get("if-none-match") == etag:
+            self.not_modified += 1
+            return Response(status_code=304, headers={"ETag": etag, "X-Shopify-Shop-Api-Call-Limit": self._bucket.header})
+        response.headers["ETag"] = etag
+        return response
+
+    async def respond_graphql(self, request: Request, cost: int, resolve) -> JSONResponse:
+        # Throttling is by query cost and reported in the body, with a 200, as Shopify does
+        self.calls[endpoint_template(request.url.path)] += 1
+        settings = self.settings
+        await asyncio.sleep(max(0.0, self._rng.gauss(settings.latency, settings.jitter)))
+        if not self._cost_bucket.take(cost) or self._rng.random() < settings.throttle_rate:
+            self.throttled += 1
+            return JSONResponse({
+                "errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+                "extensions": {"cost": {
+                    "requestedQueryCost": cost,
+                    "actualQueryCost": None,
+                    "throttleStatus": self._cost_bucket.throttle_status,
+                }},
+            })
+        data = resolve()
+        return JSONResponse({
+            "data": data,
+            "extensions": {"cost": {
+                "requestedQueryCost": cost,
+                "actualQueryCost": cost,
+                "throttleStatus": self._cost_bucket.throttle_status,
+            }},
+        })
+
+    def paginate(self, request: Request, resource: str, records: list[dict]):
+        params = request.query_params
+        limit = min(int(params.get("limit", 50)), 250)
+        # page_info is opaque to clients; here it's just the offset of the next page
+        offset = int(params.get("page_info", 0))
+        page = records[offset:offset + limit]
+
+        def content(headers: dict) -> dict:
+            if offset + limit < len(records):
+                query = {key: value for key, value in params.items() if key != "page_info"}
+                next_url = request.url.replace(query=urlencode({**query, "page_info": offset + limit}))
+                headers["Link"] = f'<{next_url}>; rel="next"'
+            return {resource: [select_fields(record, params.get("fields")) for record in page]}
+
+        return content
+
+    def create_app(self) -> FastAPI:
+        app = FastAPI()
+        dataset = self.dataset
+
+        @app.get(API_PATH + "/orders.json")
+        async def list_orders(request: Request):
+            params = request.query_params
+            if "ids" in params:
+                ids = [int(order_id) for order_id in params["ids"].split(",")]
+                orders = [dataset.orders_by_id[order_id] for order_id in ids if order_id in dataset.orders_by_id]
+            else:
+                # Newest first, as Shopify lists them
+                orders = filter_orders(dataset.orders, params)[::-1]
+            return await self.respond(request, self.paginate(request, "orders", orders))
+
+        @app.get(API_PATH + "/orders/count.json")
+        async def count_orders(request: Request):
+            return await self.respond(request, {"count": len(filter_orders(dataset.orders, request.query_params))})
+
+        @app.get(API_PATH + "/orders/{order_id}.json")
+        async def get_order(order_id: int, request: Request):
+            order = dataset.orders_by_id.get(order_id)
+            content = None if order is None else {"order": select_fields(order, request.query_params.get("fields"))}
+            return await self.respond(request, content)
+
+        @app.get(API_PATH + "/customers.json")
+        async def list_customers(request: Request):
+            params = request.query_params
+            customers = dataset.customers
+            if "ids" in params:
+                ids = [int(customer_id) for customer_id in params["ids"].split(",")]
+                customers = [dataset.customers_by_id[customer_id] for customer_id in ids if customer_id in dataset.customers_by_id]
+            return await self.respond(request, self.paginate(request, "customers", customers))
+
+        @app.get(API_PATH + "/customers/count.json")
+        async def count_customers(request: Request):
+            customers = filter_dates(dataset.customers, request.query_params, ("created_at", "updated_at"))
+            return await self.respond(request, {"count": len(customers)})
+
+        @app.get(API_PATH + "/customers/search.json")
+        async def search(request: Request):
+            params = request.query_params
+            customers = sort_customers(search_customers(dataset.customers, params.get("query")), params.get("order"))
+            return await self.respond(request, self.paginate(request, "customers", customers))
+
+        @app.get(API_PATH + "/customers/{customer_id}.json")
+        async def get_customer(customer_id: int, request: Request):
+            customer = dataset.customers_by_id.get(customer_id)
+            content = None if customer is None else {"customer": select_fields(customer, request.query_params.get("fields"))}
+            return await self.respond(request, content)
+
+        @app.post(API_PATH + "/graphql.json")
+        async def graphql(request: Request):
+            body = await request.json()
+            query, variables = body["query"], body.get("variables") or {}
+            lookups = NODE_LOOKUP.findall(query)
+            connection = CONNECTION.search(query)
+            if not lookups and connection is None:
+                return JSONResponse({"errors": [{"message": "Query not supported by the mock"}]})
+
+            def resolve() -> dict:
+                data = {}
+                for alias, resource, record_id in lookups:
+                    if resource == "order":
+                        order = dataset.orders_by_id.get(int(record_id))
+                        data[alias] = None if order is None else order_node(order, dataset.customers_by_id)
+                    else:
+                        customer = dataset.customers_by_id.get(int(record_id))
+                        data[alias] = None if customer is None else customer_node(customer)
+                if connection is not None:
+                    resource, first, arguments = connection.groups()
+                    if resource == "orders":
+                        orders = search_orders(dataset.orders, variables.get("query"))
+                        nodes = [order_node(order, dataset.customers_by_id) for order in orders[:int(first)]]
+                    else:
+                        customers = search_customers(dataset.customers, variables.get("query"))
+                        sort_key = re.search(r"sortKey: (\w+)", arguments)
+                        if sort_key is not None:
+                            field = CUSTOMER_SORT_FIELDS[sort_key.group(1)]
+                            customers = sorted(customers, key=customer_sort_key(field), reverse="reverse: true" in arguments)
+                        nodes = [customer_node(customer) for customer in customers[:int(first)]]
+                    data[resource] = {"edges": [{"node": node} for node in nodes]}
+                return data
+
+            # Shopify's estimate: a point per object, nested ones included, and one per connection.
+            # A selection appears once per aliased lookup, but once for all of a connection's nodes
+            nested = len(NESTED_OBJECT.findall(query))
+            if connection is None:
+                cost = len(lookups) + nested
+            else:
+                cost = int(connection.group(2)) * (1 + nested) + 1
+            return await self.respond_graphql(request, cost, resolve)
+
+        return app
+
+
+class MockServer:
+    # Runs the mock in a thread with its own event loop, so its latency
+    # doesn't compete with the app under test for the benchmark's loop
+    def __init__(self, mock: MockShopify, host: str = "127.0.0.1", port: int = 0):
+        self.mock = mock
+        self.host = host
+        self.url = None
+        self._server = uvicorn.Server(uvicorn.Config(mock.app, host=host, port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        while not self._server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError("Mock Shopify server failed to start")
+            time.sleep(0.01)
+        # Port 0 picks any free port; read back the one that was bound
+        port = self._server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://{self.host}:{port}"
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.should_exit = True
+        self._thread.join()
@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import httpx
+
+from benchmarks.datasets import FIRST_NAMES, CUSTOMER_TAGS, Dataset, generate_dataset
+from benchmarks.mock_shopify import MockServer, MockSettings, MockShopify
+
+FINANCIAL_STATUSES = ["any", "paid", "pending", "authorized", "refunded", "voided"]
+# Most lookups go to a small working set of recent orders, as they do in chat sessions
+HOT_ORDERS = 200
+HOT_SHARE = 0.8
+SHOP_DOMAIN_NAME = "benchmark-shop.myshopify.com"
+BEARER_TOKEN = "benchmark-token"
+
+
+def list_orders(rng: random.Random, dataset: Dataset) -> str:
+    return "/orders?" + urlencode({"limit": rng.choice([10, 50, 250]), "status": "any"})
+
+
+def get_order(rng: random.Random, dataset: Dataset) -> str:
+    if rng.random() < HOT_SHARE:
+        order = rng.choice(dataset.orders[-HOT_ORDERS:])
+    else:
+        order = rng.choice(dataset.orders)
+    return f"/orders/{order['id']}"
+
+
+def count_orders(rng: random.Random, dataset: Dataset) -> str:
+    return "/orders/count?" + urlencode({"financial_status": rng.choice(FINANCIAL_STATUSES), "status": "any"})
+
+
+def search_customers(rng: random.Random, dataset: Dataset) -> str:
+    query = rng.choice([rng.choice(FIRST_NAMES), f"tag:{rng.choice(CUSTOMER_TAGS)}", "state:enabled"])
+    return "/customers/search?" + urlencode({"query": query, "limit": 10})
+
+
+SCENARIOS = {
+    "orders": list_orders,
+    "order": get_order,
+    "orders_count": count_orders,
+    "customers_search": search_customers,
+}
+
+
+def percentile(values: list[float], percent: float) -> float:
+    # Nearest rank, on an already sorted list
+    if not values:
+        return 0.0
+    rank = max(1, round(percent / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure_environment(mock_url: str):
+    # server.main reads its settings at import time, so they're set first
+    os.environ["SHOPIFY_BASE_URL"] = mock_url
+    os.environ["MULTI_TENANT"] = "false"
+    os.environ["SHOP_DOMAIN_NAME"] = SHOP_DOMAIN_NAME
+    os.environ["BEARER_TOKEN"] = BEARER_TOKEN
+    # Scenarios measure from a cold cache; warming would only add calls to the first one
+    os.environ["WARMUP_ORDERS"] = "0"
+    os.environ.setdefault("HOST", "http://localhost:8000")
+    os.environ.setdefault("SHOP_NAME", "Benchmark Shop")
+    os.environ.setdefault("SHOP_API_KEY", "benchmark-key")
+
+
+async def run_scenario(client: httpx.AsyncClient, mock: MockShopify, name: str, args) -> dict:
+    from services.cache import response_cache
+
+    make_path = SCENARIOS[name]
+    rng = random.Random(args.seed)
+    paths = [make_path(rng, mock.dataset) for _ in range(args.requests)]
+    # Every scenario starts cold, with an empty cache and an empty call limit bucket
+    await response_cache.clear_shop(SHOP_DOMAIN_NAME)
+    mock.reset()
+
+    latencies, statuses = [], {}
+    queue = asyncio.Queue()
+    for path in paths:
+        queue.put_nowait(path)
+
+    async def worker():
+        while not queue.empty():
+            path = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                response = await client.get(path)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(paths),
+        "errors": len(paths) - statuses.get("200", 0),
+        "statuses": statuses,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(paths) / duration, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2),
+        },
+        "upstream_calls": mock.total_calls,
+        "upstream_calls_per_request": round(mock.total_calls / len(paths), 3),
+        "upstream_throttled": mock.throttled,
+        "upstream_endpoints": dict(mock.calls),
+    }
+
+
+async def run_benchmarks(mock: MockShopify, args) -> dict:
+    main = importlib.import_module("server.main")
+    # ASGITransport skips lifespan events, so the app's own hooks are run here
+    await main.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport,
+            base_url="http://benchmark",
+            headers={"Authorization": f"Bearer {BEARER_TOKEN}"},
+            timeout=60,
+        ) as client:
+            results = {}
+            for name in args.scenarios:
+                results[name] = await run_scenario(client, mock, name, args)
+                print_result(name, results[name])
+            return results
+    finally:
+        await main.app.router.shutdown()
+
+
+def print_result(name: str, result: dict):
+    latency = result["latency_ms"]
+    print(
+        f"{name:<18} p50 {latency['p50']:>8.1f}ms  p95 {latency['p95']:>8.1f}ms  p99 {latency['p99']:>8.1f}ms  "
+        f"{result['throughput_rps']:>8.1f} req/s  {result['upstream_calls_per_request']:>6.2f} upstream/req  "
+        f"{result['errors']} errors"
+    )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        checks = [
+            ("p95 latency", result["latency_ms"]["p95"], previous["latency_ms"]["p95"], True),
+            ("p99 latency", result["latency_ms"]["p99"], previous["latency_ms"]["p99"], True),
+            ("throughput", result["throughput_rps"], previous["throughput_rps"], False),
+            ("upstream calls per request", result["upstream_calls_per_request"], previous["upstream_calls_per_request"], True),
+        ]
+        for label, current, before, lower_is_better in checks:
+            worse = current > before * (1 + tolerance) if lower_is_better else current < before * (1 - tolerance)
+            if worse and before:
+                regressions.append(f"{name}: {label} {before} -> {current}")
+        if result["errors"] > previous["errors"]:
+            regressions.append(f"{name}: errors {previous['errors']} -> {result['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the plugin API against a local mock Shopify server")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--orders", type=int, default=5000, help="Orders in the synthetic store")
+    parser.add_argument("--customers", type=int, default=1000, help="Customers in the synthetic store")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=50, help="Mean Shopify latency in milliseconds")
+    parser.add_argument("--jitter", type=float, default=20, help="Standard deviation of Shopify latency in milliseconds")
+    # Defaults to a Shopify Plus bucket; --bucket-size 40 --leak-rate 2 is a standard plan
+    parser.add_argument("--bucket-size", type=int, default=400)
+    parser.add_argument("--leak-rate", type=float, default=20)
+    # Shopify Plus' GraphQL bucket; --graphql-bucket-size 1000 --graphql-restore-rate 50 is a standard plan
+    parser.add_argument("--graphql-bucket-size", type=int, default=2000)
+    parser.add_argument("--graphql-restore-rate", type=float, default=100)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of Shopify calls answered with 429 regardless")
+    parser.add_argument("--port", type=int, default=0, help="Port for the mock Shopify server (default: any free port)")
+    parser.add_argument("--output", default="benchmarks/results/latest.json")
+    parser.add_argument("--baseline", help="Earlier results to check this run against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    settings = MockSettings(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        bucket_size=args.bucket_size,
+        leak_rate=args.leak_rate,
+        graphql_bucket_size=args.graphql_bucket_size,
+        graphql_restore_rate=args.graphql_restore_rate,
+        throttle_rate=args.throttle_rate,
+        seed=args.seed,
+    )
+    dataset = generate_dataset(args.orders, args.customers, args.seed)
+    mock = MockShopify(dataset, settings)
+    with MockServer(mock, port=args.port) as server:
+        configure_environment(server.url)
+        scenarios = asyncio.run(run_benchmarks(mock, args))
+
+    results = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": os.getenv("SHOPIFY_API_BACKEND", "rest"),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "scenarios": scenarios,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
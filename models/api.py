@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseModel
 from models.models import (
     Customer,
@@ -21,4 +22,84 @@ class OrderResponse(BaseModel):
 
 
 class OrdersResponse(BaseModel):
-    orders: list[Order]
\ No newline at end of file
+    orders: list[Order]
+
+
+class AggregateGroup(BaseModel):
+    key: str
+    currency: Optional[str]
+    count: int
+    sum: Optional[str]
+    avg: Optional[str]
+    min: Optional[str]
+    max: Optional[str]
+    percentiles: Optional[dict[str, str]]
+
+
+class AggregateResponse(BaseModel):
+    field: str
+    group_by: str
+    order_count: int
+    groups: list[AggregateGroup]
+
+
+class BatchError(BaseModel):
+    id: int
+    detail: str
+
+
+class CustomersBatchResponse(BaseModel):
+    customers: list[Customer]
+    errors: list[BatchError]
+
+
+class OrdersBatchResponse(BaseModel):
+    orders: list[Order]
+    errors: list[BatchError]
+
+class CountBucket(BaseModel):
+    key: str
+    count: int
+    start: Optional[str]
+    end: Optional[str]
+
+
+class CountBreakdownResponse(BaseModel):
+    dimension: str
+    buckets: list[CountBucket]
+    total: Optional[int]
+
+
+class CustomerSegment(BaseModel):
+    segment: str
+    description: str
+    count: int
+
+
+class CustomerSegmentsResponse(BaseModel):
+    customers: int
+    updated_at: str
+    segments: list[CustomerSegment]
+
+
+class RankedCustomer(BaseModel):
+    id: int
+    orders_count: int
+    total_spent: str
+    last_order_id: Optional[int]
+    last_order_date: Optional[str]
+    segment: str
+    rfm_score: Optional[str]
+
+
+class TopCustomersResponse(BaseModel):
+    by: str
+    segment: Optional[str]
+    total: int
+    customers: list[RankedCustomer]
+
+
+class JobRequest(BaseModel):
+    resource: str
+    params: dict = {}
+    max_records: Optional[int]
@@ -88,4 +88,15 @@ class CustomerSearchUrlParams(BaseModel):
     limit: int = 50
     order_field: Optional[str] = "last_order_date"
     order_direction: SearchOrderDirection = SearchOrderDirection.desc
-    query: Optional[str] = None
\ No newline at end of file
+    query: Optional[str] = None
+
+
+class CustomerUrlParams(BaseModel):
+    created_at_max: datetime = None
+    created_at_min: datetime = None
+    fields: str = None
+    ids: str = None
+    limit: int = 50
+    since_id: int = None
+    updated_at_max: datetime = None
+    updated_at_min: datetime = None
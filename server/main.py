@@ -1,7 +1,9 @@
+import json
 import os
 import uvicorn
 from datetime import datetime
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
@@ -13,13 +15,22 @@ from models.shopify_api import(
     OrderUrlParams,
     CustomerCountUrlParams,
     CustomerSearchUrlParams,
+    CustomerUrlParams,
 )
+from models.models import Shop
 from models.api import (
+    AggregateResponse,
+    CountBreakdownResponse,
     CountResponse,
+    CustomerSegmentsResponse,
+    CustomersBatchResponse,
     CustomersResponse,
     CustomerResponse,
+    JobRequest,
+    OrdersBatchResponse,
     OrdersResponse,
     OrderResponse,
+    TopCustomersResponse,
 )
 
 from services.shopify import (
@@ -29,23 +40,64 @@ from services.shopify import (
     get_shop_customer,
     get_shop_customers,
     get_shop_customers_count,
+    get_shop_customers_batch,
+    get_shop_orders_batch,
+    iter_shop_customers,
+    iter_shop_orders,
+    expand_order_customers,
+    parse_expand,
+    with_field,
     DEFAULT_CUSTOMER_FIELDS,
     DEFAULT_ORDER_FIELDS,
 )
+from server.middleware import ConditionalMiddleware, DeadlineMiddleware, MetricsMiddleware
+from server.responses import dumps, model_response
+from services.analytics import aggregate_shop_orders
+from services.breakdown import get_customers_count_breakdown, get_orders_count_breakdown
+from services.bulk_export import bulk_exporter
+from services.cache import response_cache
+from services.deadline import DeadlineExceeded, with_fallback
+from services.http_client import close_clients
+from services.jobs import JobQueueFull, job_runner
+from services.metrics import cache_hit_ratio, cache_lookups, registry
+from services.mirror import mirror
+from services.prefetch import prefetcher
+from services.shopify_graphql import customer_filters_to_search_query, order_filters_to_search_query
+from services.search_index import search_index
+from services.segments import SegmentSnapshot, segment_worker
+from services.singleflight import request_flights
+from services.tenants import MULTI_TENANT, tenants
+from services.warmup import readiness
+from services.webhooks import (
+    WEBHOOK_TOPICS,
+    WebhookEvent,
+    verify_webhook,
+    webhook_processor,
+)
 
 PORT = int(os.getenv("PORT", 8000))
+MAX_BATCH_IDS = int(os.getenv("MAX_BATCH_IDS", 250))
 HOST = os.getenv("HOST")
 SHOP_NAME = os.getenv("SHOP_NAME")
 SHOP_DOMAIN_NAME = os.getenv("SHOP_DOMAIN_NAME")
 SHOP_API_KEY = os.getenv("SHOP_API_KEY")
 assert HOST is not None
-assert SHOP_NAME is not None
-assert SHOP_DOMAIN_NAME is not None
-assert SHOP_API_KEY is not None
+# In multi-tenant mode shops and their tokens come from the tenant store instead
+if MULTI_TENANT:
+    SHOP_NAME = SHOP_NAME or "Shopify"
+else:
+    assert SHOP_NAME is not None
+    assert SHOP_DOMAIN_NAME is not None
+    assert SHOP_API_KEY is not None
 
 bearer_scheme = HTTPBearer()
+optional_bearer_scheme = HTTPBearer(auto_error=False)
 BEARER_TOKEN = os.environ.get("BEARER_TOKEN")
-assert BEARER_TOKEN is not None
+if not MULTI_TENANT:
+    assert BEARER_TOKEN is not None
+    DEFAULT_SHOP = Shop(id=0, shopify_domain=SHOP_DOMAIN_NAME, shopify_token=SHOP_API_KEY)
+# Stats and metrics cover every shop, so in multi-tenant mode a shop's token can't read them
+OPERATOR_TOKEN = os.getenv("OPERATOR_TOKEN")
 
 
 def validate_token(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
@@ -53,12 +105,32 @@ def validate_token(credentials: HTTPAuthorizationCredentials = Depends(bearer_sc
         raise HTTPException(status_code=401, detail="Invalid or missing token")
     return credentials
 
+
+def validate_operator_token(credentials: HTTPAuthorizationCredentials | None = Depends(optional_bearer_scheme)):
+    # A single shop's owner is its operator too; validate_token has already checked them
+    if not MULTI_TENANT:
+        return
+    if not OPERATOR_TOKEN or credentials is None or credentials.credentials != OPERATOR_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid or missing operator token")
+
+
+async def resolve_shop(credentials: HTTPAuthorizationCredentials | None = Depends(optional_bearer_scheme)) -> Shop:
+    if not MULTI_TENANT:
+        return DEFAULT_SHOP
+    shop = await tenants.resolve(credentials.credentials) if credentials else None
+    if shop is None:
+        raise HTTPException(status_code=401, detail="Invalid or missing token")
+    mirror.start(shop.shopify_token, shop.shopify_domain)
+    segment_worker.start(shop.shopify_token, shop.shopify_domain)
+    return shop
+
 origins = [
     HOST,
     "https://chat.openai.com",
 ]
 
-if HOST == "http://localhost:8000":
+if MULTI_TENANT or HOST == "http://localhost:8000":
+    # resolve_shop authenticates each request in multi-tenant mode
     api_dependencies = []
 else:
     api_dependencies = [Depends(validate_token)]
@@ -77,12 +149,214 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ConditionalMiddleware)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(MetricsMiddleware)
 if HOST == "http://localhost:8000":
     app.mount("/.well-known", StaticFiles(directory="local-server", html=True), name="static")
 else:
     app.mount("/.well-known", StaticFiles(directory=".well-known"), name="static")
 
 
+# Shopify authenticates webhooks with an HMAC signature rather than the
+# plugin's bearer token, so they're served from their own sub-app
+webhooks = FastAPI(openapi_url=None)
+
+
+@webhooks.post("/shopify")
+async def receive_shopify_webhook(
+    request: Request,
+    x_shopify_topic: str | None = Header(None),
+    x_shopify_hmac_sha256: str | None = Header(None),
+    x_shopify_shop_domain: str | None = Header(None),
+    x_shopify_webhook_id: str | None = Header(None),
+):
+    body = await request.body()
+    if not verify_webhook(body, x_shopify_hmac_sha256):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+    if x_shopify_topic not in WEBHOOK_TOPICS:
+        return {"status": "ignored"}
+    # Entries are cached per shop, so a delivery that doesn't name its shop can't be placed
+    if not x_shopify_shop_domain:
+        raise HTTPException(status_code=400, detail="Missing X-Shopify-Shop-Domain header")
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict) or "id" not in payload:
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
+    event = WebhookEvent(
+        shop=x_shopify_shop_domain,
+        topic=x_shopify_topic,
+        payload=payload,
+        webhook_id=x_shopify_webhook_id,
+    )
+    if not webhook_processor.enqueue(event):
+        raise HTTPException(status_code=503, detail="Webhook queue is full")
+    return {"status": "queued"}
+
+
+app.mount("/webhooks", webhooks)
+
+
+@app.on_event("startup")
+async def startup():
+    if MULTI_TENANT:
+        tenants.start()
+    else:
+        mirror.start(SHOP_API_KEY, SHOP_DOMAIN_NAME)
+        segment_worker.start(SHOP_API_KEY, SHOP_DOMAIN_NAME)
+    webhook_processor.start()
+    search_index.start()
+    job_runner.start()
+    if MULTI_TENANT:
+        readiness.start()
+    else:
+        readiness.start(SHOP_API_KEY, SHOP_DOMAIN_NAME)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await readiness.drain()
+    await tenants.stop()
+    await webhook_processor.stop()
+    await bulk_exporter.stop()
+    await job_runner.stop()
+    await prefetcher.stop()
+    await segment_worker.stop()
+    await search_index.stop()
+    await mirror.stop()
+    await close_clients()
+    await response_cache.close()
+
+
+@app.get("/ready", include_in_schema=False)
+async def get_ready():
+    # For load balancer health checks: 503 until the caches are warm and again while draining
+    return JSONResponse(readiness.as_dict(), status_code=200 if readiness.ready else 503)
+
+
+@app.get("/cache/stats", include_in_schema=False, dependencies=[Depends(validate_operator_token)])
+async def get_cache_stats():
+    return {
+        **await response_cache.stats_dict(),
+        "singleflight": request_flights.stats.as_dict(),
+        "webhooks": webhook_processor.stats.as_dict(),
+        "tenants": tenants.stats_dict(),
+        "search_index": search_index.stats_dict(),
+        "segments": segment_worker.stats_dict(),
+        "jobs": job_runner.stats_dict(),
+        "prefetch": prefetcher.stats_dict(),
+    }
+
+
+@app.post("/exports/{resource}", include_in_schema=False)
+async def start_export(
+    resource: str,
+    created_at_max: datetime | None = None,
+    created_at_min: datetime | None = None,
+    updated_at_max: datetime | None = None,
+    updated_at_min: datetime | None = None,
+    shop: Shop = Depends(resolve_shop),
+):
+    # Full-history datasets come from a Shopify bulk operation rather than paging
+    if resource == "orders":
+        search_query = order_filters_to_search_query(OrderUrlParams(
+            created_at_max=created_at_max,
+            created_at_min=created_at_min,
+            status="any",
+            updated_at_max=updated_at_max,
+            updated_at_min=updated_at_min,
+        ))
+    elif resource == "customers":
+        search_query = customer_filters_to_search_query(CustomerUrlParams(
+            created_at_max=created_at_max,
+            created_at_min=created_at_min,
+            updated_at_max=updated_at_max,
+            updated_at_min=updated_at_min,
+        ))
+    else:
+        raise HTTPException(status_code=404, detail="Exports cover orders or customers")
+    export = bulk_exporter.start(shop.shopify_token, shop.shopify_domain, resource[:-1], search_query or None)
+    return export.as_dict()
+
+
+@app.get("/exports/{export_id}", include_in_schema=False)
+async def get_export(export_id: str, shop: Shop = Depends(resolve_shop)):
+    export = bulk_exporter.get(export_id)
+    if export is None or export.shop != shop.shopify_domain:
+        raise HTTPException(status_code=404, detail="Export not found")
+    return export.as_dict()
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(job_request: JobRequest, shop: Shop = Depends(resolve_shop)):
+    # For listings too large to page through within a plugin call: acknowledge
+    # now, and let the caller read the results from /jobs/{job_id} as they arrive
+    try:
+        job, deduplicated = job_runner.submit(
+            shop.shopify_token, shop.shopify_domain, job_request.resource, job_request.params, job_request.max_records
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {**job.as_dict(), "deduplicated": deduplicated}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, offset: int = 0, limit: int = 50, shop: Shop = Depends(resolve_shop)):
+    job = job_runner.get(job_id)
+    if job is None or job.shop != shop.shopify_domain:
+        raise HTTPException(status_code=404, detail="Job not found, or its results have expired")
+    if offset < 0 or not 1 <= limit <= 250:
+        raise HTTPException(status_code=400, detail="offset must be at least 0 and limit between 1 and 250")
+    return job.as_dict(offset, limit)
+
+
+async def collect_cache_metrics():
+    stats = response_cache.stats.as_dict()
+    cache_lookups.set_total(stats["hits"], result="hit")
+    cache_lookups.set_total(stats["misses"] - stats["partial_misses"], result="miss")
+    cache_lookups.set_total(stats["partial_misses"], result="partial_miss")
+    cache_hit_ratio.set(stats["hit_ratio"])
+
+
+registry.add_collector(collect_cache_metrics)
+
+
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(validate_operator_token)])
+async def get_metrics():
+    return PlainTextResponse(await registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def parse_batch_ids(ids: str) -> list[int]:
+    try:
+        parsed = [int(i) for i in ids.split(",") if i.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma separated list of integers")
+    if not parsed or len(parsed) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"Pass between 1 and {MAX_BATCH_IDS} ids")
+    return parsed
+
+
+def parse_expand_param(expand: str | None) -> frozenset[str]:
+    try:
+        return parse_expand(expand)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def ndjson_lines(records):
+    try:
+        async for record in records:
+            yield dumps(record) + b"\n"
+    except Exception as e:
+        # Headers are already sent, so report the failure in-band
+        print("Error:", e)
+        yield dumps({"error": str(e)}) + b"\n"
+
+
 @app.get(
     "/orders", 
     response_model=OrdersResponse,
@@ -103,9 +377,15 @@ async def get_orders(
     status: str = "open",
     updated_at_max: datetime | None = None,
     updated_at_min: datetime | None = None,
+    expand: str | None = None,
+    customer_fields: str | None = DEFAULT_CUSTOMER_FIELDS,
+    shop: Shop = Depends(resolve_shop),
 ):
+    expansions = parse_expand_param(expand)
     try:
-        orders = get_shop_orders(SHOP_API_KEY, SHOP_DOMAIN_NAME, OrderUrlParams(
+        if "customer" in expansions:
+            fields = with_field(fields, "customer")
+        filters = OrderUrlParams(
             attribution_app_id=attribution_app_id,
             created_at_max=created_at_max,
             created_at_min=created_at_min,
@@ -120,8 +400,22 @@ async def get_orders(
             status=status,
             updated_at_max=updated_at_max,
             updated_at_min=updated_at_min,
-        ))
-        return orders
+        )
+        orders = await mirror.get_orders(shop.shopify_domain, filters)
+        if orders is None:
+            orders = await with_fallback(
+                lambda: get_shop_orders(shop.shopify_token, shop.shopify_domain, filters),
+                lambda: mirror.get_orders(shop.shopify_domain, filters, max_staleness=None),
+            )
+        if "customer" in expansions and "orders" in orders:
+            # The result may be shared with other callers (single-flight, cache), so copy rather than mutate it
+            orders = {**orders, "orders": await expand_order_customers(
+                shop.shopify_token, shop.shopify_domain, orders["orders"], customer_fields
+            )}
+        prefetcher.after_orders(shop.shopify_token, shop.shopify_domain, orders.get("orders", []))
+        return model_response(OrdersResponse, orders)
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
     except Exception as e:
         print("Error:", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
@@ -140,9 +434,10 @@ async def get_orders_count(
     status: str | None = "open",
     updated_at_max: datetime | None = None,
     updated_at_min: datetime | None = None,
+    shop: Shop = Depends(resolve_shop),
 ):
     try:
-        orders_count = get_shop_orders_count(SHOP_API_KEY, SHOP_DOMAIN_NAME, OrderCountUrlParams(
+        filters = OrderCountUrlParams(
             created_at_max=created_at_max,
             created_at_min=created_at_min,
             financial_status=financial_status,
@@ -150,13 +445,157 @@ async def get_orders_count(
             status=status,
             updated_at_max=updated_at_max,
             updated_at_min=updated_at_min,
-        ))
-        return orders_count
+        )
+        orders_count = await mirror.get_orders_count(shop.shopify_domain, filters)
+        if orders_count is None:
+            orders_count = await with_fallback(
+                lambda: get_shop_orders_count(shop.shopify_token, shop.shopify_domain, filters),
+                lambda: mirror.get_orders_count(shop.shopify_domain, filters, max_staleness=None),
+            )
+        return model_response(CountResponse, orders_count)
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
     except Exception as e:
         print("Error:", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
 
 
+@app.get(
+    "/orders/count/breakdown",
+    response_model=CountBreakdownResponse,
+    response_model_exclude_none=True
+)
+async def get_orders_count_breakdown_table(
+    dimension: str,
+    date_field: str = "created_at",
+    created_at_max: datetime | None = None,
+    created_at_min: datetime | None = None,
+    financial_status: str | None = "any",
+    fulfillment_status: str | None = "any",
+    status: str | None = "any",
+    updated_at_max: datetime | None = None,
+    updated_at_min: datetime | None = None,
+    shop: Shop = Depends(resolve_shop),
+):
+    try:
+        filters = OrderCountUrlParams(
+            created_at_max=created_at_max,
+            created_at_min=created_at_min,
+            financial_status=financial_status,
+            fulfillment_status=fulfillment_status,
+            status=status,
+            updated_at_max=updated_at_max,
+            updated_at_min=updated_at_min,
+        )
+        breakdown = await get_orders_count_breakdown(
+            shop.shopify_token, shop.shopify_domain, filters, dimension, date_field
+        )
+        return model_response(CountBreakdownResponse, breakdown)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
+    except Exception as e:
+        print("Error:", e)
+        raise HTTPException(status_code=500, detail=f"str({e})")
+
+
+@app.get(
+    "/orders/aggregate",
+    response_model=AggregateResponse,
+    response_model_exclude_none=True
+)
+async def get_orders_aggregate(
+    created_at_max: datetime | None = None,
+    created_at_min: datetime | None = None,
+    financial_status: str = "any",
+    fulfillment_status: str = "any",
+    status: str = "any",
+    updated_at_max: datetime | None = None,
+    updated_at_min: datetime | None = None,
+    field: str = "total_price",
+    group_by: str = "day",
+    metrics: str = "count,sum,avg",
+    shop: Shop = Depends(resolve_shop),
+):
+    try:
+        filters = OrderUrlParams(
+            created_at_max=created_at_max,
+            created_at_min=created_at_min,
+            financial_status=financial_status,
+            fulfillment_status=fulfillment_status,
+            status=status,
+            updated_at_max=updated_at_max,
+            updated_at_min=updated_at_min,
+        )
+        return await aggregate_shop_orders(shop.shopify_token, shop.shopify_domain, filters, field, group_by, metrics)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
+    except Exception as e:
+        print("Error:", e)
+        raise HTTPException(status_code=500, detail=f"str({e})")
+
+
+@app.get(
+    "/orders/batch",
+    response_model=OrdersBatchResponse,
+    response_model_exclude_unset=True
+)
+async def get_orders_batch(
+    ids: str,
+    fields: str | None = DEFAULT_ORDER_FIELDS,
+    shop: Shop = Depends(resolve_shop),
+):
+    order_ids = parse_batch_ids(ids)
+    try:
+        orders = await get_shop_orders_batch(shop.shopify_token, shop.shopify_domain, order_ids, fields)
+        return model_response(OrdersBatchResponse, orders)
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
+    except Exception as e:
+        print("Error:", e)
+        raise HTTPException(status_code=500, detail=f"str({e})")
+
+
+@app.get("/orders/stream")
+async def stream_orders(
+    attribution_app_id: str | None = None,
+    created_at_max: datetime | None = None,
+    created_at_min: datetime | None = None,
+    fields: str | None = DEFAULT_ORDER_FIELDS,
+    financial_status: str = "any",
+    fulfillment_status: str = "any",
+    ids: str | None = None,
+    limit: int = 250,
+    processed_at_max: datetime | None = None,
+    processed_at_min: datetime | None = None,
+    since_id: int | None = None,
+    status: str = "open",
+    updated_at_max: datetime | None = None,
+    updated_at_min: datetime | None = None,
+    shop: Shop = Depends(resolve_shop),
+):
+    orders = iter_shop_orders(shop.shopify_token, shop.shopify_domain, OrderUrlParams(
+        attribution_app_id=attribution_app_id,
+        created_at_max=created_at_max,
+        created_at_min=created_at_min,
+        fields=fields,
+        financial_status=financial_status,
+        fulfillment_status=fulfillment_status,
+        ids=ids,
+        limit=limit,
+        processed_at_max=processed_at_max,
+        processed_at_min=processed_at_min,
+        since_id=since_id,
+        status=status,
+        updated_at_max=updated_at_max,
+        updated_at_min=updated_at_min,
+    ))
+    return StreamingResponse(ndjson_lines(orders), media_type="application/x-ndjson")
+
+
 @app.get(
     "/orders/{order_id}", 
     response_model=OrderResponse,
@@ -165,10 +604,26 @@ async def get_orders_count(
 async def get_order(
     order_id: int, 
     fields: str | None = DEFAULT_ORDER_FIELDS, 
+    expand: str | None = None,
+    customer_fields: str | None = DEFAULT_CUSTOMER_FIELDS,
+    shop: Shop = Depends(resolve_shop),
 ):
+    expansions = parse_expand_param(expand)
     try:
-        order = get_shop_order(SHOP_API_KEY, SHOP_DOMAIN_NAME, order_id, fields=fields)
-        return order
+        if "customer" in expansions:
+            fields = with_field(fields, "customer")
+        await prefetcher.record_lookup(shop.shopify_domain, "order", order_id, fields)
+        order = await get_shop_order(shop.shopify_token, shop.shopify_domain, order_id, fields=fields)
+        if "customer" in expansions and (order.get("order", {}).get("customer") or {}).get("id"):
+            await prefetcher.record_lookup(shop.shopify_domain, "customer", order["order"]["customer"]["id"], customer_fields)
+        if "customer" in expansions and "order" in order:
+            [expanded] = await expand_order_customers(
+                shop.shopify_token, shop.shopify_domain, [order["order"]], customer_fields
+            )
+            order = {**order, "order": expanded}
+        return model_response(OrderResponse, order)
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
     except Exception as e:
         print("Error:", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
@@ -183,21 +638,101 @@ async def get_customers_count(
     created_at_min: datetime | None = None,
     updated_at_max: datetime | None = None,
     updated_at_min: datetime | None = None,
+    shop: Shop = Depends(resolve_shop),
 ):
     try:
-        customers_count = get_shop_customers_count(SHOP_API_KEY, SHOP_DOMAIN_NAME, CustomerCountUrlParams(
+        filters = CustomerCountUrlParams(
             created_at_max=created_at_max,
             created_at_min=created_at_min,
             updated_at_max=updated_at_max,
             updated_at_min=updated_at_min,
-        ))
+        )
+        customers_count = await mirror.get_customers_count(shop.shopify_domain, filters)
+        if customers_count is None:
+            customers_count = await with_fallback(
+                lambda: get_shop_customers_count(shop.shopify_token, shop.shopify_domain, filters),
+                lambda: mirror.get_customers_count(shop.shopify_domain, filters, max_staleness=None),
+            )
 
-        return customers_count
+        return model_response(CountResponse, customers_count)
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
     except Exception as e:
         print("Error:", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
 
 
+@app.get(
+    "/customers/count/breakdown",
+    response_model=CountBreakdownResponse,
+    response_model_exclude_none=True
+)
+async def get_customers_count_breakdown_table(
+    dimension: str,
+    date_field: str = "created_at",
+    created_at_max: datetime | None = None,
+    created_at_min: datetime | None = None,
+    updated_at_max: datetime | None = None,
+    updated_at_min: datetime | None = None,
+    shop: Shop = Depends(resolve_shop),
+):
+    try:
+        filters = CustomerCountUrlParams(
+            created_at_max=created_at_max,
+            created_at_min=created_at_min,
+            updated_at_max=updated_at_max,
+            updated_at_min=updated_at_min,
+        )
+        breakdown = await get_customers_count_breakdown(
+            shop.shopify_token, shop.shopify_domain, filters, dimension, date_field
+        )
+        return model_response(CountBreakdownResponse, breakdown)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
+    except Exception as e:
+        print("Error:", e)
+        raise HTTPException(status_code=500, detail=f"str({e})")
+
+
+def segment_snapshot(shop: Shop) -> SegmentSnapshot:
+    if not segment_worker.enabled:
+        raise HTTPException(status_code=404, detail="Customer segments are turned off (SEGMENTS_ENABLED)")
+    snapshot = segment_worker.get(shop.shopify_domain)
+    if snapshot is None:
+        raise HTTPException(status_code=503, detail="Customer segments are still being computed; try again shortly")
+    return snapshot
+
+
+@app.get(
+    "/customers/segments",
+    response_model=CustomerSegmentsResponse
+)
+async def get_customer_segments(shop: Shop = Depends(resolve_shop)):
+    return model_response(CustomerSegmentsResponse, segment_snapshot(shop).segments_dict())
+
+
+@app.get(
+    "/customers/top",
+    response_model=TopCustomersResponse,
+    response_model_exclude_none=True
+)
+async def get_top_customers(
+    by: str = "total_spent",
+    segment: str | None = None,
+    limit: int = 10,
+    offset: int = 0,
+    shop: Shop = Depends(resolve_shop),
+):
+    snapshot = segment_snapshot(shop)
+    try:
+        # Not model_response: its compaction would strip these down to Customer's fields
+        return snapshot.top(by, segment, max(0, limit), max(0, offset))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.get(
     "/customers/search", 
     response_model=CustomersResponse,
@@ -209,22 +744,71 @@ async def search_customers(
     order_field: str = "last_order_date",
     order_direction: str = "DESC",
     query: str = None,
+    shop: Shop = Depends(resolve_shop),
 ):
     try:
-        customers = get_shop_customers(SHOP_API_KEY, SHOP_DOMAIN_NAME, CustomerSearchUrlParams(
+        filters = CustomerSearchUrlParams(
             fields=fields,
             limit=limit,
             order_field=order_field,
             order_direction=order_direction,
             query=query,
-        ))
+        )
+        customers = await search_index.search_customers(shop.shopify_domain, filters)
+        if customers is None:
+            customers = await with_fallback(
+                lambda: get_shop_customers(shop.shopify_token, shop.shopify_domain, filters),
+                lambda: search_index.search_customers(shop.shopify_domain, filters, max_staleness=None),
+            )
+        prefetcher.after_customer_search(shop.shopify_token, shop.shopify_domain, customers.get("customers", []))
+        return model_response(CustomersResponse, customers)
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
+    except Exception as e:
+        print("Error:", e)
+        raise HTTPException(status_code=500, detail=f"str({e})")
 
-        return customers
+
+@app.get(
+    "/customers/batch",
+    response_model=CustomersBatchResponse,
+    response_model_exclude_unset=True
+)
+async def get_customers_batch(
+    ids: str,
+    fields: str | None = DEFAULT_CUSTOMER_FIELDS,
+    shop: Shop = Depends(resolve_shop),
+):
+    customer_ids = parse_batch_ids(ids)
+    try:
+        customers = await get_shop_customers_batch(shop.shopify_token, shop.shopify_domain, customer_ids, fields)
+        return model_response(CustomersBatchResponse, customers)
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
     except Exception as e:
         print("Error:", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
 
 
+@app.get("/customers/search/stream")
+async def stream_customers(
+    fields: str | None = DEFAULT_CUSTOMER_FIELDS,
+    limit: int = 250,
+    order_field: str = "last_order_date",
+    order_direction: str = "DESC",
+    query: str = None,
+    shop: Shop = Depends(resolve_shop),
+):
+    customers = iter_shop_customers(shop.shopify_token, shop.shopify_domain, CustomerSearchUrlParams(
+        fields=fields,
+        limit=limit,
+        order_field=order_field,
+        order_direction=order_direction,
+        query=query,
+    ))
+    return StreamingResponse(ndjson_lines(customers), media_type="application/x-ndjson")
+
+
 @app.get(
     "/customers/{customer_id}", 
     response_model=CustomerResponse,
@@ -233,10 +817,14 @@ async def search_customers(
 async def get_customer(
     customer_id: int, 
     fields: str | None = DEFAULT_CUSTOMER_FIELDS, 
+    shop: Shop = Depends(resolve_shop),
 ):
     try:
-        customer = get_shop_customer(SHOP_API_KEY, SHOP_DOMAIN_NAME, customer_id, fields)
-        return customer
+        await prefetcher.record_lookup(shop.shopify_domain, "customer", customer_id, fields)
+        customer = await get_shop_customer(shop.shopify_token, shop.shopify_domain, customer_id, fields)
+        return model_response(CustomerResponse, customer)
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Shopify didn't respond in time")
     except Exception as e:
         print("Error:", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
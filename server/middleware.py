@@ -0,0 +1,181 @@
+import gzip
+import hashlib
+import os
+import time
+
+from services.deadline import FALLBACK_HEADER, REQUEST_DEADLINE, deadline_scope
+from services.metrics import http_request_duration
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Clients may ask for a tighter deadline than REQUEST_DEADLINE, never a looser one
+TIMEOUT_HEADER = b"x-request-timeout"
+# Smaller bodies aren't worth the CPU; most single-record responses stay uncompressed
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+GZIP_LEVEL = 6
+# Brotli's higher qualities are meant for static assets; 4 compresses about as fast as gzip
+BROTLI_QUALITY = 4
+COMPRESSIBLE_TYPES = (b"application/json", b"application/x-ndjson", b"text/")
+
+
+class MetricsMiddleware:
+    # Plain ASGI rather than BaseHTTPMiddleware, so streamed responses are
+    # timed to their last chunk and nothing is buffered
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # FastAPI records the matched route in the scope; label by its template
+            route = scope.get("route")
+            http_request_duration.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=status,
+            )
+
+
+class DeadlineMiddleware:
+    # Gives each request a deadline its Shopify calls share, and reports in a
+    # header when the handler had to answer from stale or partial data
+    def __init__(self, app, seconds: float = REQUEST_DEADLINE):
+        self.app = app
+        self.seconds = seconds
+
+    def request_seconds(self, scope) -> float:
+        for name, value in scope["headers"]:
+            if name == TIMEOUT_HEADER:
+                try:
+                    return max(0.0, min(self.seconds, float(value)))
+                except ValueError:
+                    break
+        return self.seconds
+
+    async def __call__(self, scope, receive, send):
+        # Streams run as long as the client keeps reading
+        if scope["type"] != "http" or scope["path"].endswith("/stream"):
+            await self.app(scope, receive, send)
+            return
+
+        with deadline_scope(self.request_seconds(scope)) as state:
+            async def send_with_fallback(message):
+                if message["type"] == "http.response.start" and state.fallback:
+                    headers = [*message.get("headers", []), (FALLBACK_HEADER.lower().encode(), state.fallback.encode())]
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_fallback)
+
+
+def accepted_encodings(value: str) -> set[str]:
+    encodings = set()
+    for item in value.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # Weak comparison, as If-None-Match calls for
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in tags
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL)
+
+
+class ConditionalMiddleware:
+    # ETags from a hash of the body, 304s for If-None-Match, and gzip/brotli.
+    # Complete bodies only: streamed responses pass through untouched
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        start = None
+        chunks = []
+        streaming = False
+
+        async def send_conditional(message):
+            nonlocal start, streaming
+            if streaming:
+                await send(message)
+            elif message["type"] == "http.response.start":
+                start = message
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if message.get("more_body", False):
+                    streaming = True
+                    await send(start)
+                    await send({"type": "http.response.body", "body": b"".join(chunks), "more_body": True})
+                else:
+                    await self.respond(start, b"".join(chunks), request_headers, send)
+            else:
+                await send(message)
+
+        await self.app(scope, receive, send_conditional)
+
+    async def respond(self, start: dict, body: bytes, request_headers: dict, send):
+        headers = [(name, value) for name, value in start.get("headers", []) if name != b"content-length"]
+        header_names = {name for name, _ in headers}
+        if start["status"] != 200 or b"content-encoding" in header_names:
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        etag = f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        headers.append((b"etag", etag.encode()))
+        headers.append((b"vary", b"Accept-Encoding"))
+        if etag_matches(request_headers.get("if-none-match", ""), etag):
+            await send({**start, "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        content_type = dict(headers).get(b"content-type", b"")
+        if len(body) >= self.minimum_size and content_type.startswith(COMPRESSIBLE_TYPES):
+            accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+            encoding = "br" if "br" in accepted and brotli is not None else "gzip" if "gzip" in accepted else None
+            if encoding is not None:
+                body = compress(body, encoding)
+                headers.append((b"content-encoding", encoding.encode()))
+        headers.append((b"content-length", str(len(body)).encode()))
+        await send({**start, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,64 @@
+import json
+import os
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from services.cache import compact_record
+from services.metrics import serialization_duration
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Debug mode: validate every response against its model the way
+# response_model does, so schema drift fails loudly instead of passing through
+STRICT_RESPONSE_VALIDATION = os.getenv("STRICT_RESPONSE_VALIDATION", "false").lower() == "true"
+
+RESPONSE_RESOURCES = {
+    "order": "order",
+    "orders": "order",
+    "customer": "customer",
+    "customers": "customer",
+}
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def compact_response(content: dict) -> dict:
+    # Shopify's JSON is trusted as is; only fields the models don't declare are dropped
+    compacted = {}
+    for key, value in content.items():
+        resource = RESPONSE_RESOURCES.get(key)
+        if resource is None:
+            compacted[key] = value
+        elif isinstance(value, list):
+            compacted[key] = [compact_record(resource, record) for record in value]
+        elif isinstance(value, dict):
+            compacted[key] = compact_record(resource, value)
+        else:
+            compacted[key] = value
+    return compacted
+
+
+def model_response(model: type[BaseModel], content: dict) -> FastJSONResponse:
+    # Returning a Response skips FastAPI's response_model validation; the
+    # model stays on the route for the OpenAPI schema
+    with serialization_duration.time(model=model.__name__):
+        missing = any(field.required and name not in content for name, field in model.__fields__.items())
+        if STRICT_RESPONSE_VALIDATION or missing:
+            # Unexpected shapes (e.g. Shopify error bodies) still fail validation as before
+            content = json.loads(model.parse_obj(content).json(exclude_unset=True))
+        else:
+            content = compact_response(content)
+        return FastJSONResponse(content)
@@ -0,0 +1,88 @@
+import asyncio
+import math
+import os
+import signal
+import sys
+
+from dotenv import load_dotenv
+from gunicorn.app.base import BaseApplication
+from gunicorn.arbiter import Arbiter
+from uvicorn.main import Server
+from uvicorn.workers import UvicornWorker
+
+load_dotenv()
+
+# Heroku sets PORT and WEB_CONCURRENCY, Azure sets WEBSITES_PORT, Fly.io uses 8080 by default
+PORT = int(os.getenv("PORT", os.getenv("WEBSITES_PORT", 8080)))
+# Every worker runs its own mirror sync, webhook and segment workers, so keep this modest
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 2))
+# How long /ready reports 503 before the worker stops accepting connections, so the load
+# balancer has time to notice; in-flight requests then get GRACEFUL_TIMEOUT to finish
+SHUTDOWN_DRAIN_DELAY = float(os.getenv("SHUTDOWN_DRAIN_DELAY", 5))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+KEEPALIVE_TIMEOUT = int(os.getenv("KEEPALIVE_TIMEOUT", 5))
+
+
+class DrainingServer(Server):
+    def handle_exit(self, sig, frame):
+        from services.warmup import readiness
+
+        # SIGQUIT is gunicorn's quick shutdown, and a second signal, or one that
+        # arrives while already draining, exits right away too
+        if sig == signal.SIGQUIT or readiness.draining or SHUTDOWN_DRAIN_DELAY <= 0:
+            return super().handle_exit(sig, frame)
+        readiness.draining = True
+        asyncio.get_running_loop().call_later(SHUTDOWN_DRAIN_DELAY, super().handle_exit, sig, frame)
+
+
+class Worker(UvicornWorker):
+    # Named explicitly so a missing dependency fails the boot rather than quietly
+    # falling back to the pure-Python loop and parser
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+    def run(self):
+        # gunicorn's extension point for a worker's main loop; uvicorn's own is private,
+        # so the server is started here through its public API
+        return asyncio.run(self.serve())
+
+    async def serve(self):
+        self.config.app = self.wsgi
+        server = DrainingServer(config=self.config)
+        # The server installs its own SIGINT and SIGTERM handlers
+        asyncio.get_running_loop().add_signal_handler(signal.SIGQUIT, server.handle_exit, signal.SIGQUIT, None)
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+class Application(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from server.main import app
+
+        return app
+
+
+def main():
+    Application({
+        "bind": f"0.0.0.0:{PORT}",
+        "workers": WEB_CONCURRENCY,
+        "worker_class": "server.serve.Worker",
+        # Import the app once in the master, so a broken build fails before any worker forks
+        "preload_app": True,
+        "graceful_timeout": GRACEFUL_TIMEOUT + math.ceil(SHUTDOWN_DRAIN_DELAY),
+        "keepalive": KEEPALIVE_TIMEOUT,
+        "forwarded_allow_ips": "*",
+        "accesslog": "-",
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+from array import array
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+
+from models.shopify_api import OrderUrlParams
+from services.deadline import DeadlineExceeded, mark_fallback
+from services.mirror import mirror, timestamp
+from services.shopify import iter_shop_orders
+
+MONEY_FIELDS = (
+    "total_price",
+    "subtotal_price",
+    "total_tax",
+    "total_discounts",
+    "total_line_items_price",
+    "total_outstanding",
+    "total_tip_received",
+    "current_total_price",
+    "current_subtotal_price",
+    "current_total_tax",
+    "current_total_discounts",
+)
+TIME_GROUPS = ("day", "week", "month")
+GROUP_BY_OPTIONS = TIME_GROUPS + ("financial_status", "currency", "tag", "none")
+METRICS = ("count", "sum", "avg", "min", "max")
+# ISO 4217 minor units for currencies that don't use two decimal places
+CURRENCY_DECIMALS = {
+    "BIF": 0, "CLP": 0, "DJF": 0, "GNF": 0, "ISK": 0, "JPY": 0, "KMF": 0, "KRW": 0,
+    "PYG": 0, "RWF": 0, "UGX": 0, "VND": 0, "VUV": 0, "XAF": 0, "XOF": 0, "XPF": 0,
+    "BHD": 3, "IQD": 3, "JOD": 3, "KWD": 3, "LYD": 3, "OMR": 3, "TND": 3,
+}
+
+
+def currency_decimals(currency: str | None) -> int:
+    return CURRENCY_DECIMALS.get((currency or "").upper(), 2)
+
+
+def to_cents(value, currency: str = None) -> int:
+    # Money is kept as integer minor units (cents, yen, fils) so sums never drift like floats do
+    if value in (None, ""):
+        return 0
+    return int(Decimal(str(value)).scaleb(currency_decimals(currency)).to_integral_value(ROUND_HALF_UP))
+
+
+def from_cents(cents: int | Decimal, currency: str = None) -> str:
+    decimals = currency_decimals(currency)
+    return str(Decimal(cents).scaleb(-decimals).quantize(Decimal(1).scaleb(-decimals), ROUND_HALF_UP))
+
+
+def parse_metrics(metrics: str) -> tuple[list[str], list[int]]:
+    names, percentiles = [], []
+    for metric in (m.strip().lower() for m in metrics.split(",")):
+        if not metric:
+            continue
+        if metric == "median":
+            percentiles.append(50)
+        elif metric.startswith("p") and metric[1:].isdigit() and 0 < int(metric[1:]) <= 100:
+            percentiles.append(int(metric[1:]))
+        elif metric in METRICS:
+            names.append(metric)
+        else:
+            raise ValueError(f"Unknown metric: {metric}")
+    return names, percentiles
+
+
+def time_bucket(created_at: float, group_by: str) -> str:
+    moment = datetime.fromtimestamp(created_at, timezone.utc)
+    if group_by == "day":
+        return moment.strftime("%Y-%m-%d")
+    if group_by == "week":
+        year, week, _ = moment.isocalendar()
+        return f"{year}-W{week:02d}"
+    return moment.strftime("%Y-%m")
+
+
+def percentile(sorted_values: array, rank: int) -> int:
+    # Nearest-rank, so the result is always an actual order amount
+    index = max(0, -(-rank * len(sorted_values) // 100) - 1)
+    return sorted_values[index]
+
+
+class OrderColumns:
+    def __init__(self, field: str):
+        self.field = field
+        self.created_at = array("d")
+        self.amounts = array("q")
+        self.financial_status: list[str] = []
+        self.currency: list[str] = []
+        self.tags: list[str] = []
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def append(self, order: dict):
+        self.created_at.append(timestamp(order.get("created_at")) or 0.0)
+        self.amounts.append(to_cents(order.get(self.field), order.get("currency")))
+        self.financial_status.append(order.get("financial_status") or "")
+        self.currency.append(order.get("currency") or "")
+        self.tags.append(order.get("tags") or "")
+
+    def group_rows(self, group_by: str) -> dict[str, array]:
+        if group_by == "none":
+            return {"all": array("q", range(len(self)))}
+        if group_by in TIME_GROUPS:
+            keys = (time_bucket(created_at, group_by) for created_at in self.created_at)
+        elif group_by == "tag":
+            keys = None
+        else:
+            keys = iter(getattr(self, group_by))
+
+        groups: dict[str, array] = {}
+        if keys is None:
+            # An order counts toward every one of its tags
+            for row, tags in enumerate(self.tags):
+                for tag in [t.strip() for t in tags.split(",") if t.strip()] or ["(none)"]:
+                    groups.setdefault(tag, array("q")).append(row)
+        else:
+            for row, key in enumerate(keys):
+                groups.setdefault(key or "(none)", array("q")).append(row)
+        return groups
+
+    def summarize(self, key: str, currency: str, rows: array, names: list[str], percentiles: list[int]) -> dict:
+        amounts = array("q", (self.amounts[row] for row in rows))
+        total = sum(amounts)
+        result = {"key": key, "currency": currency or None, "count": len(amounts)}
+        if "sum" in names:
+            result["sum"] = from_cents(total, currency)
+        if "avg" in names:
+            result["avg"] = from_cents(Decimal(total) / len(amounts), currency)
+        if "min" in names:
+            result["min"] = from_cents(min(amounts), currency)
+        if "max" in names:
+            result["max"] = from_cents(max(amounts), currency)
+        if percentiles:
+            ordered = array("q", sorted(amounts))
+            result["percentiles"] = {f"p{rank}": from_cents(percentile(ordered, rank), currency) for rank in percentiles}
+        return result
+
+    def aggregate(self, group_by: str, metrics: str) -> list[dict]:
+        names, percentiles = parse_metrics(metrics)
+        results = []
+        for key, rows in self.group_rows(group_by).items():
+            # Amounts in different currencies are never added up; each group is split by currency
+            by_currency: dict[str, array] = {}
+            for row in rows:
+                by_currency.setdefault(self.currency[row], array("q")).append(row)
+            for currency, currency_rows in by_currency.items():
+                results.append(self.summarize(key, currency, currency_rows, names, percentiles))
+
+        if group_by in TIME_GROUPS:
+            results.sort(key=lambda result: (result["key"], -result["count"], result["currency"] or ""))
+        else:
+            results.sort(key=lambda result: (-result["count"], result["key"], result["currency"] or ""))
+        return results
+
+
+async def aggregate_shop_orders(
+    shop_api_key: str,
+    shop_domain_name: str,
+    filters: OrderUrlParams,
+    field: str = "total_price",
+    group_by: str = "day",
+    metrics: str = "count,sum,avg",
+) -> dict:
+    if field not in MONEY_FIELDS:
+        raise ValueError(f"field must be one of: {', '.join(MONEY_FIELDS)}")
+    if group_by not in GROUP_BY_OPTIONS:
+        raise ValueError(f"group_by must be one of: {', '.join(GROUP_BY_OPTIONS)}")
+    parse_metrics(metrics)
+
+    columns = OrderColumns(field)
+    records = await mirror.get_order_records(shop_domain_name, filters)
+    if records is not None:
+        for order in records:
+            columns.append(order)
+    else:
+        # Fetch only the columns the aggregation reads, a full page at a time
+        filters = filters.copy(update={
+            "fields": f"id,created_at,financial_status,currency,tags,{field}",
+            "limit": 250,
+        })
+        try:
+            async for order in iter_shop_orders(shop_api_key, shop_domain_name, filters):
+                columns.append(order)
+        except DeadlineExceeded:
+            # Pages come newest first, so what's been read covers the most recent orders
+            mark_fallback("partial")
+
+    return {
+        "field": field,
+        "group_by": group_by,
+        "order_count": len(columns),
+        "groups": columns.aggregate(group_by, metrics),
+    }
@@ -0,0 +1,168 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
+from models.shopify_api import (
+    CustomerCountUrlParams,
+    FinancialStatusForOrderCount,
+    FulfillmentStatus,
+    OrderCountStatus,
+    OrderCountUrlParams,
+)
+from services.analytics import TIME_GROUPS, time_bucket
+from services.cache import response_cache
+from services.deadline import with_fallback
+from services.mirror import mirror
+from services.shopify import (
+    customer_count_filters_to_url_parms,
+    get_shop_customers_count,
+    get_shop_orders_count,
+    order_count_filters_to_url_params,
+)
+
+# Each bucket is one count call on a cold cache, so wide ranges need a coarser dimension
+MAX_BREAKDOWN_BUCKETS = int(os.getenv("MAX_BREAKDOWN_BUCKETS", 100))
+
+ORDER_DIMENSIONS = {
+    "financial_status": [status for status in FinancialStatusForOrderCount if status != FinancialStatusForOrderCount.any],
+    "fulfillment_status": [status for status in FulfillmentStatus if status != FulfillmentStatus.any],
+    "status": [status for status in OrderCountStatus if status != OrderCountStatus.any],
+}
+DATE_FIELDS = ("created_at", "updated_at")
+
+
+def as_utc(moment: datetime) -> datetime:
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment.astimezone(timezone.utc)
+
+
+def bucket_start(moment: datetime, group_by: str) -> datetime:
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if group_by == "day":
+        return day
+    if group_by == "week":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def next_bucket_start(start: datetime, group_by: str) -> datetime:
+    if group_by == "day":
+        return start + timedelta(days=1)
+    if group_by == "week":
+        return start + timedelta(weeks=1)
+    return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def date_buckets(start: datetime | None, end: datetime | None, group_by: str) -> list[tuple[str, datetime, datetime]]:
+    # Calendar-aligned (UTC) buckets, so overlapping ranges ask for the same
+    # interior buckets and hit the same cache entries
+    if start is None:
+        raise ValueError("A date breakdown needs a start date")
+    start = as_utc(start)
+    end = as_utc(end) if end is not None else datetime.now(timezone.utc).replace(microsecond=0)
+    if start > end:
+        raise ValueError("The start date must be before the end date")
+
+    buckets = []
+    current = bucket_start(start, group_by)
+    while current <= end:
+        following = next_bucket_start(current, group_by)
+        # Shopify's *_max bounds are inclusive, to the second
+        buckets.append((time_bucket(current.timestamp(), group_by), max(start, current), min(end, following - timedelta(seconds=1))))
+        if len(buckets) > MAX_BREAKDOWN_BUCKETS:
+            raise ValueError(f"A breakdown is limited to {MAX_BREAKDOWN_BUCKETS} buckets; narrow the range or use a coarser dimension")
+        current = following
+    return buckets
+
+
+def plan_buckets(filters, dimensions: dict, dimension: str, date_field: str) -> list[tuple[dict, object]]:
+    # One (bucket description, filters for its count) pair per bucket
+    if dimension in dimensions:
+        return [({"key": value.value}, filters.copy(update={dimension: value})) for value in dimensions[dimension]]
+    if dimension not in TIME_GROUPS:
+        raise ValueError(f"dimension must be one of: {', '.join([*dimensions, *TIME_GROUPS])}")
+    if date_field not in DATE_FIELDS:
+        raise ValueError(f"date_field must be one of: {', '.join(DATE_FIELDS)}")
+
+    buckets = date_buckets(getattr(filters, f"{date_field}_min"), getattr(filters, f"{date_field}_max"), dimension)
+    return [
+        (
+            {"key": key, "start": start.isoformat(), "end": end.isoformat()},
+            filters.copy(update={f"{date_field}_min": start, f"{date_field}_max": end}),
+        )
+        for key, start, end in buckets
+    ]
+
+
+async def cached_count(shop_domain_name: str, cache_id: str, fetch) -> dict:
+    cached = await response_cache.get(shop_domain_name, "count", cache_id)
+    if cached is not None:
+        return cached
+    data = await fetch()
+    if "count" not in data:
+        raise RuntimeError(f"Count failed: {data.get('errors')}")
+    await response_cache.set(shop_domain_name, "count", cache_id, None, data)
+    return data
+
+
+async def count_breakdown(plan: list[tuple[dict, object]], count) -> list[dict]:
+    # Every bucket at once; the per-shop rate limiter paces the Shopify calls
+    counts = await asyncio.gather(*(count(bucket_filters) for _, bucket_filters in plan))
+    return [{**bucket, "count": data["count"]} for (bucket, _), data in zip(plan, counts)]
+
+
+def breakdown_response(dimension: str, buckets: list[dict]) -> dict:
+    response = {"dimension": dimension, "buckets": buckets}
+    if dimension in TIME_GROUPS:
+        # Date buckets partition the range; status buckets can overlap (e.g. unshipped and unfulfilled)
+        response["total"] = sum(bucket["count"] for bucket in buckets)
+    return response
+
+
+async def get_orders_count_breakdown(
+    shop_api_key: str,
+    shop_domain_name: str,
+    filters: OrderCountUrlParams,
+    dimension: str,
+    date_field: str = "created_at",
+) -> dict:
+    plan = plan_buckets(filters, ORDER_DIMENSIONS, dimension, date_field)
+
+    async def count(bucket_filters: OrderCountUrlParams) -> dict:
+        data = await mirror.get_orders_count(shop_domain_name, bucket_filters)
+        if data is not None:
+            return data
+        return await with_fallback(
+            lambda: cached_count(
+                shop_domain_name,
+                f"orders?{order_count_filters_to_url_params(bucket_filters)}",
+                lambda: get_shop_orders_count(shop_api_key, shop_domain_name, bucket_filters),
+            ),
+            lambda: mirror.get_orders_count(shop_domain_name, bucket_filters, max_staleness=None),
+        )
+
+    return breakdown_response(dimension, await count_breakdown(plan, count))
+
+
+async def get_customers_count_breakdown(
+    shop_api_key: str,
+    shop_domain_name: str,
+    filters: CustomerCountUrlParams,
+    dimension: str,
+    date_field: str = "created_at",
+) -> dict:
+    plan = plan_buckets(filters, {}, dimension, date_field)
+
+    async def count(bucket_filters: CustomerCountUrlParams) -> dict:
+        data = await mirror.get_customers_count(shop_domain_name, bucket_filters)
+        if data is not None:
+            return data
+        return await with_fallback(
+            lambda: cached_count(
+                shop_domain_name,
+                f"customers?{customer_count_filters_to_url_parms(bucket_filters)}",
+                lambda: get_shop_customers_count(shop_api_key, shop_domain_name, bucket_filters),
+            ),
+            lambda: mirror.get_customers_count(shop_domain_name, bucket_filters, max_staleness=None),
+        )
+
+    return breakdown_response(dimension, await count_breakdown(plan, count))
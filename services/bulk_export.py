@@ -0,0 +1,264 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+import uuid
+from dataclasses import dataclass
+
+from services.cache import RESOURCE_MODELS
+from services.deadline import detach
+from services.http_client import get_client
+from services.mirror import mirror, timestamp
+from services.rate_limit import Priority
+from services.shopify_graphql import GraphQLError, convert_node, graphql_request, selection
+
+BULK_EXPORT_DIR = os.getenv("BULK_EXPORT_DIR", "exports")
+BULK_POLL_INTERVAL = float(os.getenv("BULK_POLL_INTERVAL", 2))
+# Records per column chunk in the export file; bounds memory while writing
+BULK_ROW_GROUP_SIZE = int(os.getenv("BULK_ROW_GROUP_SIZE", 10000))
+BULK_WRITE_BATCH = 500
+# Finished exports are forgotten this long after they finish; their files are left in place
+BULK_EXPORT_TTL = float(os.getenv("BULK_EXPORT_TTL", 86400))
+# Bulk mutations are charged a flat 10 points
+BULK_MUTATION_COST = 10
+
+BULK_RUN_MUTATION = """
+mutation($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+BULK_STATUS_QUERY = """
+query($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { id status errorCode objectCount url }
+  }
+}
+"""
+
+FINISHED_STATUSES = {"COMPLETED", "FAILED", "CANCELED", "EXPIRED"}
+
+
+def bulk_query(resource: str, search_query: str | None) -> str:
+    arguments = f"(query: {json.dumps(search_query)})" if search_query else ""
+    return f"{{ {resource}s{arguments} {{ edges {{ node {{ {selection(resource, None)} }} }} }} }}"
+
+
+class ColumnarWriter:
+    # A gzip file of JSON lines: a header naming the columns, then one line
+    # per row group holding each column's values as a list
+    def __init__(self, path: str, resource: str, fields: list[str]):
+        self.path = path
+        self.fields = fields
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._file.write(json.dumps({"resource": resource, "fields": fields}) + "\n")
+        self._columns = self._empty_columns()
+        self._rows = 0
+
+    def _empty_columns(self) -> dict[str, list]:
+        return {field: [] for field in self.fields}
+
+    def append(self, record: dict):
+        for field, column in self._columns.items():
+            column.append(record.get(field))
+        self._rows += 1
+
+    @property
+    def full(self) -> bool:
+        return self._rows >= BULK_ROW_GROUP_SIZE
+
+    def flush(self):
+        if not self._rows:
+            return
+        self._file.write(json.dumps({"rows": self._rows, "columns": self._columns}, separators=(",", ":")) + "\n")
+        self._columns = self._empty_columns()
+        self._rows = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def read_columnar(path: str, columns: list[str] = None):
+    # Yields one {column: values} dict per row group, for just the columns asked for
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        header = json.loads(file.readline())
+        wanted = columns or header["fields"]
+        for line in file:
+            group = json.loads(line)["columns"]
+            yield {column: group[column] for column in wanted}
+
+
+@dataclass
+class BulkExport:
+    id: str
+    shop: str
+    resource: str
+    search_query: str = None
+    status: str = "CREATED"
+    operation_id: str = None
+    object_count: int = 0
+    records: int = 0
+    invalid: int = 0
+    path: str = None
+    error: str = None
+    started_at: float = None
+    finished_at: float = None
+
+    @property
+    def expired(self) -> bool:
+        return self.finished_at is not None and time.time() - self.finished_at > BULK_EXPORT_TTL
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "resource": self.resource,
+            "query": self.search_query,
+            "status": self.status,
+            "object_count": self.object_count,
+            "records": self.records,
+            "invalid": self.invalid,
+            "path": self.path,
+            "error": self.error,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class BulkExporter:
+    def __init__(self, directory: str = BULK_EXPORT_DIR):
+        self.directory = directory
+        self.exports: dict[str, BulkExport] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    async def submit(self, shop_api_key: str, shop_domain_name: str, query: str) -> str:
+        data = await graphql_request(
+            shop_api_key,
+            shop_domain_name,
+            BULK_RUN_MUTATION,
+            {"query": query},
+            cost=BULK_MUTATION_COST,
+            priority=Priority.BULK,
+        )
+        result = data["bulkOperationRunQuery"]
+        if result["userErrors"]:
+            raise GraphQLError("; ".join(error["message"] for error in result["userErrors"]))
+        return result["bulkOperation"]["id"]
+
+    async def poll(self, shop_api_key: str, shop_domain_name: str, export: BulkExport) -> dict:
+        while True:
+            data = await graphql_request(
+                shop_api_key, shop_domain_name, BULK_STATUS_QUERY, {"id": export.operation_id}, priority=Priority.BULK
+            )
+            operation = data["node"]
+            export.status = operation["status"]
+            export.object_count = int(operation.get("objectCount") or 0)
+            if export.status in FINISHED_STATUSES:
+                return operation
+            await asyncio.sleep(BULK_POLL_INTERVAL)
+
+    async def iter_lines(self, shop_domain_name: str, url: str | None):
+        # An operation that matched nothing has no result file
+        if not url:
+            return
+        # The result file can be gigabytes; read it a line at a time
+        async with get_client(shop_domain_name).stream("GET", url) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.strip():
+                    yield line
+
+    async def store(self, export: BulkExport, records: list[dict]):
+        if export.resource == "order":
+            await mirror.upsert_orders(export.shop, records)
+        else:
+            await mirror.upsert_customers(export.shop, records)
+
+    async def _run(self, shop_api_key: str, export: BulkExport):
+        # Exports run for minutes, long past the deadline of the request that started them
+        detach()
+        model = RESOURCE_MODELS[export.resource]
+        export.started_at = time.time()
+        writer = None
+        try:
+            export.operation_id = await self.submit(
+                shop_api_key, export.shop, bulk_query(export.resource, export.search_query)
+            )
+            operation = await self.poll(shop_api_key, export.shop, export)
+            if export.status != "COMPLETED":
+                raise GraphQLError(f"Bulk operation {export.status.lower()}: {operation.get('errorCode')}")
+
+            os.makedirs(self.directory, exist_ok=True)
+            export.path = os.path.join(self.directory, f"{export.shop}-{export.resource}s-{export.id}.columns.jsonl.gz")
+            writer = ColumnarWriter(export.path, export.resource, list(model.__fields__))
+            watermark, batch = None, []
+            export.status = "IMPORTING"
+            async for line in self.iter_lines(export.shop, operation.get("url")):
+                try:
+                    record = convert_node(export.resource, json.loads(line), None)
+                    model.parse_obj(record)
+                except (ValueError, TypeError):
+                    # Malformed lines, pydantic ValidationErrors included, are counted and skipped
+                    export.invalid += 1
+                    continue
+                writer.append(record)
+                export.records += 1
+                watermark = max(watermark or 0, timestamp(record.get("updated_at")) or 0)
+                if writer.full:
+                    await asyncio.to_thread(writer.flush)
+                # Without the mirror the file is the only copy: a full history would just
+                # churn through the response cache, which is sized for chat lookups
+                if mirror.enabled:
+                    batch.append(record)
+                    if len(batch) >= BULK_WRITE_BATCH:
+                        await self.store(export, batch)
+                        batch = []
+            if batch:
+                await self.store(export, batch)
+            await asyncio.to_thread(writer.close)
+            writer = None
+            export.status = "COMPLETED"
+
+            if mirror.enabled and not export.search_query:
+                # A full history export is as good as a mirror backfill
+                await mirror.mark_synced(export.shop, f"{export.resource}s", watermark, export.started_at)
+        except asyncio.CancelledError:
+            export.status = "CANCELED"
+            raise
+        except Exception as e:
+            print("Bulk export error:", e)
+            export.status = "FAILED"
+            export.error = str(e)
+        finally:
+            if writer is not None:
+                writer.close()
+            export.finished_at = time.time()
+            self._tasks.pop(export.id, None)
+
+    def evict_expired(self):
+        for export in [export for export in self.exports.values() if export.expired]:
+            del self.exports[export.id]
+
+    def start(self, shop_api_key: str, shop_domain_name: str, resource: str, search_query: str = None) -> BulkExport:
+        self.evict_expired()
+        export = BulkExport(id=uuid.uuid4().hex, shop=shop_domain_name, resource=resource, search_query=search_query)
+        self.exports[export.id] = export
+        self._tasks[export.id] = asyncio.create_task(self._run(shop_api_key, export))
+        return export
+
+    def get(self, export_id: str) -> BulkExport | None:
+        self.evict_expired()
+        return self.exports.get(export_id)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+bulk_exporter = BulkExporter()
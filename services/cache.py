@@ -0,0 +1,472 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from models.models import Customer, Order
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_REDIS_POOL_SIZE = int(os.getenv("CACHE_REDIS_POOL_SIZE", 10))
+CACHE_KEY_PREFIX = os.getenv("CACHE_KEY_PREFIX", "shopify-plugin")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 10000))
+CACHE_TTLS = {
+    "order": float(os.getenv("CACHE_ORDER_TTL", 60)),
+    "customer": float(os.getenv("CACHE_CUSTOMER_TTL", 300)),
+    "count": float(os.getenv("CACHE_COUNT_TTL", 60)),
+}
+CACHE_DEFAULT_TTL = float(os.getenv("CACHE_DEFAULT_TTL", 60))
+# How long one worker may hold a refresh lock before others stop waiting on it
+CACHE_LOCK_TIMEOUT = float(os.getenv("CACHE_LOCK_TIMEOUT", 5))
+CACHE_LOCK_POLL_INTERVAL = 0.05
+# Payloads above this many bytes are zlib compressed before going over the network
+CACHE_COMPRESS_MIN_SIZE = 1024
+# Shopify bodies kept to answer conditional GETs with, per process
+SHOPIFY_ETAG_CACHE_BYTES = int(os.getenv("SHOPIFY_ETAG_CACHE_BYTES", 32 * 1024 * 1024))
+# Compare and delete in one step, so a lock that expired and was taken by another worker survives
+DELETE_IF_SCRIPT = 'if redis.call("GET", KEYS[1]) == ARGV[1] then return redis.call("DEL", KEYS[1]) end return 0'
+
+RESOURCE_MODELS = {
+    "order": Order,
+    "customer": Customer,
+}
+
+
+def parse_fields(fields: str | None) -> frozenset[str] | None:
+    if not fields:
+        return None
+    return frozenset(field.strip() for field in fields.split(",") if field.strip())
+
+
+def project_fields(data: dict, fields: frozenset[str] | None) -> dict:
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key in fields}
+
+
+def covers(cached_fields: frozenset[str] | None, fields: frozenset[str] | None) -> bool:
+    # None means the record was fetched without a fields filter, i.e. in full
+    if cached_fields is None:
+        return True
+    return fields is not None and fields <= cached_fields
+
+
+def compact_record(resource: str, data: dict) -> dict:
+    # Keep only what the response models can return, nested customers included
+    model = RESOURCE_MODELS.get(resource)
+    if model is None:
+        return data
+    record = {key: value for key, value in data.items() if key in model.__fields__}
+    if isinstance(record.get("customer"), dict):
+        record["customer"] = compact_record("customer", record["customer"])
+    return record
+
+
+def encode_value(value) -> bytes:
+    payload = json.dumps(value, separators=(",", ":")).encode()
+    if len(payload) >= CACHE_COMPRESS_MIN_SIZE:
+        return b"z" + zlib.compress(payload)
+    return b"j" + payload
+
+
+def decode_value(payload: bytes):
+    if payload[:1] == b"z":
+        return json.loads(zlib.decompress(payload[1:]))
+    return json.loads(payload[1:])
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    partial_misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    lock_waits: int = 0
+
+    def as_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "partial_misses": self.partial_misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "lock_waits": self.lock_waits,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CacheBackend:
+    async def get(self, key: str):
+        raise NotImplementedError
+
+    async def set(self, key: str, value, ttl: float):
+        raise NotImplementedError
+
+    async def add(self, key: str, value, ttl: float) -> bool:
+        # Set only if the key is missing; returns whether it was set
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def delete_if(self, key: str, value) -> bool:
+        # Delete only while the key still holds value; returns whether it was deleted
+        raise NotImplementedError
+
+    async def delete_prefix(self, prefix: str):
+        raise NotImplementedError
+
+    async def size(self) -> int | None:
+        return None
+
+    async def close(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, stats: CacheStats = None):
+        self.max_entries = max_entries
+        self.stats = stats or CacheStats()
+        self._entries: OrderedDict[str, tuple[float, object]] = OrderedDict()
+
+    def _live(self, key: str):
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.monotonic():
+            del self._entries[key]
+            self.stats.expirations += 1
+            return None
+        return item
+
+    async def get(self, key: str):
+        item = self._live(key)
+        if item is None:
+            return None
+        self._entries.move_to_end(key)
+        return item[1]
+
+    async def set(self, key: str, value, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    async def add(self, key: str, value, ttl: float) -> bool:
+        if self._live(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    async def delete_if(self, key: str, value) -> bool:
+        item = self._live(key)
+        if item is None or item[1] != value:
+            return False
+        del self._entries[key]
+        return True
+
+    async def delete_prefix(self, prefix: str):
+        for key in [key for key in self._entries if key.startswith(prefix)]:
+            del self._entries[key]
+
+    async def size(self) -> int | None:
+        return len(self._entries)
+
+    async def close(self):
+        self._entries.clear()
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, url: str):
+        parsed = urlparse(url)
+        reader, writer = await asyncio.open_connection(parsed.hostname or "localhost", parsed.port or 6379)
+        connection = cls(reader, writer)
+        if parsed.password:
+            if parsed.username:
+                await connection.execute("AUTH", parsed.username, parsed.password)
+            else:
+                await connection.execute("AUTH", parsed.password)
+        db = parsed.path.lstrip("/")
+        if db and db != "0":
+            await connection.execute("SELECT", db)
+        return connection
+
+    async def execute(self, *args):
+        command = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            command.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.writer.write(b"".join(command))
+        await self.writer.drain()
+        return await self._read_reply()
+
+    async def _read_reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b"+":
+            return body.decode()
+        if prefix == b"-":
+            raise RedisError(body.decode())
+        if prefix == b":":
+            return int(body)
+        if prefix == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2]
+        if prefix == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    def close(self):
+        self.writer.close()
+
+
+class RedisCacheBackend(CacheBackend):
+    def __init__(self, url: str = CACHE_REDIS_URL, pool_size: int = CACHE_REDIS_POOL_SIZE):
+        self.url = url
+        self._pool: asyncio.Queue = None
+        self._pool_size = pool_size
+
+    async def _acquire(self) -> RedisConnection:
+        if self._pool is None:
+            self._pool = asyncio.Queue()
+            for _ in range(self._pool_size):
+                self._pool.put_nowait(None)
+        connection = await self._pool.get()
+        if connection is not None:
+            return connection
+        # An empty slot: open a connection for it
+        try:
+            return await RedisConnection.connect(self.url)
+        except Exception:
+            self._pool.put_nowait(None)
+            raise
+
+    async def execute(self, *args):
+        connection = await self._acquire()
+        try:
+            reply = await connection.execute(*args)
+        except RedisError:
+            self._pool.put_nowait(connection)
+            raise
+        except BaseException:
+            # Broken or half-read connection, replace it on next use
+            connection.close()
+            self._pool.put_nowait(None)
+            raise
+        self._pool.put_nowait(connection)
+        return reply
+
+    async def get(self, key: str):
+        payload = await self.execute("GET", key)
+        return decode_value(payload) if payload is not None else None
+
+    async def set(self, key: str, value, ttl: float):
+        await self.execute("SET", key, encode_value(value), "PX", max(1, int(ttl * 1000)))
+
+    async def add(self, key: str, value, ttl: float) -> bool:
+        reply = await self.execute("SET", key, encode_value(value), "PX", max(1, int(ttl * 1000)), "NX")
+        return reply is not None
+
+    async def delete(self, key: str):
+        await self.execute("DEL", key)
+
+    async def delete_if(self, key: str, value) -> bool:
+        return await self.execute("EVAL", DELETE_IF_SCRIPT, 1, key, encode_value(value)) == 1
+
+    async def delete_prefix(self, prefix: str):
+        cursor = b"0"
+        while True:
+            cursor, keys = await self.execute("SCAN", cursor, "MATCH", prefix + "*", "COUNT", 500)
+            if keys:
+                await self.execute("DEL", *keys)
+            if cursor == b"0":
+                return
+
+    async def close(self):
+        while self._pool is not None and not self._pool.empty():
+            connection = self._pool.get_nowait()
+            if connection is not None:
+                connection.close()
+        self._pool = None
+
+
+class RefreshLock:
+    def __init__(self):
+        self.record: dict | None = None
+
+
+class ResponseCache:
+    def __init__(self, backend: CacheBackend, ttls: dict[str, float] = CACHE_TTLS, prefix: str = CACHE_KEY_PREFIX):
+        self.backend = backend
+        self.ttls = ttls
+        self.prefix = prefix
+        self.stats = getattr(backend, "stats", None) or CacheStats()
+
+    def _key(self, shop: str, resource: str, resource_id) -> str:
+        return f"{self.prefix}:{shop}:{resource}:{resource_id}"
+
+    async def _entry(self, shop: str, resource: str, resource_id) -> dict | None:
+        return await self.backend.get(self._key(shop, resource, resource_id))
+
+    async def peek(self, shop: str, resource: str, resource_id, fields: str | None = None) -> dict | None:
+        requested = parse_fields(fields)
+        entry = await self._entry(shop, resource, resource_id)
+        if entry is None or not covers(parse_fields(entry["fields"]), requested):
+            return None
+        return project_fields(entry["data"], requested)
+
+    async def peek_partial(self, shop: str, resource: str, resource_id, fields: str | None = None) -> dict | None:
+        # Whichever of the requested fields are cached, for when there's no time to fetch the rest
+        entry = await self._entry(shop, resource, resource_id)
+        if entry is None:
+            return None
+        return project_fields(entry["data"], parse_fields(fields))
+
+    async def get(self, shop: str, resource: str, resource_id, fields: str | None = None) -> dict | None:
+        requested = parse_fields(fields)
+        entry = await self._entry(shop, resource, resource_id)
+        if entry is None or not covers(parse_fields(entry["fields"]), requested):
+            self.stats.misses += 1
+            if entry is not None:
+                self.stats.partial_misses += 1
+            return None
+        self.stats.hits += 1
+        return project_fields(entry["data"], requested)
+
+    async def fetch_fields(self, shop: str, resource: str, resource_id, fields: str | None = None) -> str | None:
+        # Widen a fetch to include what's already cached, so the new entry
+        # still serves every field set the old one did
+        requested = parse_fields(fields)
+        entry = await self._entry(shop, resource, resource_id)
+        if requested is None or entry is None:
+            return fields
+        if entry["fields"] is None:
+            return None
+        return ",".join(sorted(requested | parse_fields(entry["fields"])))
+
+    async def set(self, shop: str, resource: str, resource_id, fields: str | None, data: dict, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttls.get(resource, CACHE_DEFAULT_TTL)
+        entry = {"fields": fields, "data": compact_record(resource, data)}
+        await self.backend.set(self._key(shop, resource, resource_id), entry, ttl)
+
+    async def delete(self, shop: str, resource: str, resource_id):
+        await self.backend.delete(self._key(shop, resource, resource_id))
+
+    async def clear_shop(self, shop: str):
+        await self.backend.delete_prefix(f"{self.prefix}:{shop}:")
+
+    @asynccontextmanager
+    async def refresh(self, shop: str, resource: str, resource_id, fields: str | None = None):
+        # Only one worker refreshes a missing key; the others wait for its result
+        lock_key = self._key(shop, resource, resource_id) + ":lock"
+        token = uuid.uuid4().hex
+        lock = RefreshLock()
+        deadline = time.monotonic() + CACHE_LOCK_TIMEOUT
+        held = await self.backend.add(lock_key, token, CACHE_LOCK_TIMEOUT)
+        if not held:
+            self.stats.lock_waits += 1
+        while not held and time.monotonic() < deadline:
+            await asyncio.sleep(CACHE_LOCK_POLL_INTERVAL)
+            lock.record = await self.peek(shop, resource, resource_id, fields)
+            if lock.record is not None:
+                break
+            held = await self.backend.add(lock_key, token, CACHE_LOCK_TIMEOUT)
+        try:
+            yield lock
+        finally:
+            # The lock may have timed out and been taken by another worker meanwhile
+            if held:
+                await self.backend.delete_if(lock_key, token)
+
+    async def stats_dict(self) -> dict:
+        return {"backend": type(self.backend).__name__, "entries": await self.backend.size(), **self.stats.as_dict()}
+
+    async def close(self):
+        await self.backend.close()
+
+
+def create_cache_backend(name: str = CACHE_BACKEND) -> CacheBackend:
+    if name == "redis":
+        return RedisCacheBackend()
+    if name == "memory":
+        return MemoryCacheBackend()
+    raise ValueError(f"Unknown cache backend: {name}")
+
+
+response_cache = ResponseCache(create_cache_backend())
+
+
+@dataclass
+class ETagEntry:
+    etag: str
+    body: bytes
+    headers: dict
+
+
+class ETagCache:
+    # The last body Shopify sent for each GET endpoint, with its ETag, so a
+    # repeat request can go out with If-None-Match and a 304 reuses the body.
+    # Bounded by total body size rather than entry count, since pages vary a lot
+    def __init__(self, max_bytes: int = SHOPIFY_ETAG_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[tuple[str, str], ETagEntry] = OrderedDict()
+
+    def get(self, shop: str, endpoint: str) -> ETagEntry | None:
+        entry = self._entries.get((shop, endpoint))
+        if entry is not None:
+            self._entries.move_to_end((shop, endpoint))
+        return entry
+
+    def set(self, shop: str, endpoint: str, entry: ETagEntry):
+        if len(entry.body) > self.max_bytes:
+            return
+        self.delete(shop, endpoint)
+        self._entries[(shop, endpoint)] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.body)
+
+    def delete(self, shop: str, endpoint: str):
+        entry = self._entries.pop((shop, endpoint), None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    def clear_shop(self, shop: str):
+        for key in [key for key in self._entries if key[0] == shop]:
+            self.delete(*key)
+
+
+etag_cache = ETagCache()
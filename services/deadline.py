@@ -0,0 +1,185 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+# ChatGPT abandons a plugin call after about 45 seconds; answer well before that
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", 30))
+# Time held back from Shopify calls so a handler can still answer from cached data
+DEADLINE_FALLBACK_MARGIN = float(os.getenv("DEADLINE_FALLBACK_MARGIN", 1.5))
+# Send a duplicate of a slow GET once it has taken longer than this percentile of recent ones
+SHOPIFY_HEDGE_ENABLED = os.getenv("SHOPIFY_HEDGE_ENABLED", "true").lower() == "true"
+SHOPIFY_HEDGE_PERCENTILE = float(os.getenv("SHOPIFY_HEDGE_PERCENTILE", 95))
+SHOPIFY_HEDGE_MIN_DELAY = float(os.getenv("SHOPIFY_HEDGE_MIN_DELAY", 0.1))
+# At most this share of calls is duplicated, so a general slowdown can't double the load
+SHOPIFY_HEDGE_BUDGET = float(os.getenv("SHOPIFY_HEDGE_BUDGET", 0.1))
+HEDGE_BURST = 10
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+# Recompute the percentile after this many new samples rather than on every call
+HEDGE_REFRESH = 10
+
+# The response header naming the fallback a handler used, e.g. "stale" or "partial"
+FALLBACK_HEADER = "X-Data-Fallback"
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+@dataclass
+class RequestDeadline:
+    expires_at: float
+    fallback: str = None
+
+
+_deadline: ContextVar[RequestDeadline | None] = ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(seconds: float):
+    # Tasks started inside the scope copy the context, and with it the deadline
+    current = _deadline.get()
+    expires_at = time.monotonic() + seconds
+    if current is not None:
+        expires_at = min(expires_at, current.expires_at)
+    state = RequestDeadline(expires_at)
+    token = _deadline.set(state)
+    try:
+        yield state
+    finally:
+        _deadline.reset(token)
+
+
+def detach():
+    # For background work started from a request, which must outlive its deadline
+    _deadline.set(None)
+
+
+def remaining() -> float | None:
+    state = _deadline.get()
+    return None if state is None else state.expires_at - time.monotonic()
+
+
+def upstream_remaining() -> float | None:
+    left = remaining()
+    return None if left is None else left - DEADLINE_FALLBACK_MARGIN
+
+
+def mark_fallback(kind: str):
+    state = _deadline.get()
+    if state is not None and state.fallback != "partial":
+        state.fallback = kind
+
+
+async def within_deadline(awaitable):
+    left = upstream_remaining()
+    if left is None:
+        return await awaitable
+    if left <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded("Request deadline exceeded")
+    try:
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded("Request deadline exceeded") from None
+
+
+async def sleep(seconds: float):
+    # A backoff that would outlast the deadline fails now instead of after the wait
+    left = upstream_remaining()
+    if left is not None and seconds >= left:
+        raise DeadlineExceeded("Request deadline exceeded")
+    await asyncio.sleep(seconds)
+
+
+async def with_fallback(primary, fallback, kind: str = "stale"):
+    # primary and fallback are zero-argument coroutine functions; a fallback
+    # returning None means there's nothing to fall back on
+    try:
+        return await primary()
+    except DeadlineExceeded:
+        data = await fallback()
+        if data is None:
+            raise
+        mark_fallback(kind)
+        return data
+
+
+class LatencyWindow:
+    def __init__(self, size: int = HEDGE_WINDOW):
+        self.samples = deque(maxlen=size)
+        self.hedge_tokens = 0.0
+        self._threshold: float | None = None
+        self._unsorted = 0
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self._unsorted += 1
+
+    def allow_hedge(self) -> bool:
+        if self.hedge_tokens < 1:
+            return False
+        self.hedge_tokens -= 1
+        return True
+
+    def threshold(self) -> float | None:
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        if self._threshold is None or self._unsorted >= HEDGE_REFRESH:
+            ordered = sorted(self.samples)
+            rank = max(1, round(SHOPIFY_HEDGE_PERCENTILE / 100 * len(ordered)))
+            self._threshold = max(SHOPIFY_HEDGE_MIN_DELAY, ordered[rank - 1])
+            self._unsorted = 0
+        return self._threshold
+
+
+_latencies: dict[str, LatencyWindow] = {}
+
+
+def latency_window(endpoint: str) -> LatencyWindow:
+    window = _latencies.get(endpoint)
+    if window is None:
+        window = _latencies[endpoint] = LatencyWindow()
+    return window
+
+
+async def hedged(send, endpoint: str, try_acquire, release, on_hedge=None):
+    # send starts one attempt; try_acquire/release take and return spare rate
+    # limit budget for the duplicate, which is only sent when there is some
+    window = latency_window(endpoint)
+    threshold = window.threshold() if SHOPIFY_HEDGE_ENABLED else None
+    # Every call earns a fraction of a hedge; HEDGE_BURST caps how many can be saved up
+    window.hedge_tokens = min(HEDGE_BURST, window.hedge_tokens + SHOPIFY_HEDGE_BUDGET)
+    started = time.perf_counter()
+    first = asyncio.ensure_future(send())
+    attempts = {first}
+    hedge = None
+    try:
+        if threshold is not None:
+            done, _ = await asyncio.wait(attempts, timeout=threshold)
+            if not done and window.allow_hedge() and try_acquire():
+                hedge = asyncio.ensure_future(send())
+                attempts.add(hedge)
+                if on_hedge is not None:
+                    on_hedge()
+        while True:
+            done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+            # Keep the first success; a failure only counts once nothing else is left
+            winner = next((task for task in done if task.exception() is None), None)
+            if winner is not None:
+                window.observe(time.perf_counter() - started)
+                return winner.result()
+            if not attempts:
+                return done.pop().result()
+    finally:
+        for task in attempts:
+            task.cancel()
+            # Nobody awaits the loser; retrieve its outcome so it isn't logged as lost
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        if hedge is not None:
+            release()
@@ -0,0 +1,58 @@
+import os
+import httpx
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Connection pool settings, shared by every shop domain's client
+SHOPIFY_HTTP_TIMEOUT = float(os.getenv("SHOPIFY_HTTP_TIMEOUT", 10))
+SHOPIFY_HTTP_CONNECT_TIMEOUT = float(os.getenv("SHOPIFY_HTTP_CONNECT_TIMEOUT", 5))
+SHOPIFY_HTTP_MAX_CONNECTIONS = int(os.getenv("SHOPIFY_HTTP_MAX_CONNECTIONS", 20))
+SHOPIFY_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("SHOPIFY_HTTP_MAX_KEEPALIVE_CONNECTIONS", 10))
+SHOPIFY_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("SHOPIFY_HTTP_KEEPALIVE_EXPIRY", 30))
+SHOPIFY_HTTP2 = os.getenv("SHOPIFY_HTTP2", "true").lower() == "true" and HTTP2_AVAILABLE
+# Send every shop's traffic to this base url instead, e.g. a local mock server
+SHOPIFY_BASE_URL = os.getenv("SHOPIFY_BASE_URL")
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def shop_base_url(shop_domain_name: str) -> str:
+    if SHOPIFY_BASE_URL:
+        return SHOPIFY_BASE_URL.rstrip("/")
+    return f"https://{shop_domain_name}"
+
+
+def create_client(shop_domain_name: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=shop_base_url(shop_domain_name),
+        http2=SHOPIFY_HTTP2,
+        timeout=httpx.Timeout(SHOPIFY_HTTP_TIMEOUT, connect=SHOPIFY_HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=SHOPIFY_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=SHOPIFY_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=SHOPIFY_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def get_client(shop_domain_name: str) -> httpx.AsyncClient:
+    client = _clients.get(shop_domain_name)
+    if client is None or client.is_closed:
+        client = create_client(shop_domain_name)
+        _clients[shop_domain_name] = client
+    return client
+
+
+async def close_client(shop_domain_name: str):
+    client = _clients.pop(shop_domain_name, None)
+    if client is not None:
+        await client.aclose()
+
+
+async def close_clients():
+    for shop_domain_name in list(_clients):
+        await close_client(shop_domain_name)
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from models.shopify_api import CustomerSearchUrlParams, OrderUrlParams
+from services.cache import parse_fields
+from services.shopify import DEFAULT_CUSTOMER_FIELDS, DEFAULT_ORDER_FIELDS, iter_shop_customers, iter_shop_orders
+
+# Jobs are for listings too slow to answer within a plugin call; they page through Shopify in the background
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 100))
+# Finished jobs, and their results, are dropped this long after they finish
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", 900))
+JOB_MAX_RECORDS = int(os.getenv("JOB_MAX_RECORDS", 10000))
+JOB_PAGE_SIZE = 250
+
+# Jobs default to the same narrow fields as the endpoints they stand in for
+JOB_RESOURCES = {
+    "orders": (OrderUrlParams, iter_shop_orders, DEFAULT_ORDER_FIELDS),
+    "customers": (CustomerSearchUrlParams, iter_shop_customers, DEFAULT_CUSTOMER_FIELDS),
+}
+FINISHED_STATUSES = {"COMPLETED", "FAILED", "CANCELED"}
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def normalize_params(resource: str, params: dict):
+    # Spellings of the same query (field order, omitted defaults, a different
+    # page size) parse to the same filters and so to the same dedupe key
+    if resource not in JOB_RESOURCES:
+        raise ValueError(f"resource must be one of: {', '.join(JOB_RESOURCES)}")
+    model, _, default_fields = JOB_RESOURCES[resource]
+    filters = model.parse_obj({**params, "fields": params.get("fields") or default_fields})
+    fields = parse_fields(filters.fields)
+    filters = filters.copy(update={
+        "fields": ",".join(sorted(fields)) if fields else None,
+        "limit": JOB_PAGE_SIZE,
+    })
+    return filters, json.dumps(filters.dict(), sort_keys=True, default=str)
+
+
+@dataclass
+class Job:
+    id: str
+    shop: str
+    resource: str
+    key: str
+    filters: object
+    max_records: int = JOB_MAX_RECORDS
+    status: str = "QUEUED"
+    records: list = field(default_factory=list)
+    truncated: bool = False
+    error: str = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float = None
+    finished_at: float = None
+
+    @property
+    def expired(self) -> bool:
+        return self.finished_at is not None and time.time() - self.finished_at > JOB_RESULT_TTL
+
+    def as_dict(self, offset: int = 0, limit: int = None) -> dict:
+        data = {
+            "id": self.id,
+            "resource": self.resource,
+            "status": self.status,
+            "params": self.filters.dict(exclude_none=True),
+            "records_fetched": len(self.records),
+            "max_records": self.max_records,
+            "truncated": self.truncated,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "expires_at": None if self.finished_at is None else self.finished_at + JOB_RESULT_TTL,
+        }
+        if limit is not None:
+            # Results are readable while the job runs; next_offset is None once
+            # the job has finished and there's nothing past this page
+            page = self.records[offset:offset + limit]
+            more = offset + len(page) < len(self.records) or self.status not in FINISHED_STATUSES
+            data["offset"] = offset
+            data["next_offset"] = offset + len(page) if more else None
+            data[self.resource] = page
+        return data
+
+
+@dataclass
+class JobStats:
+    submitted: int = 0
+    deduplicated: int = 0
+    rejected: int = 0
+    completed: int = 0
+    failed: int = 0
+    evicted: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "evicted": self.evicted,
+        }
+
+
+class JobRunner:
+    def __init__(self, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE):
+        self.workers = workers
+        self.jobs: dict[str, Job] = {}
+        self.stats = JobStats()
+        self._by_key: dict[tuple[str, str, str], str] = {}
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._workers: list[asyncio.Task] = []
+
+    def evict_expired(self):
+        for job in [job for job in self.jobs.values() if job.expired]:
+            del self.jobs[job.id]
+            if self._by_key.get((job.shop, job.resource, job.key)) == job.id:
+                del self._by_key[(job.shop, job.resource, job.key)]
+            self.stats.evicted += 1
+
+    def submit(self, shop_api_key: str, shop_domain_name: str, resource: str, params: dict, max_records: int = None) -> tuple[Job, bool]:
+        # Returns the job and whether it is one already submitted with the same params
+        filters, key = normalize_params(resource, params)
+        if max_records is not None and max_records < 1:
+            raise ValueError("max_records must be at least 1")
+        max_records = min(max_records or JOB_MAX_RECORDS, JOB_MAX_RECORDS)
+        self.evict_expired()
+        existing = self.jobs.get(self._by_key.get((shop_domain_name, resource, key)))
+        # A failed job is retried rather than handed back
+        if existing is not None and existing.status not in ("FAILED", "CANCELED") and existing.max_records >= max_records:
+            self.stats.deduplicated += 1
+            return existing, True
+
+        job = Job(id=uuid.uuid4().hex, shop=shop_domain_name, resource=resource, key=key, filters=filters, max_records=max_records)
+        try:
+            self._queue.put_nowait((shop_api_key, job))
+        except asyncio.QueueFull:
+            self.stats.rejected += 1
+            raise JobQueueFull("Too many jobs are waiting; try again later") from None
+        self.jobs[job.id] = job
+        self._by_key[(shop_domain_name, resource, key)] = job.id
+        self.stats.submitted += 1
+        return job, False
+
+    def get(self, job_id: str) -> Job | None:
+        self.evict_expired()
+        return self.jobs.get(job_id)
+
+    async def run(self, shop_api_key: str, job: Job):
+        _, iterate, _ = JOB_RESOURCES[job.resource]
+        job.status = "RUNNING"
+        job.started_at = time.time()
+        records = iterate(shop_api_key, job.shop, job.filters)
+        try:
+            async for record in records:
+                # Dropped along with its shop; see stop_shop
+                if job.id not in self.jobs:
+                    job.status = "CANCELED"
+                    return
+                if len(job.records) >= job.max_records:
+                    job.truncated = True
+                    break
+                job.records.append(record)
+            job.status = "COMPLETED"
+            self.stats.completed += 1
+        except asyncio.CancelledError:
+            job.status = "CANCELED"
+            raise
+        except Exception as e:
+            print("Job error:", e)
+            job.status = "FAILED"
+            job.error = str(e)
+            self.stats.failed += 1
+        finally:
+            # Closing the listing cancels the page it was prefetching
+            await records.aclose()
+            job.finished_at = time.time()
+
+    async def _run(self):
+        while True:
+            shop_api_key, job = await self._queue.get()
+            try:
+                # Shops removed while a job waited (e.g. evicted tenants) leave nothing to run
+                if job.id in self.jobs:
+                    await self.run(shop_api_key, job)
+            finally:
+                self._queue.task_done()
+
+    def start(self):
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while len(self._workers) < self.workers:
+            self._workers.append(asyncio.create_task(self._run()))
+
+    async def stop_shop(self, shop: str):
+        # Queued jobs are skipped and running ones stop at their next record
+        for job in [job for job in self.jobs.values() if job.shop == shop]:
+            del self.jobs[job.id]
+            self._by_key.pop((job.shop, job.resource, job.key), None)
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats_dict(self) -> dict:
+        statuses = {}
+        for job in self.jobs.values():
+            statuses[job.status.lower()] = statuses.get(job.status.lower(), 0) + 1
+        return {**self.stats.as_dict(), "queued": self._queue.qsize(), "jobs": statuses}
+
+
+job_runner = JobRunner()
@@ -0,0 +1,232 @@
+import os
+import re
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager, nullcontext
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Emit spans through OpenTelemetry when it's installed and configured
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+API_PATH = re.compile(r"^/admin/api/[^/]+/")
+NUMERIC_SEGMENT = re.compile(r"(?<=/)\d+(?=[/.])")
+
+
+def endpoint_template(endpoint: str) -> str:
+    # /admin/api/2022-10/orders/450789469.json?fields=id -> orders/{id}.json
+    path = API_PATH.sub("", endpoint.split("?", 1)[0])
+    return NUMERIC_SEGMENT.sub("{id}", "/" + path)[1:]
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if METRICS_ENABLED:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels):
+        # For counters kept elsewhere and copied in at scrape time
+        if METRICS_ENABLED:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, format_labels(self.labels, key), value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        if METRICS_ENABLED:
+            self._values[self._key(labels)] = value
+
+    def remove(self, **labels):
+        self._values.pop(self._key(labels), None)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, format_labels(self.labels, key), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            # Per-bucket counts, then sum and count
+            series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", format_labels(self.labels, key, f'le="{format_value(bound)}"'), cumulative
+            yield f"{self.name}_bucket", format_labels(self.labels, key, 'le="+Inf"'), count
+            yield f"{self.name}_sum", format_labels(self.labels, key), total
+            yield f"{self.name}_count", format_labels(self.labels, key), count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+        self.collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        # Called before each scrape, to copy in values kept elsewhere (e.g. cache stats)
+        self.collectors.append(collector)
+
+    async def render(self) -> str:
+        for collector in self.collectors:
+            await collector()
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "End-to-end handler latency", ("method", "route", "status"),
+))
+shopify_request_duration = registry.register(Histogram(
+    "shopify_request_duration_seconds", "Latency of each call to Shopify", ("method", "endpoint", "status"),
+))
+shopify_retries = registry.register(Counter(
+    "shopify_retries_total", "Shopify calls retried", ("endpoint", "reason"),
+))
+shopify_not_modified = registry.register(Counter(
+    "shopify_not_modified_total", "Shopify GETs answered 304 and served from the ETag cache", ("endpoint",),
+))
+shopify_hedges = registry.register(Counter(
+    "shopify_hedges_total", "Duplicate Shopify GETs sent for slow calls", ("endpoint",),
+))
+prefetch_records = registry.register(Counter(
+    "prefetch_records_total", "Records fetched ahead of a predicted lookup, and whether it came", ("resource", "outcome"),
+))
+prefetch_calls = registry.register(Counter(
+    "prefetch_calls_total", "Shopify calls spent prefetching; wasted when none of their records was looked up", ("outcome",),
+))
+prefetch_suppressed = registry.register(Counter(
+    "prefetch_suppressed_total", "Prefetches skipped for lack of spare call budget, or because one was running", ("reason",),
+))
+json_decode_duration = registry.register(Histogram(
+    "json_decode_duration_seconds", "Time spent decoding Shopify responses", ("endpoint",), FAST_BUCKETS,
+))
+serialization_duration = registry.register(Histogram(
+    "response_serialization_duration_seconds", "Time spent serializing API responses", ("model",), FAST_BUCKETS,
+))
+call_limit_headroom = registry.register(Gauge(
+    "shopify_call_limit_headroom", "Calls left in the REST bucket, from X-Shopify-Shop-Api-Call-Limit", ("shop",),
+))
+graphql_cost_available = registry.register(Gauge(
+    "shopify_graphql_cost_available", "Query cost points left in the GraphQL bucket", ("shop",),
+))
+cache_lookups = registry.register(Counter(
+    "cache_lookups_total", "Response cache lookups", ("result",),
+))
+cache_hit_ratio = registry.register(Gauge(
+    "cache_hit_ratio", "Share of response cache lookups served from the cache",
+))
+
+
+_span_hooks = []
+NO_SPAN = nullcontext()
+
+
+def add_span_hook(hook):
+    # A hook takes (name, attributes) and returns a context manager around the span
+    _span_hooks.append(hook)
+
+
+def span(name: str, **attributes):
+    if not _span_hooks:
+        # Shared no-op context; tracing costs one list check when disabled
+        return NO_SPAN
+    return _spans(name, attributes)
+
+
+@contextmanager
+def _spans(name: str, attributes: dict):
+    with ExitStack() as stack:
+        for hook in _span_hooks:
+            stack.enter_context(hook(name, attributes))
+        yield
+
+
+def opentelemetry_hook(name: str, attributes: dict):
+    return trace.get_tracer("shopify-plugin").start_as_current_span(name, attributes=attributes)
+
+
+if TRACING_ENABLED and trace is not None:
+    add_span_hook(opentelemetry_hook)
@@ -0,0 +1,422 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from models.shopify_api import (
+    CustomerCountUrlParams,
+    CustomerUrlParams,
+    FulfillmentStatus,
+    OrderCountUrlParams,
+    OrderUrlParams,
+)
+from services.cache import parse_fields, project_fields
+from services.deadline import detach
+from services.shopify import iter_shop_customers_list, iter_shop_orders
+
+MIRROR_ENABLED = os.getenv("MIRROR_ENABLED", "false").lower() == "true"
+MIRROR_DATABASE_PATH = os.getenv("MIRROR_DATABASE_PATH", "mirror.db")
+MIRROR_SYNC_INTERVAL = float(os.getenv("MIRROR_SYNC_INTERVAL", 60))
+# Queries fall back to Shopify once the last completed sync is older than this
+MIRROR_MAX_STALENESS = float(os.getenv("MIRROR_MAX_STALENESS", 300))
+MIRROR_PAGE_SIZE = 250
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    shop TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    created_at REAL,
+    updated_at REAL,
+    processed_at REAL,
+    financial_status TEXT,
+    fulfillment_status TEXT,
+    status TEXT,
+    customer_id INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (shop, id)
+);
+CREATE INDEX IF NOT EXISTS orders_created_at ON orders (shop, created_at);
+CREATE INDEX IF NOT EXISTS orders_updated_at ON orders (shop, updated_at);
+CREATE INDEX IF NOT EXISTS orders_financial_status ON orders (shop, financial_status);
+CREATE INDEX IF NOT EXISTS orders_fulfillment_status ON orders (shop, fulfillment_status);
+CREATE INDEX IF NOT EXISTS orders_status ON orders (shop, status);
+CREATE INDEX IF NOT EXISTS orders_customer_id ON orders (shop, customer_id);
+
+CREATE TABLE IF NOT EXISTS customers (
+    shop TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    created_at REAL,
+    updated_at REAL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (shop, id)
+);
+CREATE INDEX IF NOT EXISTS customers_created_at ON customers (shop, created_at);
+CREATE INDEX IF NOT EXISTS customers_updated_at ON customers (shop, updated_at);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    shop TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    watermark REAL,
+    synced_at REAL,
+    PRIMARY KEY (shop, resource)
+);
+"""
+
+# Shopify's financial_status filter values that match more than one status
+FINANCIAL_STATUS_MATCHES = {
+    "unpaid": ("authorized", "partially_paid"),
+}
+
+
+def timestamp(value) -> float | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def order_status(order: dict) -> str:
+    if order.get("cancelled_at"):
+        return "cancelled"
+    if order.get("closed_at"):
+        return "closed"
+    return "open"
+
+
+def range_conditions(filters, columns: list[str]) -> tuple[list[str], list]:
+    conditions, params = [], []
+    for column in columns:
+        minimum = getattr(filters, f"{column}_min", None)
+        maximum = getattr(filters, f"{column}_max", None)
+        if minimum:
+            conditions.append(f"{column} >= ?")
+            params.append(timestamp(minimum))
+        if maximum:
+            conditions.append(f"{column} <= ?")
+            params.append(timestamp(maximum))
+    return conditions, params
+
+
+def order_conditions(filters: OrderUrlParams | OrderCountUrlParams) -> tuple[list[str], list]:
+    conditions, params = range_conditions(filters, ["created_at", "updated_at", "processed_at"])
+
+    financial_status = filters.financial_status.value if filters.financial_status else "any"
+    if financial_status != "any":
+        matches = FINANCIAL_STATUS_MATCHES.get(financial_status, (financial_status,))
+        conditions.append(f"financial_status IN ({','.join('?' * len(matches))})")
+        params.extend(matches)
+
+    fulfillment_status = filters.fulfillment_status.value if filters.fulfillment_status else "any"
+    if fulfillment_status == FulfillmentStatus.shipped:
+        conditions.append("fulfillment_status = 'fulfilled'")
+    elif fulfillment_status == FulfillmentStatus.partial:
+        conditions.append("fulfillment_status = 'partial'")
+    elif fulfillment_status == FulfillmentStatus.unshipped:
+        conditions.append("fulfillment_status IS NULL")
+    elif fulfillment_status == FulfillmentStatus.unfulfilled:
+        conditions.append("(fulfillment_status IS NULL OR fulfillment_status = 'partial')")
+
+    status = filters.status.value if filters.status else "any"
+    if status == "open":
+        conditions.append("status = 'open'")
+    elif status == "closed":
+        # Cancelled orders are often closed too, which the status column doesn't record
+        conditions.append("json_extract(data, '$.closed_at') IS NOT NULL")
+    elif status == "cancelled":
+        conditions.append("status = 'cancelled'")
+
+    return conditions, params
+
+
+def where_clause(shop: str, conditions: list[str], params: list) -> tuple[str, list]:
+    return " AND ".join(["shop = ?"] + conditions), [shop] + params
+
+
+class Mirror:
+    def __init__(self, path: str = MIRROR_DATABASE_PATH, enabled: bool = MIRROR_ENABLED):
+        self.path = path
+        self.enabled = enabled
+        self._connection: sqlite3.Connection = None
+        self._lock = threading.Lock()
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._customer_hooks = []
+        self._customer_delete_hooks = []
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def _execute(self, sql: str, params=()) -> list:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _execute_many(self, sql: str, rows: list):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(sql, rows)
+
+    async def run(self, fn, *args):
+        return await asyncio.to_thread(fn, *args)
+
+    def _upsert_orders(self, shop: str, orders: list[dict]):
+        self._execute_many(
+            "INSERT OR REPLACE INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    shop,
+                    order["id"],
+                    timestamp(order.get("created_at")),
+                    timestamp(order.get("updated_at")),
+                    timestamp(order.get("processed_at")),
+                    order.get("financial_status"),
+                    order.get("fulfillment_status"),
+                    order_status(order),
+                    (order.get("customer") or {}).get("id"),
+                    json.dumps(order),
+                )
+                for order in orders
+            ],
+        )
+
+    def _upsert_customers(self, shop: str, customers: list[dict]):
+        self._execute_many(
+            "INSERT OR REPLACE INTO customers VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    shop,
+                    customer["id"],
+                    timestamp(customer.get("created_at")),
+                    timestamp(customer.get("updated_at")),
+                    json.dumps(customer),
+                )
+                for customer in customers
+            ],
+        )
+
+    async def upsert_orders(self, shop: str, orders: list[dict]):
+        await self.run(self._upsert_orders, shop, orders)
+
+    async def upsert_customers(self, shop: str, customers: list[dict]):
+        await self.run(self._upsert_customers, shop, customers)
+        for hook in self._customer_hooks:
+            await hook(shop, customers)
+
+    def add_customer_hook(self, hook):
+        # Awaited with (shop, customers) after every customer upsert, e.g. to keep a search index current
+        self._customer_hooks.append(hook)
+
+    def add_customer_delete_hook(self, hook):
+        # Awaited with (shop, ids) after customers are deleted
+        self._customer_delete_hooks.append(hook)
+
+    def _delete(self, table: str, shop: str, ids: list[int]):
+        self._execute_many(f"DELETE FROM {table} WHERE shop = ? AND id = ?", [(shop, i) for i in ids])
+
+    async def delete_orders(self, shop: str, ids: list[int]):
+        await self.run(self._delete, "orders", shop, ids)
+
+    async def delete_customers(self, shop: str, ids: list[int]):
+        await self.run(self._delete, "customers", shop, ids)
+        for hook in self._customer_delete_hooks:
+            await hook(shop, ids)
+
+    def _sync_state(self, shop: str, resource: str) -> tuple[float | None, float | None]:
+        rows = self._execute(
+            "SELECT watermark, synced_at FROM sync_state WHERE shop = ? AND resource = ?",
+            (shop, resource),
+        )
+        return rows[0] if rows else (None, None)
+
+    def _set_sync_state(self, shop: str, resource: str, watermark: float | None, synced_at: float):
+        self._execute_many(
+            "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)",
+            [(shop, resource, watermark, synced_at)],
+        )
+
+    async def mark_synced(self, shop: str, resource: str, watermark: float | None, synced_at: float):
+        # For backfills done outside the sync loop, e.g. by a bulk export
+        await self.run(self._set_sync_state, shop, resource, watermark, synced_at)
+
+    async def _sync(self, shop: str, resource: str, records, upsert):
+        watermark, _ = await self.run(self._sync_state, shop, resource)
+        started_at = time.time()
+        batch = []
+        async for record in records(watermark):
+            batch.append(record)
+            if len(batch) >= MIRROR_PAGE_SIZE:
+                await upsert(shop, batch)
+                watermark = max([watermark or 0] + [timestamp(r.get("updated_at")) or 0 for r in batch])
+                batch = []
+        if batch:
+            await upsert(shop, batch)
+            watermark = max([watermark or 0] + [timestamp(r.get("updated_at")) or 0 for r in batch])
+        # A record on a page already read can change while later pages are fetched;
+        # its new updated_at is below the newest one seen, so the next sync has to
+        # start no later than this one did to pick it up
+        if watermark is not None:
+            watermark = min(watermark, started_at)
+        await self.run(self._set_sync_state, shop, resource, watermark, started_at)
+
+    async def sync(self, shop_api_key: str, shop_domain_name: str):
+        # The first sync backfills everything; later ones fetch only what
+        # changed since the newest updated_at already mirrored
+        def since(watermark):
+            return datetime.fromtimestamp(watermark, timezone.utc) if watermark else None
+
+        await self._sync(
+            shop_domain_name,
+            "orders",
+            lambda watermark: iter_shop_orders(shop_api_key, shop_domain_name, OrderUrlParams(
+                limit=MIRROR_PAGE_SIZE,
+                status="any",
+                updated_at_min=since(watermark),
+            )),
+            self.upsert_orders,
+        )
+        await self._sync(
+            shop_domain_name,
+            "customers",
+            lambda watermark: iter_shop_customers_list(shop_api_key, shop_domain_name, CustomerUrlParams(
+                limit=MIRROR_PAGE_SIZE,
+                updated_at_min=since(watermark),
+            )),
+            self.upsert_customers,
+        )
+
+    async def is_fresh(self, shop: str, resource: str, max_staleness: float | None = MIRROR_MAX_STALENESS) -> bool:
+        # max_staleness=None accepts any completed sync, for when Shopify has run out of time
+        if not self.enabled:
+            return False
+        _, synced_at = await self.run(self._sync_state, shop, resource)
+        if synced_at is None:
+            return False
+        return max_staleness is None or time.time() - synced_at <= max_staleness
+
+    def _get_orders(self, shop: str, filters: OrderUrlParams) -> list[dict]:
+        conditions, params = order_conditions(filters)
+        if filters.ids:
+            ids = [int(order_id) for order_id in filters.ids.split(",") if order_id.strip()]
+            conditions.append(f"id IN ({','.join('?' * len(ids))})")
+            params.extend(ids)
+        if filters.since_id:
+            conditions.append("id > ?")
+            params.append(filters.since_id)
+        where, params = where_clause(shop, conditions, params)
+        order_by = "id ASC" if filters.since_id else "created_at DESC, id DESC"
+        rows = self._execute(
+            f"SELECT data FROM orders WHERE {where} ORDER BY {order_by} LIMIT ?",
+            params + [filters.limit],
+        )
+        fields = parse_fields(filters.fields)
+        return [project_fields(json.loads(data), fields) for data, in rows]
+
+    def _order_records(self, shop: str, filters: OrderUrlParams) -> list[dict]:
+        where, params = where_clause(shop, *order_conditions(filters))
+        rows = self._execute(f"SELECT data FROM orders WHERE {where} ORDER BY created_at", params)
+        return [json.loads(data) for data, in rows]
+
+    def _rows_by_id(self, sql: str, shop: str, ids: list[int]) -> list:
+        # In chunks, to stay under SQLite's limit on bound parameters
+        rows = []
+        for start in range(0, len(ids), MIRROR_PAGE_SIZE):
+            chunk = ids[start:start + MIRROR_PAGE_SIZE]
+            rows.extend(self._execute(sql.format(ids=",".join("?" * len(chunk))), [shop] + chunk))
+        return rows
+
+    def _customer_records(self, shop: str, ids: list[int]) -> dict[int, dict]:
+        rows = self._rows_by_id("SELECT id, data FROM customers WHERE shop = ? AND id IN ({ids})", shop, ids)
+        return {customer_id: json.loads(data) for customer_id, data in rows}
+
+    def _customers_since(self, shop: str, updated_at: float | None) -> list[dict]:
+        rows = self._execute(
+            "SELECT data FROM customers WHERE shop = ? AND updated_at >= ?", (shop, updated_at or 0)
+        )
+        return [json.loads(data) for data, in rows]
+
+    def _order_dates(self, shop: str, ids: list[int]) -> dict[int, float]:
+        return dict(self._rows_by_id("SELECT id, created_at FROM orders WHERE shop = ? AND id IN ({ids})", shop, ids))
+
+    async def get_customer_records(self, shop: str, ids: list[int]) -> dict[int, dict]:
+        return await self.run(self._customer_records, shop, ids) if ids else {}
+
+    async def get_customers_since(self, shop: str, updated_at: float | None) -> list[dict]:
+        return await self.run(self._customers_since, shop, updated_at)
+
+    async def get_order_dates(self, shop: str, ids: list[int]) -> dict[int, float]:
+        return await self.run(self._order_dates, shop, ids) if ids else {}
+
+    def _count_orders(self, shop: str, filters: OrderCountUrlParams) -> int:
+        where, params = where_clause(shop, *order_conditions(filters))
+        return self._execute(f"SELECT COUNT(*) FROM orders WHERE {where}", params)[0][0]
+
+    def _count_customers(self, shop: str, filters: CustomerCountUrlParams) -> int:
+        where, params = where_clause(shop, *range_conditions(filters, ["created_at", "updated_at"]))
+        return self._execute(f"SELECT COUNT(*) FROM customers WHERE {where}", params)[0][0]
+
+    async def get_orders(self, shop: str, filters: OrderUrlParams, max_staleness: float | None = MIRROR_MAX_STALENESS) -> dict | None:
+        # Filters the mirror can't evaluate locally go to Shopify instead
+        if filters.attribution_app_id or not await self.is_fresh(shop, "orders", max_staleness):
+            return None
+        return {"orders": await self.run(self._get_orders, shop, filters)}
+
+    async def get_order_records(self, shop: str, filters: OrderUrlParams, max_staleness: float | None = MIRROR_MAX_STALENESS) -> list[dict] | None:
+        # Every matching order in full, for server-side aggregation
+        if filters.attribution_app_id or not await self.is_fresh(shop, "orders", max_staleness):
+            return None
+        return await self.run(self._order_records, shop, filters)
+
+    async def get_orders_count(self, shop: str, filters: OrderCountUrlParams, max_staleness: float | None = MIRROR_MAX_STALENESS) -> dict | None:
+        if not await self.is_fresh(shop, "orders", max_staleness):
+            return None
+        return {"count": await self.run(self._count_orders, shop, filters)}
+
+    async def get_customers_count(self, shop: str, filters: CustomerCountUrlParams, max_staleness: float | None = MIRROR_MAX_STALENESS) -> dict | None:
+        if not await self.is_fresh(shop, "customers", max_staleness):
+            return None
+        return {"count": await self.run(self._count_customers, shop, filters)}
+
+    async def _run_sync_loop(self, shop_api_key: str, shop_domain_name: str):
+        # Started from whichever request first saw the shop; syncs aren't bound by its deadline
+        detach()
+        while True:
+            try:
+                await self.sync(shop_api_key, shop_domain_name)
+            except Exception as e:
+                print("Mirror sync error:", e)
+            await asyncio.sleep(MIRROR_SYNC_INTERVAL)
+
+    def start(self, shop_api_key: str, shop_domain_name: str):
+        if not self.enabled or shop_domain_name in self._tasks:
+            return
+        self._tasks[shop_domain_name] = asyncio.create_task(
+            self._run_sync_loop(shop_api_key, shop_domain_name)
+        )
+
+    async def stop_shop(self, shop: str):
+        task = self._tasks.pop(shop, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+        if self._connection is not None:
+            with self._lock:
+                self._connection.close()
+                self._connection = None
+
+
+mirror = Mirror()
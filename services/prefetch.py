@@ -0,0 +1,200 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from services.cache import response_cache
+from services.deadline import detach
+from services.metrics import prefetch_calls, prefetch_records, prefetch_suppressed
+from services.rate_limit import get_bucket, get_cost_bucket
+from services.shopify import (
+    CUSTOMER_FIELDS,
+    ORDER_FIELDS,
+    SHOPIFY_API_BACKEND,
+    get_shop_customers_batch,
+    get_shop_orders_batch,
+)
+
+# Fetch the records a chat usually asks about next (the top search hit, the
+# first orders listed and their customers) while the bucket has calls to spare
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() == "true"
+PREFETCH_TOP_N = int(os.getenv("PREFETCH_TOP_N", 3))
+# Prefetching stops while less than this share of the call bucket is spare
+PREFETCH_MIN_HEADROOM = float(os.getenv("PREFETCH_MIN_HEADROOM", 0.5))
+# A prefetched record nobody looked up within this long counts as wasted
+PREFETCH_WINDOW = float(os.getenv("PREFETCH_WINDOW", 300))
+PREFETCH_TRACKED = 10000
+
+
+@dataclass
+class PrefetchBatch:
+    # One batch call's records; the call was wasted if none of them is looked up
+    calls: int
+    pending: int
+    hits: int = 0
+
+
+@dataclass
+class PrefetchStats:
+    fetched: int = 0
+    hits: int = 0
+    wasted: int = 0
+    calls: int = 0
+    wasted_calls: int = 0
+    suppressed: int = 0
+
+    def as_dict(self) -> dict:
+        settled = self.hits + self.wasted
+        return {
+            "fetched": self.fetched,
+            "hits": self.hits,
+            "wasted": self.wasted,
+            "hit_ratio": round(self.hits / settled, 4) if settled else 0.0,
+            "calls": self.calls,
+            "wasted_calls": self.wasted_calls,
+            "suppressed": self.suppressed,
+        }
+
+
+class Prefetcher:
+    def __init__(self, enabled: bool = PREFETCH_ENABLED):
+        self.enabled = enabled
+        self.stats = PrefetchStats()
+        self._tracked: OrderedDict[tuple[str, str, int], tuple[float, PrefetchBatch]] = OrderedDict()
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def _settle(self, batch: PrefetchBatch, hit: bool):
+        batch.pending -= 1
+        batch.hits += hit
+        if batch.pending == 0 and batch.hits == 0:
+            self.stats.wasted_calls += batch.calls
+            prefetch_calls.inc(batch.calls, outcome="wasted")
+
+    def _expire(self):
+        cutoff = time.monotonic() - PREFETCH_WINDOW
+        while self._tracked:
+            key, (fetched_at, batch) = next(iter(self._tracked.items()))
+            if fetched_at > cutoff and len(self._tracked) <= PREFETCH_TRACKED:
+                return
+            del self._tracked[key]
+            self.stats.wasted += 1
+            prefetch_records.inc(resource=key[1], outcome="wasted")
+            self._settle(batch, hit=False)
+
+    async def record_lookup(self, shop: str, resource: str, resource_id: int, fields: str | None = None):
+        # Called before the lookup is served. Only a lookup the completed prefetch's
+        # cache entry can answer is a hit; one wanting other fields, or arriving after
+        # the entry went, is served from Shopify and leaves the prefetch unused
+        if not self.enabled:
+            return
+        self._expire()
+        item = self._tracked.pop((shop, resource, resource_id), None)
+        if item is None:
+            return
+        hit = await response_cache.peek(shop, resource, resource_id, fields) is not None
+        if hit:
+            self.stats.hits += 1
+            prefetch_records.inc(resource=resource, outcome="hit")
+        else:
+            self.stats.wasted += 1
+            prefetch_records.inc(resource=resource, outcome="wasted")
+        self._settle(item[1], hit=hit)
+
+    def has_headroom(self, shop: str) -> bool:
+        bucket = get_cost_bucket(shop) if SHOPIFY_API_BACKEND == "graphql" else get_bucket(shop)
+        return bucket.spare >= PREFETCH_MIN_HEADROOM * bucket.capacity
+
+    async def fetch(self, shop_api_key: str, shop: str, resource: str, ids: list[int], fields: str, fetch_batch):
+        missing = [i for i in dict.fromkeys(ids) if await response_cache.peek(shop, resource, i, fields) is None]
+        if not missing:
+            return
+        # Checked before each call, so a burst of real traffic stops a prefetch halfway
+        if not self.has_headroom(shop):
+            self.stats.suppressed += 1
+            prefetch_suppressed.inc(reason="headroom")
+            return
+        data = await fetch_batch(shop_api_key, shop, missing, fields)
+        records = data.get(f"{resource}s", [])
+        self.stats.calls += 1
+        prefetch_calls.inc(outcome="spent")
+        if not records:
+            self.stats.wasted_calls += 1
+            prefetch_calls.inc(outcome="wasted")
+            return
+        batch = PrefetchBatch(calls=1, pending=len(records))
+        now = time.monotonic()
+        for record in records:
+            key = (shop, resource, record["id"])
+            previous = self._tracked.pop(key, None)
+            if previous is not None:
+                # Refetched after its cache entry went; the earlier fetch wasn't used
+                self.stats.wasted += 1
+                prefetch_records.inc(resource=resource, outcome="wasted")
+                self._settle(previous[1], hit=False)
+            self._tracked[key] = (now, batch)
+        self.stats.fetched += len(records)
+        prefetch_records.inc(len(records), resource=resource, outcome="fetched")
+        self._expire()
+
+    async def _prefetch_customers(self, shop_api_key: str, shop: str, customer_ids: list[int]):
+        await self.fetch(shop_api_key, shop, "customer", customer_ids, CUSTOMER_FIELDS, get_shop_customers_batch)
+
+    async def _prefetch_orders(self, shop_api_key: str, shop: str, order_ids: list[int]):
+        await self.fetch(shop_api_key, shop, "order", order_ids, ORDER_FIELDS, get_shop_orders_batch)
+        customer_ids = []
+        for order_id in order_ids:
+            order = await response_cache.peek(shop, "order", order_id, "customer")
+            if order and (order.get("customer") or {}).get("id"):
+                customer_ids.append(order["customer"]["id"])
+        if customer_ids:
+            await self._prefetch_customers(shop_api_key, shop, customer_ids)
+
+    async def _run(self, prefetch, shop_api_key: str, shop: str, ids: list[int]):
+        # Outlives the request that prompted it, and must never fail it
+        detach()
+        try:
+            await prefetch(shop_api_key, shop, ids)
+        except Exception as e:
+            print("Prefetch error:", e)
+        finally:
+            self._tasks.pop(shop, None)
+
+    def _start(self, prefetch, shop_api_key: str, shop: str, records: list[dict]):
+        if not self.enabled:
+            return
+        ids = [record["id"] for record in records[:PREFETCH_TOP_N] if record.get("id")]
+        if not ids:
+            return
+        # One prefetch per shop at a time; a chat moving faster than that doesn't need one
+        if shop in self._tasks:
+            self.stats.suppressed += 1
+            prefetch_suppressed.inc(reason="busy")
+            return
+        self._tasks[shop] = asyncio.create_task(self._run(prefetch, shop_api_key, shop, ids))
+
+    def after_customer_search(self, shop_api_key: str, shop: str, customers: list[dict]):
+        self._start(self._prefetch_customers, shop_api_key, shop, customers)
+
+    def after_orders(self, shop_api_key: str, shop: str, orders: list[dict]):
+        self._start(self._prefetch_orders, shop_api_key, shop, orders)
+
+    async def stop_shop(self, shop: str):
+        task = self._tasks.pop(shop, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        for key in [key for key in self._tracked if key[0] == shop]:
+            del self._tracked[key]
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats_dict(self) -> dict:
+        return {"enabled": self.enabled, "tracked": len(self._tracked), **self.stats.as_dict()}
+
+
+prefetcher = Prefetcher()
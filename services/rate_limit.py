@@ -0,0 +1,201 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+from enum import IntEnum
+
+# Shopify's REST Admin API is a leaky bucket: 40 calls, leaking 2 per second
+# (80 and 4 on Shopify Plus). The real size is read from response headers.
+SHOPIFY_CALL_LIMIT = int(os.getenv("SHOPIFY_CALL_LIMIT", 40))
+SHOPIFY_CALL_LEAK_RATE = float(os.getenv("SHOPIFY_CALL_LEAK_RATE", 2))
+# Slots kept free for interactive lookups so listings can't starve them
+SHOPIFY_CALL_LIMIT_RESERVE = int(os.getenv("SHOPIFY_CALL_LIMIT_RESERVE", 5))
+SHOPIFY_MAX_RETRIES = int(os.getenv("SHOPIFY_MAX_RETRIES", 3))
+SHOPIFY_RETRY_BACKOFF = float(os.getenv("SHOPIFY_RETRY_BACKOFF", 0.5))
+SHOPIFY_RETRY_BACKOFF_MAX = float(os.getenv("SHOPIFY_RETRY_BACKOFF_MAX", 8))
+# The GraphQL Admin API budgets query cost points instead: 1000, restoring 50 per second
+SHOPIFY_GRAPHQL_COST_LIMIT = int(os.getenv("SHOPIFY_GRAPHQL_COST_LIMIT", 1000))
+SHOPIFY_GRAPHQL_RESTORE_RATE = float(os.getenv("SHOPIFY_GRAPHQL_RESTORE_RATE", 50))
+
+CALL_LIMIT_HEADER = "X-Shopify-Shop-Api-Call-Limit"
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    NORMAL = 1
+    BULK = 2
+
+
+def parse_call_limit(value: str | None) -> tuple[int, int] | None:
+    if not value:
+        return None
+    try:
+        used, limit = value.split("/")
+        return int(used), int(limit)
+    except ValueError:
+        return None
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def retry_delay(attempt: int, retry_after: float | None = None) -> float:
+    if retry_after is not None:
+        return retry_after
+    # Full jitter, so retrying workers don't stampede the bucket together
+    ceiling = min(SHOPIFY_RETRY_BACKOFF_MAX, SHOPIFY_RETRY_BACKOFF * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+class CallLimitBucket:
+    def __init__(
+        self,
+        capacity: int = SHOPIFY_CALL_LIMIT,
+        leak_rate: float = SHOPIFY_CALL_LEAK_RATE,
+        reserve: int = SHOPIFY_CALL_LIMIT_RESERVE,
+    ):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.reserve = reserve
+        self.used = 0.0
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._updated_at = time.monotonic()
+        self._waiters = []
+        self._counter = itertools.count()
+        self._dispatcher = None
+        self._wakeup = asyncio.Event()
+
+    @property
+    def available(self) -> float:
+        self._leak()
+        return max(0.0, self.capacity - self.used)
+
+    def _leak(self):
+        now = time.monotonic()
+        self.used = max(0.0, self.used - (now - self._updated_at) * self.leak_rate)
+        self._updated_at = now
+
+    def _delay(self, priority: Priority, cost: float = 1) -> float:
+        self._leak()
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        ceiling = self.capacity if priority == Priority.INTERACTIVE else self.capacity - self.reserve
+        overflow = self.used + cost - max(cost, ceiling)
+        if overflow <= 0:
+            return 0.0
+        return overflow / self.leak_rate
+
+    async def acquire(self, priority: Priority = Priority.NORMAL, cost: float = 1):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), cost, future))
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(cost=cost)
+            raise
+
+    def try_acquire(self, cost: float = 1) -> bool:
+        # Take spare budget now or not at all: never ahead of queued calls, never from the reserve
+        if self._waiters or self._delay(Priority.BULK, cost) > 0:
+            return False
+        self.used += cost
+        self.in_flight += cost
+        return True
+
+    async def _dispatch(self):
+        while self._waiters:
+            priority, _, cost, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._delay(priority, cost)
+            if delay > 0:
+                # Wake early if a higher priority call arrives in the meantime
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._waiters)
+            self.used += cost
+            self.in_flight += cost
+            future.set_result(None)
+
+    def release(self, headers=None, cost: float = 1):
+        self.in_flight = max(0, self.in_flight - cost)
+        call_limit = parse_call_limit(headers.get(CALL_LIMIT_HEADER)) if headers else None
+        if call_limit is not None:
+            # Shopify's count is authoritative, but hasn't seen calls still in flight
+            used, capacity = call_limit
+            self._leak()
+            self.capacity = capacity
+            self.used = float(used + self.in_flight)
+
+    def settle(self, cost: float, throttle_status: dict | None = None):
+        # GraphQL reports the bucket in the response body's extensions.cost
+        self.in_flight = max(0, self.in_flight - cost)
+        if throttle_status:
+            self._leak()
+            self.capacity = throttle_status["maximumAvailable"]
+            self.leak_rate = throttle_status["restoreRate"]
+            self.used = self.capacity - throttle_status["currentlyAvailable"] + self.in_flight
+
+    @property
+    def spare(self) -> float:
+        # Budget nobody is queued for, beyond the reserve kept for interactive calls
+        if self._waiters or time.monotonic() < self.blocked_until:
+            return 0.0
+        return max(0.0, self.available - self.reserve)
+
+    @property
+    def idle(self) -> bool:
+        return not self._waiters and not self.in_flight
+
+    def block(self, seconds: float):
+        self._leak()
+        self.used = float(self.capacity)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+_buckets: dict[str, CallLimitBucket] = {}
+_cost_buckets: dict[str, CallLimitBucket] = {}
+
+
+def get_bucket(shop_domain_name: str) -> CallLimitBucket:
+    bucket = _buckets.get(shop_domain_name)
+    if bucket is None:
+        bucket = CallLimitBucket()
+        _buckets[shop_domain_name] = bucket
+    return bucket
+
+
+def drop_buckets(shop_domain_name: str):
+    # Forget an idle shop's buckets; a fresh one starts out conservative anyway
+    for buckets in (_buckets, _cost_buckets):
+        bucket = buckets.get(shop_domain_name)
+        if bucket is not None and bucket.idle:
+            del buckets[shop_domain_name]
+
+
+def get_cost_bucket(shop_domain_name: str) -> CallLimitBucket:
+    bucket = _cost_buckets.get(shop_domain_name)
+    if bucket is None:
+        bucket = CallLimitBucket(SHOPIFY_GRAPHQL_COST_LIMIT, SHOPIFY_GRAPHQL_RESTORE_RATE, reserve=0)
+        _cost_buckets[shop_domain_name] = bucket
+    return bucket
@@ -0,0 +1,403 @@
+import asyncio
+import gzip
+import heapq
+import json
+import os
+import re
+import unicodedata
+from bisect import bisect_left
+
+from models.shopify_api import CustomerSearchUrlParams, SearchOrderDirection
+from services.cache import parse_fields, project_fields
+from services.mirror import MIRROR_MAX_STALENESS, mirror, timestamp
+
+# Serve /customers/search from an in-process index over the mirrored customers
+SEARCH_INDEX_ENABLED = os.getenv("SEARCH_INDEX_ENABLED", "true").lower() == "true"
+SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR", "search-index")
+SEARCH_INDEX_SAVE_INTERVAL = float(os.getenv("SEARCH_INDEX_SAVE_INTERVAL", 60))
+SEARCH_INDEX_VERSION = 1
+# Records indexed between yields to the event loop during a full build
+SEARCH_INDEX_BUILD_CHUNK = 1000
+
+FIELD_WEIGHTS = {
+    "email": 3.0,
+    "first_name": 3.0,
+    "last_name": 3.0,
+    "last_order_name": 2.0,
+    "tags": 2.0,
+    "note": 1.0,
+}
+# Shopify's field:value search terms the index can answer
+QUERY_FIELDS = {
+    "email": ("email",),
+    "first_name": ("first_name",),
+    "last_name": ("last_name",),
+    "name": ("first_name", "last_name"),
+    "tag": ("tags",),
+    "tags": ("tags",),
+    "note": ("note",),
+    "last_order_name": ("last_order_name",),
+}
+SORT_FIELDS = ("last_order_date", "created_at", "updated_at", "orders_count", "total_spent", "id")
+UPDATED_AT = SORT_FIELDS.index("updated_at")
+
+EXACT, PREFIX, INFIX, FUZZY = 1.0, 0.75, 0.5, 0.4
+# Trigram similarity a term needs to count as a typo of the query term
+FUZZY_THRESHOLD = 0.5
+QUERY_TERM = re.compile(r'(\w+):("[^"]*"|\S+)|("[^"]*"|\S+)')
+TOKEN = re.compile(r"[a-z0-9]+")
+OPERATORS = {"OR", "NOT"}
+
+
+def normalize(text: str) -> str:
+    # Müller matches muller: accents are folded away before tokenizing
+    return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode().lower()
+
+
+def tokenize(value) -> tuple[str, ...]:
+    return tuple(TOKEN.findall(normalize(str(value)))) if value else ()
+
+
+def trigrams(term: str) -> set[str]:
+    padded = f"^{term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def parse_query(query: str | None) -> list[tuple[tuple | None, str]] | None:
+    # (fields, token) pairs that must all match; None for syntax only Shopify can evaluate
+    terms = []
+    for field, value, text in QUERY_TERM.findall(query or ""):
+        if field:
+            fields = QUERY_FIELDS.get(field.lower())
+            if fields is None:
+                return None
+        else:
+            if text in OPERATORS or text.startswith("-"):
+                return None
+            fields, value = None, text
+        terms.extend((fields, token) for token in tokenize(value.strip('"')))
+    return terms
+
+
+def sort_values(customer: dict, last_order_date: float | None) -> tuple:
+    total_spent = customer.get("total_spent")
+    return (
+        last_order_date,
+        timestamp(customer.get("created_at")),
+        timestamp(customer.get("updated_at")),
+        customer.get("orders_count"),
+        float(total_spent) if total_spent not in (None, "") else None,
+        customer["id"],
+    )
+
+
+class CustomerIndex:
+    def __init__(self):
+        # Documents are numbered densely; a removed document leaves a None hole until the next save
+        self.ids: list[int | None] = []
+        self.fields: list[dict[str, tuple] | None] = []
+        self.sorts: list[tuple | None] = []
+        self.docnos: dict[int, int] = {}
+        self.postings: dict[str, set[int]] = {}
+        # Sorted terms for prefix lookups, and trigrams of each term for infix and fuzzy ones
+        self.vocabulary: list[str] = []
+        self.grams: dict[str, set[str]] = {}
+        self.watermark = 0.0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.docnos)
+
+    def _add_term(self, term: str, docno: int):
+        docs = self.postings.get(term)
+        if docs is None:
+            docs = self.postings[term] = set()
+            self.vocabulary.insert(bisect_left(self.vocabulary, term), term)
+            for gram in trigrams(term):
+                self.grams.setdefault(gram, set()).add(term)
+        docs.add(docno)
+
+    def _remove_term(self, term: str, docno: int):
+        docs = self.postings[term]
+        docs.discard(docno)
+        if docs:
+            return
+        del self.postings[term]
+        del self.vocabulary[bisect_left(self.vocabulary, term)]
+        for gram in trigrams(term):
+            terms = self.grams[gram]
+            terms.discard(term)
+            if not terms:
+                del self.grams[gram]
+
+    def add(self, customer_id: int, fields: dict[str, tuple], sorts: tuple):
+        self.remove(customer_id)
+        docno = len(self.ids)
+        self.ids.append(customer_id)
+        self.fields.append(fields)
+        self.sorts.append(sorts)
+        self.docnos[customer_id] = docno
+        for term in {term for tokens in fields.values() for term in tokens}:
+            self._add_term(term, docno)
+        self.watermark = max(self.watermark, sorts[UPDATED_AT] or 0)
+        self.dirty = True
+
+    def add_customer(self, customer: dict, last_order_date: float | None = None):
+        fields = {field: tokenize(customer.get(field)) for field in FIELD_WEIGHTS}
+        self.add(customer["id"], {field: tokens for field, tokens in fields.items() if tokens}, sort_values(customer, last_order_date))
+
+    def remove(self, customer_id: int):
+        docno = self.docnos.pop(customer_id, None)
+        if docno is None:
+            return
+        for term in {term for tokens in self.fields[docno].values() for term in tokens}:
+            self._remove_term(term, docno)
+        self.ids[docno] = self.fields[docno] = self.sorts[docno] = None
+        self.dirty = True
+
+    def match(self, token: str) -> dict[str, float]:
+        matches = {token: EXACT} if token in self.postings else {}
+        start = bisect_left(self.vocabulary, token)
+        for term in self.vocabulary[start:bisect_left(self.vocabulary, token + "\x7f", start)]:
+            matches.setdefault(term, PREFIX)
+        if len(token) >= 3:
+            # Every trigram of an infix occurs among the term's own trigrams
+            grams = sorted((self.grams.get(gram, set()) for gram in trigrams(token) if "^" not in gram and "$" not in gram), key=len)
+            if grams and grams[0]:
+                for term in grams[0].intersection(*grams[1:]):
+                    if token in term:
+                        matches.setdefault(term, INFIX)
+        if not matches and len(token) >= 4:
+            # Only when nothing matches as typed: terms sharing most trigrams, i.e. likely typos
+            query_grams = trigrams(token)
+            overlaps: dict[str, int] = {}
+            for gram in query_grams:
+                for term in self.grams.get(gram, ()):
+                    overlaps[term] = overlaps.get(term, 0) + 1
+            for term, overlap in overlaps.items():
+                similarity = 2 * overlap / (len(query_grams) + len(term))
+                if similarity >= FUZZY_THRESHOLD:
+                    matches[term] = FUZZY * similarity
+        return matches
+
+    def _score_term(self, fields: tuple | None, token: str) -> dict[int, float]:
+        scores: dict[int, float] = {}
+        for term, quality in self.match(token).items():
+            for docno in self.postings[term]:
+                weight = max(
+                    (FIELD_WEIGHTS[field] for field, tokens in self.fields[docno].items()
+                     if term in tokens and (fields is None or field in fields)),
+                    default=0.0,
+                )
+                if weight and quality * weight > scores.get(docno, 0.0):
+                    scores[docno] = quality * weight
+        return scores
+
+    def search(self, terms: list[tuple], order_field: str, descending: bool, limit: int) -> list[int]:
+        if terms:
+            scores = None
+            for fields, token in terms:
+                term_scores = self._score_term(fields, token)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {docno: score + term_scores[docno] for docno, score in scores.items() if docno in term_scores}
+                if not scores:
+                    return []
+        else:
+            scores = dict.fromkeys(self.docnos.values(), 0.0)
+
+        column = SORT_FIELDS.index(order_field)
+        sign = -1 if descending else 1
+
+        def key(docno: int):
+            value = self.sorts[docno][column]
+            # Like Shopify, customers without a value come last either way; relevance breaks ties
+            return (value is None, sign * value if value is not None else 0, -scores[docno], self.ids[docno])
+
+        return [self.ids[docno] for docno in heapq.nsmallest(limit, scores, key=key)]
+
+    def to_dict(self) -> dict:
+        # Live documents only, renumbered, with each posting list delta encoded
+        live = [docno for docno, customer_id in enumerate(self.ids) if customer_id is not None]
+        renumber = {docno: index for index, docno in enumerate(live)}
+        postings = {}
+        for term, docs in self.postings.items():
+            numbers = sorted(renumber[docno] for docno in docs)
+            postings[term] = [numbers[0]] + [b - a for a, b in zip(numbers, numbers[1:])]
+        return {
+            "version": SEARCH_INDEX_VERSION,
+            "watermark": self.watermark,
+            "ids": [self.ids[docno] for docno in live],
+            "fields": [{field: " ".join(tokens) for field, tokens in self.fields[docno].items()} for docno in live],
+            "sorts": [self.sorts[docno] for docno in live],
+            "postings": postings,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CustomerIndex":
+        index = cls()
+        index.ids = data["ids"]
+        index.fields = [{field: tuple(tokens.split()) for field, tokens in fields.items()} for fields in data["fields"]]
+        index.sorts = [tuple(sorts) for sorts in data["sorts"]]
+        index.docnos = {customer_id: docno for docno, customer_id in enumerate(index.ids)}
+        for term, deltas in data["postings"].items():
+            docs, docno = set(), 0
+            for delta in deltas:
+                docno += delta
+                docs.add(docno)
+            index.postings[term] = docs
+        index.vocabulary = sorted(index.postings)
+        for term in index.vocabulary:
+            for gram in trigrams(term):
+                index.grams.setdefault(gram, set()).add(term)
+        index.watermark = data["watermark"]
+        return index
+
+
+def write_index_file(path: str, data: dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = path + ".tmp"
+    with gzip.open(temporary, "wt", encoding="utf-8") as file:
+        json.dump(data, file, separators=(",", ":"))
+    # Readers never see a half-written index
+    os.replace(temporary, path)
+
+
+def read_index_file(path: str) -> dict | None:
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            data = json.load(file)
+    except (OSError, ValueError) as e:
+        if os.path.exists(path):
+            print("Search index unreadable, rebuilding:", e)
+        return None
+    return data if data.get("version") == SEARCH_INDEX_VERSION else None
+
+
+class SearchIndex:
+    def __init__(self, directory: str = SEARCH_INDEX_DIR, enabled: bool = SEARCH_INDEX_ENABLED):
+        self.directory = directory
+        self.enabled = enabled and mirror.enabled
+        self.indexes: dict[str, CustomerIndex] = {}
+        self._loading: dict[str, asyncio.Task] = {}
+        # Changes the mirror reports while a shop's index is loading, applied once it has caught up
+        self._changes: dict[str, list[tuple[str, list]]] = {}
+        self._saver: asyncio.Task = None
+        if self.enabled:
+            mirror.add_customer_hook(self.update)
+            mirror.add_customer_delete_hook(self.remove)
+
+    def path(self, shop: str) -> str:
+        return os.path.join(self.directory, f"{shop}.customers.json.gz")
+
+    async def index_customers(self, shop: str, index: CustomerIndex, customers: list[dict]):
+        dates = await mirror.get_order_dates(shop, [c["last_order_id"] for c in customers if c.get("last_order_id")])
+        for start in range(0, len(customers), SEARCH_INDEX_BUILD_CHUNK):
+            for customer in customers[start:start + SEARCH_INDEX_BUILD_CHUNK]:
+                index.add_customer(customer, dates.get(customer.get("last_order_id")))
+            await asyncio.sleep(0)
+
+    async def _apply(self, shop: str, index: CustomerIndex, change: tuple[str, list]):
+        kind, records = change
+        if kind == "update":
+            await self.index_customers(shop, index, records)
+        else:
+            for customer_id in records:
+                index.remove(customer_id)
+
+    async def _load(self, shop: str) -> CustomerIndex:
+        changes = self._changes[shop] = []
+        try:
+            data = await asyncio.to_thread(read_index_file, self.path(shop))
+            index = CustomerIndex.from_dict(data) if data is not None else CustomerIndex()
+            # Catch up on whatever the mirror took in since the index was last saved
+            await self.index_customers(shop, index, await mirror.get_customers_since(shop, index.watermark or None))
+            # The catch-up may have read the mirror before these changes; replaying them in
+            # order is harmless if it didn't. No await between the last one and registering
+            while changes:
+                await self._apply(shop, index, changes.pop(0))
+            self.indexes[shop] = index
+        finally:
+            del self._changes[shop]
+        return index
+
+    async def get_index(self, shop: str) -> CustomerIndex:
+        index = self.indexes.get(shop)
+        if index is not None:
+            return index
+        task = self._loading.get(shop)
+        if task is None:
+            task = self._loading[shop] = asyncio.create_task(self._load(shop))
+            task.add_done_callback(lambda _: self._loading.pop(shop, None))
+        return await asyncio.shield(task)
+
+    async def _change(self, shop: str, change: tuple[str, list]):
+        # Shops not loaded yet catch up from the mirror when they are
+        index = self.indexes.get(shop)
+        if index is not None:
+            await self._apply(shop, index, change)
+        elif shop in self._changes:
+            self._changes[shop].append(change)
+
+    async def update(self, shop: str, customers: list[dict]):
+        await self._change(shop, ("update", customers))
+
+    async def remove(self, shop: str, customer_ids: list[int]):
+        await self._change(shop, ("remove", customer_ids))
+
+    async def search_customers(
+        self, shop: str, filters: CustomerSearchUrlParams, max_staleness: float | None = MIRROR_MAX_STALENESS
+    ) -> dict | None:
+        if not self.enabled or filters.order_field not in SORT_FIELDS:
+            return None
+        terms = parse_query(filters.query)
+        if terms is None or not await mirror.is_fresh(shop, "customers", max_staleness):
+            return None
+        index = await self.get_index(shop)
+        ids = index.search(terms, filters.order_field, filters.order_direction == SearchOrderDirection.desc, filters.limit)
+        records = await mirror.get_customer_records(shop, ids)
+        fields = parse_fields(filters.fields)
+        return {"customers": [project_fields(records[customer_id], fields) for customer_id in ids if customer_id in records]}
+
+    async def save(self, shop: str):
+        index = self.indexes.get(shop)
+        if index is not None and index.dirty:
+            index.dirty = False
+            await asyncio.to_thread(write_index_file, self.path(shop), index.to_dict())
+
+    async def unload(self, shop: str):
+        await self.save(shop)
+        self.indexes.pop(shop, None)
+
+    async def _run_saver(self):
+        while True:
+            await asyncio.sleep(SEARCH_INDEX_SAVE_INTERVAL)
+            for shop in list(self.indexes):
+                try:
+                    await self.save(shop)
+                except Exception as e:
+                    print("Search index save error:", e)
+
+    def stats_dict(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "shops": len(self.indexes),
+            "customers": sum(len(index) for index in self.indexes.values()),
+            "terms": sum(len(index.postings) for index in self.indexes.values()),
+        }
+
+    def start(self):
+        if self.enabled and (self._saver is None or self._saver.done()):
+            self._saver = asyncio.create_task(self._run_saver())
+
+    async def stop(self):
+        if self._saver is not None:
+            self._saver.cancel()
+            await asyncio.gather(self._saver, return_exceptions=True)
+            self._saver = None
+        for shop in list(self.indexes):
+            await self.unload(shop)
+
+
+search_index = SearchIndex()
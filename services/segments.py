@@ -0,0 +1,331 @@
+import asyncio
+import os
+import time
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+from models.shopify_api import CustomerUrlParams, OrderUrlParams
+from services.analytics import from_cents, to_cents
+from services.deadline import detach
+from services.mirror import timestamp
+from services.shopify import get_shop_orders, iter_shop_customers_list, iter_shop_orders
+
+# Keeps recency/frequency/monetary metrics per customer in the background; off
+# by default since the first pass reads every customer
+SEGMENTS_ENABLED = os.getenv("SEGMENTS_ENABLED", "false").lower() == "true"
+SEGMENTS_SYNC_INTERVAL = float(os.getenv("SEGMENTS_SYNC_INTERVAL", 300))
+# Customer totals are re-read from Shopify this often, picking up refunds and edits to old orders
+SEGMENTS_RESEED_INTERVAL = float(os.getenv("SEGMENTS_RESEED_INTERVAL", 86400))
+SEGMENTS_PAGE_SIZE = 250
+
+CUSTOMER_SEED_FIELDS = "id,orders_count,total_spent,last_order_id"
+ORDER_FOLD_FIELDS = "id,customer,created_at,updated_at,total_price,cancelled_at"
+
+# The usual RFM grid over recency (rows) and frequency (columns) scores, 1-5 each
+SEGMENT_GRID = {
+    "champions": "Bought recently and often",
+    "loyal": "Buy often and fairly recently",
+    "potential_loyalists": "Recent customers with a few orders",
+    "new": "First order was recent",
+    "promising": "Recent, but only one order",
+    "need_attention": "Middling recency and frequency",
+    "about_to_sleep": "Haven't bought in a while, and rarely did",
+    "at_risk": "Used to buy often, but not lately",
+    "cant_lose": "Among the most frequent buyers, but gone quiet",
+    "hibernating": "Few orders, long ago",
+}
+SEGMENTS = (*SEGMENT_GRID, "prospects")
+SEGMENT_DESCRIPTIONS = {**SEGMENT_GRID, "prospects": "No orders yet"}
+TOP_METRICS = ("total_spent", "orders_count", "last_order_date")
+
+
+def segment_for(recency: int, frequency: int) -> str:
+    if recency <= 2:
+        if frequency == 5:
+            return "cant_lose"
+        return "at_risk" if frequency >= 3 else "hibernating"
+    if recency == 3:
+        if frequency >= 4:
+            return "loyal"
+        return "need_attention" if frequency == 3 else "about_to_sleep"
+    if frequency >= 4:
+        return "champions" if recency == 5 else "loyal"
+    if frequency >= 2:
+        return "potential_loyalists"
+    return "new" if recency == 5 else "promising"
+
+
+def quintile_scores(values) -> array:
+    # Ties share a score, so the many one-order customers all land in the bottom bucket
+    ordered = sorted(values)
+    count = len(ordered)
+    return array("b", (1 + bisect_left(ordered, value) * 5 // count for value in values))
+
+
+class CustomerMetrics:
+    # Column arrays rather than a dict per customer: about 40 bytes a customer
+    def __init__(self):
+        self.ids = array("q")
+        self.orders_count = array("q")
+        self.spent_cents = array("q")
+        self.last_order_ids = array("q")
+        self.last_order_at = array("d")
+        self.rows: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _row(self, customer_id: int) -> int:
+        row = self.rows.get(customer_id)
+        if row is None:
+            row = self.rows[customer_id] = len(self.ids)
+            self.ids.append(customer_id)
+            self.orders_count.append(0)
+            self.spent_cents.append(0)
+            self.last_order_ids.append(0)
+            self.last_order_at.append(0.0)
+        return row
+
+    def seed(self, customer: dict):
+        row = self._row(customer["id"])
+        self.orders_count[row] = customer.get("orders_count") or 0
+        self.spent_cents[row] = to_cents(customer.get("total_spent"))
+        last_order_id = customer.get("last_order_id") or 0
+        if last_order_id != self.last_order_ids[row]:
+            self.last_order_ids[row] = last_order_id
+            self.last_order_at[row] = 0.0
+
+    def set_last_order_at(self, order_id: int, created_at: float | None, customer_id: int):
+        row = self.rows.get(customer_id)
+        if row is not None and self.last_order_ids[row] == order_id and created_at:
+            self.last_order_at[row] = created_at
+
+    def fold(self, order: dict) -> bool:
+        # Order ids grow over time, so anything at or below the customer's last
+        # order is already in their totals; that's what makes re-reads harmless
+        customer_id = (order.get("customer") or {}).get("id")
+        if customer_id is None or order.get("cancelled_at"):
+            return False
+        row = self._row(customer_id)
+        created_at = timestamp(order.get("created_at")) or 0.0
+        if order["id"] < self.last_order_ids[row]:
+            return False
+        if order["id"] == self.last_order_ids[row]:
+            if self.last_order_at[row]:
+                return False
+            self.last_order_at[row] = created_at
+            return True
+        self.orders_count[row] += 1
+        self.spent_cents[row] += to_cents(order.get("total_price"))
+        self.last_order_ids[row] = order["id"]
+        self.last_order_at[row] = created_at
+        return True
+
+    def copy(self) -> "CustomerMetrics":
+        metrics = CustomerMetrics()
+        metrics.ids = self.ids[:]
+        metrics.orders_count = self.orders_count[:]
+        metrics.spent_cents = self.spent_cents[:]
+        metrics.last_order_ids = self.last_order_ids[:]
+        metrics.last_order_at = self.last_order_at[:]
+        return metrics
+
+
+class SegmentSnapshot:
+    # Scores and every ranking are computed once per update, so queries only slice
+    def __init__(self, metrics: CustomerMetrics, updated_at: float):
+        self.metrics = metrics
+        self.updated_at = updated_at
+        buyers = [row for row in range(len(metrics)) if metrics.orders_count[row] > 0]
+        self.scores = {}
+        if buyers:
+            # Customers whose last order date is unknown count as the least recent
+            recency = quintile_scores([metrics.last_order_at[row] for row in buyers])
+            frequency = quintile_scores([metrics.orders_count[row] for row in buyers])
+            monetary = quintile_scores([metrics.spent_cents[row] for row in buyers])
+            self.scores = {row: (r, f, m) for row, r, f, m in zip(buyers, recency, frequency, monetary)}
+
+        self.segments = array("B", [SEGMENTS.index("prospects")]) * len(metrics)
+        for row, (r, f, _) in self.scores.items():
+            self.segments[row] = SEGMENTS.index(segment_for(r, f))
+
+        keys = {
+            "total_spent": metrics.spent_cents,
+            "orders_count": metrics.orders_count,
+            "last_order_date": metrics.last_order_at,
+        }
+        self.rankings = {}
+        for by, values in keys.items():
+            ranked = sorted(range(len(metrics)), key=values.__getitem__, reverse=True)
+            self.rankings[(by, None)] = array("l", ranked)
+            members = [array("l") for _ in SEGMENTS]
+            for row in ranked:
+                members[self.segments[row]].append(row)
+            for segment, rows in zip(SEGMENTS, members):
+                self.rankings[(by, segment)] = rows
+
+    def segments_dict(self) -> dict:
+        return {
+            "customers": len(self.metrics),
+            "updated_at": datetime.fromtimestamp(self.updated_at, timezone.utc).isoformat(timespec="seconds"),
+            "segments": [
+                {
+                    "segment": segment,
+                    "description": SEGMENT_DESCRIPTIONS[segment],
+                    "count": len(self.rankings[("total_spent", segment)]),
+                }
+                for segment in SEGMENTS
+            ],
+        }
+
+    def customer_dict(self, row: int) -> dict:
+        metrics = self.metrics
+        last_order_at = metrics.last_order_at[row]
+        scores = self.scores.get(row)
+        return {
+            "id": metrics.ids[row],
+            "orders_count": metrics.orders_count[row],
+            "total_spent": from_cents(metrics.spent_cents[row]),
+            "last_order_id": metrics.last_order_ids[row] or None,
+            "last_order_date": datetime.fromtimestamp(last_order_at, timezone.utc).isoformat() if last_order_at else None,
+            "segment": SEGMENTS[self.segments[row]],
+            "rfm_score": "".join(str(score) for score in scores) if scores else None,
+        }
+
+    def top(self, by: str = "total_spent", segment: str = None, limit: int = 10, offset: int = 0) -> dict:
+        if by not in TOP_METRICS:
+            raise ValueError(f"by must be one of: {', '.join(TOP_METRICS)}")
+        if segment is not None and segment not in SEGMENTS:
+            raise ValueError(f"segment must be one of: {', '.join(SEGMENTS)}")
+        ranked = self.rankings[(by, segment)]
+        return {
+            "by": by,
+            "segment": segment,
+            "total": len(ranked),
+            "customers": [self.customer_dict(row) for row in ranked[offset:offset + limit]],
+        }
+
+
+@dataclass
+class ShopSegments:
+    metrics: CustomerMetrics = field(default_factory=CustomerMetrics)
+    snapshot: SegmentSnapshot = None
+    watermark: float = None
+    seeded_at: float = None
+
+
+class SegmentWorker:
+    def __init__(self, enabled: bool = SEGMENTS_ENABLED):
+        self.enabled = enabled
+        self.shops: dict[str, ShopSegments] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    async def seed(self, shop_api_key: str, shop_domain_name: str, state: ShopSegments):
+        # Customer totals are the starting point; only the last order's date needs an order lookup
+        started_at = time.time()
+        metrics = CustomerMetrics()
+        customers = iter_shop_customers_list(shop_api_key, shop_domain_name, CustomerUrlParams(
+            fields=CUSTOMER_SEED_FIELDS,
+            limit=SEGMENTS_PAGE_SIZE,
+        ))
+        async for customer in customers:
+            metrics.seed(customer)
+
+        last_orders = {
+            metrics.last_order_ids[row]: metrics.ids[row]
+            for row in range(len(metrics)) if metrics.last_order_ids[row]
+        }
+        order_ids = list(last_orders)
+        for start in range(0, len(order_ids), SEGMENTS_PAGE_SIZE):
+            chunk = order_ids[start:start + SEGMENTS_PAGE_SIZE]
+            data = await get_shop_orders(shop_api_key, shop_domain_name, OrderUrlParams(
+                ids=",".join(str(order_id) for order_id in chunk),
+                fields="id,created_at",
+                limit=len(chunk),
+                status="any",
+            ))
+            for order in data.get("orders", []):
+                metrics.set_last_order_at(order["id"], timestamp(order.get("created_at")), last_orders[order["id"]])
+
+        state.metrics = metrics
+        # Orders updated while the customers were read are folded in next; the id check skips repeats
+        state.watermark = started_at
+        state.seeded_at = started_at
+
+    async def fold_orders(self, shop_api_key: str, shop_domain_name: str, state: ShopSegments) -> bool:
+        started_at = time.time()
+        orders = iter_shop_orders(shop_api_key, shop_domain_name, OrderUrlParams(
+            fields=ORDER_FOLD_FIELDS,
+            limit=SEGMENTS_PAGE_SIZE,
+            status="any",
+            updated_at_min=datetime.fromtimestamp(state.watermark, timezone.utc),
+        ))
+        # Listed newest first, but fold skips anything below a customer's last order,
+        # so the pass is read in full and folded oldest first. A pass that fails
+        # part way folds nothing and leaves the watermark for the next one to retry
+        pass_orders = [order async for order in orders]
+        changed = False
+        watermark = state.watermark
+        for order in sorted(pass_orders, key=lambda order: order["id"]):
+            changed = state.metrics.fold(order) or changed
+            watermark = max(watermark, timestamp(order.get("updated_at")) or 0)
+        # Orders updated during the pass may be on pages already read; re-reading them is harmless
+        state.watermark = min(watermark, started_at)
+        return changed
+
+    async def update(self, shop_api_key: str, shop_domain_name: str):
+        state = self.shops.setdefault(shop_domain_name, ShopSegments())
+        if state.seeded_at is None or time.time() - state.seeded_at > SEGMENTS_RESEED_INTERVAL:
+            await self.seed(shop_api_key, shop_domain_name, state)
+            changed = True
+        else:
+            changed = False
+        changed = await self.fold_orders(shop_api_key, shop_domain_name, state) or changed
+        if changed or state.snapshot is None:
+            # Built from a copy off the event loop; queries keep using the old snapshot meanwhile
+            state.snapshot = await asyncio.to_thread(SegmentSnapshot, state.metrics.copy(), time.time())
+
+    def get(self, shop: str) -> SegmentSnapshot | None:
+        state = self.shops.get(shop)
+        return None if state is None else state.snapshot
+
+    async def _run_loop(self, shop_api_key: str, shop_domain_name: str):
+        # Started from whichever request first saw the shop; not bound by its deadline
+        detach()
+        while True:
+            try:
+                await self.update(shop_api_key, shop_domain_name)
+            except Exception as e:
+                print("Segments update error:", e)
+            await asyncio.sleep(SEGMENTS_SYNC_INTERVAL)
+
+    def start(self, shop_api_key: str, shop_domain_name: str):
+        if not self.enabled or shop_domain_name in self._tasks:
+            return
+        self._tasks[shop_domain_name] = asyncio.create_task(
+            self._run_loop(shop_api_key, shop_domain_name)
+        )
+
+    async def stop_shop(self, shop: str):
+        task = self._tasks.pop(shop, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self.shops.pop(shop, None)
+
+    async def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    def stats_dict(self) -> dict:
+        return {
+            shop: {"customers": len(state.metrics), "watermark": state.watermark, "seeded_at": state.seeded_at}
+            for shop, state in self.shops.items()
+        }
+
+
+segment_worker = SegmentWorker()
@@ -1,14 +1,58 @@
-import requests
-from urllib.parse import urlencode
+import asyncio
+import os
+import time
+import httpx
+from urllib.parse import urlencode, urlsplit
 
 from models.shopify_api import (
     OrderCountUrlParams, 
     OrderUrlParams,
     CustomerCountUrlParams,
     CustomerSearchUrlParams,
+    CustomerUrlParams,
 )
+from services.cache import (
+    ETagEntry,
+    etag_cache,
+    parse_fields,
+    project_fields,
+    response_cache,
+)
+from services import deadline
+from services.deadline import DeadlineExceeded, hedged, mark_fallback, within_deadline
+from services.http_client import get_client
+from services.metrics import (
+    call_limit_headroom,
+    endpoint_template,
+    json_decode_duration,
+    shopify_hedges,
+    shopify_not_modified,
+    shopify_request_duration,
+    shopify_retries,
+    span,
+)
+from services.rate_limit import (
+    CALL_LIMIT_HEADER,
+    Priority,
+    RETRYABLE_STATUS_CODES,
+    SHOPIFY_MAX_RETRIES,
+    get_bucket,
+    parse_call_limit,
+    parse_retry_after,
+    retry_delay,
+)
+from services.singleflight import request_flights
+from services import shopify_graphql
 
 SHOPIFY_API_VERSION = "2022-10" # 2023-04 is latest version
+# rest or graphql; counts, pagination and filters GraphQL can't express always use REST
+SHOPIFY_API_BACKEND = os.getenv("SHOPIFY_API_BACKEND", "rest")
+# Most ids the REST ids filter accepts per call
+SHOPIFY_IDS_PER_REQUEST = 250
+# Nested resources expand= can embed in an order
+ORDER_EXPANSIONS = ("customer",)
+# What a cached body needs from its original response to stand in for it after a 304
+ETAG_HEADERS = ("content-type", "link")
 
 # For better results, narrow fields returned
 DEFAULT_ORDER_FIELDS = "id,buyer_accepts_marketing,cancel_reason,cancelled_at,closed_at,confirmed,created_at,total_price,updated_at"
@@ -84,6 +128,28 @@ def customer_count_filters_to_url_parms(filters: CustomerCountUrlParams) -> str:
 
     return urlencode(params)
 
+def customer_filters_to_url_params(filters: CustomerUrlParams) -> str:
+    params = {}
+
+    if filters.created_at_max:
+        params["created_at_max"] = filters.created_at_max.isoformat()
+    if filters.created_at_min:
+        params["created_at_min"] = filters.created_at_min.isoformat()
+    if filters.fields:
+        params["fields"] = filters.fields
+    if filters.ids:
+        params["ids"] = filters.ids
+    if filters.limit:
+        params["limit"] = str(filters.limit)
+    if filters.since_id:
+        params["since_id"] = str(filters.since_id)
+    if filters.updated_at_max:
+        params["updated_at_max"] = filters.updated_at_max.isoformat()
+    if filters.updated_at_min:
+        params["updated_at_min"] = filters.updated_at_min.isoformat()
+
+    return urlencode(params)
+
 def customer_search_filters_to_url_params(filters: CustomerSearchUrlParams) -> str:
     params = {}
 
@@ -99,61 +165,405 @@ def customer_search_filters_to_url_params(filters: CustomerSearchUrlParams) -> s
     return urlencode(params)
 
 
-def authenticated_api_request(
+async def send_request(client: httpx.AsyncClient, endpoint: str, headers: dict, method="GET", data={}):
+    if method == "GET":
+      return await client.get(endpoint, headers=headers)
+    elif method == "POST":
+      return await client.post(endpoint, headers=headers, data=data)
+    elif method == "PUT":
+      return await client.put(endpoint, headers=headers, data=data)
+    elif method == "DELETE":
+      return await client.delete(endpoint, headers=headers)
+    raise ValueError(f"Unsupported method: {method}")
+
+
+def conditional_response(shop_domain_name: str, endpoint: str, response: httpx.Response, cached: ETagEntry | None) -> httpx.Response:
+    if response.status_code == 304 and cached is not None:
+        shopify_not_modified.inc(endpoint=endpoint_template(endpoint))
+        headers = httpx.Headers(response.headers)
+        for name in ("content-length", "content-encoding"):
+            headers.pop(name, None)
+        headers.update(cached.headers)
+        return httpx.Response(200, headers=headers, content=cached.body, request=response.request)
+    etag = response.headers.get("ETag")
+    if response.status_code == 200 and etag:
+        cached_headers = {name: response.headers[name] for name in ETAG_HEADERS if name in response.headers}
+        etag_cache.set(shop_domain_name, endpoint, ETagEntry(etag, response.content, cached_headers))
+    return response
+
+
+async def authenticated_api_response(
     shop_api_key: str, 
     shop_domain_name: str, 
     endpoint: str, 
     method="GET", 
-    data={}
-):
-    url = f"https://{shop_domain_name}{endpoint}"
+    data={},
+    priority: Priority = Priority.NORMAL,
+) -> httpx.Response:
+    client = get_client(shop_domain_name)
+    bucket = get_bucket(shop_domain_name)
     headers = {
         "X-Shopify-Access-Token": shop_api_key
     }
-    if method == "GET":
-      response = requests.get(url, headers=headers)
-    elif method == "POST":
-      response = requests.post(url, headers=headers, data=data)
-    elif method == "PUT":
-      response = requests.put(url, headers=headers, data=data)
-    elif method == "DELETE":
-      response = requests.delete(url, headers=headers)
-    return response.json()
+    template = endpoint_template(endpoint)
+    cached = etag_cache.get(shop_domain_name, endpoint) if method == "GET" else None
+    if cached is not None:
+        # Shopify answers 304 without a body if nothing changed since
+        headers["If-None-Match"] = cached.etag
+    attempt = 0
+    while True:
+        await within_deadline(bucket.acquire(priority))
+        started = time.perf_counter()
+        if method == "GET":
+            # A GET slower than most is sent again if there's spare budget; the first answer wins
+            request = hedged(
+                lambda: send_request(client, endpoint, headers, method, data),
+                template,
+                bucket.try_acquire,
+                bucket.release,
+                on_hedge=lambda: shopify_hedges.inc(endpoint=template),
+            )
+        else:
+            request = send_request(client, endpoint, headers, method, data)
+        try:
+            response = await within_deadline(request)
+        except (asyncio.CancelledError, DeadlineExceeded):
+            bucket.release()
+            raise
+        except httpx.TransportError:
+            bucket.release()
+            shopify_request_duration.observe(time.perf_counter() - started, method=method, endpoint=template, status="error")
+            # Only GETs are safe to replay after a dropped connection
+            if method != "GET" or attempt >= SHOPIFY_MAX_RETRIES:
+                raise
+            shopify_retries.inc(endpoint=template, reason="transport")
+            await deadline.sleep(retry_delay(attempt))
+            attempt += 1
+            continue
+
+        shopify_request_duration.observe(
+            time.perf_counter() - started, method=method, endpoint=template, status=response.status_code
+        )
+        bucket.release(response.headers)
+        call_limit = parse_call_limit(response.headers.get(CALL_LIMIT_HEADER))
+        if call_limit is not None:
+            call_limit_headroom.set(call_limit[1] - call_limit[0], shop=shop_domain_name)
+        # A 429 was turned away before it ran, but a server error may come after a write
+        # was applied, so only GETs are replayed on one
+        retryable = response.status_code == 429 or (method == "GET" and response.status_code in RETRYABLE_STATUS_CODES)
+        if not retryable:
+            return conditional_response(shop_domain_name, endpoint, response, cached) if method == "GET" else response
+
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if response.status_code == 429:
+            # The bucket holds every queued call back, not just this retry
+            bucket.block(retry_after if retry_after is not None else retry_delay(attempt))
+        elif attempt < SHOPIFY_MAX_RETRIES:
+            await deadline.sleep(retry_delay(attempt, retry_after))
+        if attempt >= SHOPIFY_MAX_RETRIES:
+            response.raise_for_status()
+        shopify_retries.inc(endpoint=template, reason=str(response.status_code))
+        attempt += 1
+
+
+async def authenticated_api_request(
+    shop_api_key: str, 
+    shop_domain_name: str, 
+    endpoint: str, 
+    method="GET", 
+    data={},
+    priority: Priority = Priority.NORMAL,
+):
+    template = endpoint_template(endpoint)
 
+    async def request():
+        with span("shopify.request", method=method, endpoint=template, shop=shop_domain_name):
+            response = await authenticated_api_response(shop_api_key, shop_domain_name, endpoint, method, data, priority)
+            with json_decode_duration.time(endpoint=template):
+                return response.json()
 
-def get_shop_order(shop_api_key: str, shop_domain_name: str, order_id: int, fields: str = None):
-    endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/orders/{order_id}.json"
-    if fields:
-        endpoint = f"{endpoint}?fields={fields}"
-    return authenticated_api_request(shop_api_key, shop_domain_name, endpoint)
+    if method != "GET":
+        return await request()
+    # Identical GETs already in flight for this shop share one upstream call
+    return await request_flights.do((shop_domain_name, endpoint), request)
 
 
-def get_shop_orders(shop_api_key: str, shop_domain_name: str, filters: OrderUrlParams):
+def next_page_endpoint(response: httpx.Response) -> str | None:
+    # Shopify cursor pagination: rel="next" in the Link header carries page_info
+    next_url = response.links.get("next", {}).get("url")
+    if not next_url:
+        return None
+    url = urlsplit(next_url)
+    return f"{url.path}?{url.query}" if url.query else url.path
+
+
+async def iter_pages(
+    shop_api_key: str,
+    shop_domain_name: str,
+    endpoint: str,
+    resource: str,
+    priority: Priority = Priority.BULK,
+):
+    def fetch(page_endpoint: str) -> asyncio.Task:
+        return asyncio.create_task(
+            authenticated_api_response(shop_api_key, shop_domain_name, page_endpoint, priority=priority)
+        )
+
+    template = endpoint_template(endpoint)
+    next_page = fetch(endpoint)
+    try:
+        while next_page is not None:
+            response = await next_page
+            response.raise_for_status()
+            page_endpoint = next_page_endpoint(response)
+            # Prefetch the next page while the caller works through this one
+            next_page = fetch(page_endpoint) if page_endpoint else None
+            with json_decode_duration.time(endpoint=template):
+                page = response.json().get(resource, [])
+            yield page
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+            if next_page.done() and not next_page.cancelled():
+                next_page.exception()
+
+
+async def get_cached_resource(
+    shop_api_key: str,
+    shop_domain_name: str,
+    resource: str,
+    resource_id: int,
+    fields: str = None,
+):
+    cached = await response_cache.get(shop_domain_name, resource, resource_id, fields)
+    if cached is not None:
+        return {resource: cached}
+
+    async with response_cache.refresh(shop_domain_name, resource, resource_id, fields) as refresh:
+        if refresh.record is not None:
+            return {resource: refresh.record}
+        fetch_fields = await response_cache.fetch_fields(shop_domain_name, resource, resource_id, fields)
+        try:
+            if SHOPIFY_API_BACKEND == "graphql":
+                data = await shopify_graphql.get_resource(shop_api_key, shop_domain_name, resource, resource_id, fetch_fields)
+            else:
+                endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/{resource}s/{resource_id}.json"
+                if fetch_fields:
+                    endpoint = f"{endpoint}?fields={fetch_fields}"
+                data = await authenticated_api_request(shop_api_key, shop_domain_name, endpoint, priority=Priority.INTERACTIVE)
+        except DeadlineExceeded:
+            # Out of time: an entry cached with fewer fields still answers part of the question
+            record = await response_cache.peek_partial(shop_domain_name, resource, resource_id, fields)
+            if record is None:
+                raise
+            mark_fallback("partial")
+            return {resource: record}
+        record = data.get(resource)
+        if record is None:
+            return data
+        await response_cache.set(shop_domain_name, resource, resource_id, fetch_fields, record)
+    return {resource: project_fields(record, parse_fields(fields))}
+
+
+async def get_shop_order(shop_api_key: str, shop_domain_name: str, order_id: int, fields: str = None):
+    return await get_cached_resource(shop_api_key, shop_domain_name, "order", order_id, fields)
+
+
+async def get_shop_orders(shop_api_key: str, shop_domain_name: str, filters: OrderUrlParams):
+    if SHOPIFY_API_BACKEND == "graphql":
+        data = await shopify_graphql.get_orders(shop_api_key, shop_domain_name, filters)
+        if data is not None:
+            return data
     params = order_filters_to_url_params(filters)
     endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/orders.json?{params}"
-    return authenticated_api_request(shop_api_key, shop_domain_name, endpoint)
+    return await authenticated_api_request(shop_api_key, shop_domain_name, endpoint, priority=Priority.BULK)
 
 
-def get_shop_orders_count(shop_api_key: str, shop_domain_name: str, filters: OrderCountUrlParams):
+async def get_shop_orders_count(shop_api_key: str, shop_domain_name: str, filters: OrderCountUrlParams):
     params = order_count_filters_to_url_params(filters)
     endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/orders/count.json?{params}"
-    return authenticated_api_request(shop_api_key, shop_domain_name, endpoint)
+    return await authenticated_api_request(shop_api_key, shop_domain_name, endpoint)
 
 
-def get_shop_customer(shop_api_key: str, shop_domain_name: str, customer_id: int, fields: str = None):
-    endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/customers/{customer_id}.json"
-    if fields:
-        endpoint = f"{endpoint}?fields={fields}"
-    return authenticated_api_request(shop_api_key, shop_domain_name, endpoint)
+async def get_shop_customer(shop_api_key: str, shop_domain_name: str, customer_id: int, fields: str = None):
+    return await get_cached_resource(shop_api_key, shop_domain_name, "customer", customer_id, fields)
 
 
-def get_shop_customers(shop_api_key: str, shop_domain_name: str, filters: CustomerSearchUrlParams):
+async def get_shop_customers(shop_api_key: str, shop_domain_name: str, filters: CustomerSearchUrlParams):
+    if SHOPIFY_API_BACKEND == "graphql":
+        data = await shopify_graphql.get_customers(shop_api_key, shop_domain_name, filters)
+        if data is not None:
+            return data
     params = customer_search_filters_to_url_params(filters)
     endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/customers/search.json?{params}"
-    return authenticated_api_request(shop_api_key, shop_domain_name, endpoint)
+    return await authenticated_api_request(shop_api_key, shop_domain_name, endpoint, priority=Priority.BULK)
 
 
-def get_shop_customers_count(shop_api_key: str, shop_domain_name: str, filters: CustomerCountUrlParams):
+async def get_shop_customers_list(shop_api_key: str, shop_domain_name: str, filters: CustomerUrlParams):
+    params = customer_filters_to_url_params(filters)
+    endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/customers.json?{params}"
+    return await authenticated_api_request(shop_api_key, shop_domain_name, endpoint, priority=Priority.BULK)
+
+
+async def get_shop_customers_count(shop_api_key: str, shop_domain_name: str, filters: CustomerCountUrlParams):
     params = customer_count_filters_to_url_parms(filters)
     endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/customers/count.json?{params}"
-    return authenticated_api_request(shop_api_key, shop_domain_name, endpoint)
+    return await authenticated_api_request(shop_api_key, shop_domain_name, endpoint)
+
+
+async def iter_shop_orders(shop_api_key: str, shop_domain_name: str, filters: OrderUrlParams):
+    params = order_filters_to_url_params(filters)
+    endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/orders.json?{params}"
+    async for orders in iter_pages(shop_api_key, shop_domain_name, endpoint, "orders"):
+        for order in orders:
+            yield order
+
+
+async def iter_shop_customers(shop_api_key: str, shop_domain_name: str, filters: CustomerSearchUrlParams):
+    params = customer_search_filters_to_url_params(filters)
+    endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/customers/search.json?{params}"
+    async for customers in iter_pages(shop_api_key, shop_domain_name, endpoint, "customers"):
+        for customer in customers:
+            yield customer
+
+
+async def iter_shop_customers_list(shop_api_key: str, shop_domain_name: str, filters: CustomerUrlParams):
+    params = customer_filters_to_url_params(filters)
+    endpoint = f"/admin/api/{SHOPIFY_API_VERSION}/customers.json?{params}"
+    async for customers in iter_pages(shop_api_key, shop_domain_name, endpoint, "customers"):
+        for customer in customers:
+            yield customer
+
+
+def with_field(fields: str | None, field: str) -> str | None:
+    requested = parse_fields(fields)
+    if requested is None or field in requested:
+        return fields
+    return ",".join(sorted(requested | {field}))
+
+
+def with_id_field(fields: str | None) -> str | None:
+    return with_field(fields, "id")
+
+
+async def get_cached_resources(
+    shop_api_key: str,
+    shop_domain_name: str,
+    resource: str,
+    resource_ids: list[int],
+    fields: str = None,
+    list_by_ids=None,
+):
+    requested = parse_fields(fields)
+    resource_ids = list(dict.fromkeys(resource_ids))
+    records, errors, missing = {}, {}, []
+    for resource_id in resource_ids:
+        cached = await response_cache.get(shop_domain_name, resource, resource_id, fields)
+        if cached is not None:
+            records[resource_id] = cached
+        else:
+            missing.append(resource_id)
+
+    async def fetch_one(resource_id: int):
+        try:
+            data = await get_cached_resource(shop_api_key, shop_domain_name, resource, resource_id, fields)
+        except DeadlineExceeded:
+            # The rest of the batch is still worth returning
+            errors[resource_id] = "Timed out"
+            mark_fallback("partial")
+            return
+        except Exception as e:
+            errors[resource_id] = str(e)
+            return
+        if resource in data:
+            records[resource_id] = data[resource]
+        else:
+            errors[resource_id] = str(data.get("errors", "Not found"))
+
+    async def fetch_chunk(chunk: list[int]):
+        # Look the whole chunk up with the ids filter where there is one. A failed
+        # chunk is reported against each of its ids rather than retried id by id,
+        # which would only turn one failing call into hundreds
+        fetch_fields = with_id_field(fields)
+        try:
+            found = await list_by_ids(chunk, fetch_fields) if list_by_ids else None
+        except DeadlineExceeded:
+            errors.update(dict.fromkeys(chunk, "Timed out"))
+            mark_fallback("partial")
+            return
+        except Exception as e:
+            print("Error:", e)
+            errors.update(dict.fromkeys(chunk, str(e)))
+            return
+        if found is None:
+            await asyncio.gather(*(fetch_one(resource_id) for resource_id in chunk))
+            return
+        for record in found:
+            records[record["id"]] = project_fields(record, requested)
+            await response_cache.set(shop_domain_name, resource, record["id"], fetch_fields, record)
+
+    await asyncio.gather(*(
+        fetch_chunk(missing[i:i + SHOPIFY_IDS_PER_REQUEST])
+        for i in range(0, len(missing), SHOPIFY_IDS_PER_REQUEST)
+    ))
+    return {
+        f"{resource}s": [records[i] for i in resource_ids if i in records],
+        "errors": [{"id": i, "detail": errors.get(i, "Not found")} for i in resource_ids if i not in records],
+    }
+
+
+async def get_shop_orders_batch(shop_api_key: str, shop_domain_name: str, order_ids: list[int], fields: str = None):
+    async def list_by_ids(ids: list[int], fetch_fields: str | None):
+        if SHOPIFY_API_BACKEND == "graphql":
+            return await shopify_graphql.get_resources(shop_api_key, shop_domain_name, "order", ids, fetch_fields)
+        data = await get_shop_orders(shop_api_key, shop_domain_name, OrderUrlParams(
+            ids=",".join(str(i) for i in ids),
+            fields=fetch_fields,
+            limit=len(ids),
+            status="any",
+        ))
+        return data.get("orders")
+
+    return await get_cached_resources(shop_api_key, shop_domain_name, "order", order_ids, fields, list_by_ids)
+
+
+async def get_shop_customers_batch(shop_api_key: str, shop_domain_name: str, customer_ids: list[int], fields: str = None):
+    async def list_by_ids(ids: list[int], fetch_fields: str | None):
+        if SHOPIFY_API_BACKEND == "graphql":
+            return await shopify_graphql.get_resources(shop_api_key, shop_domain_name, "customer", ids, fetch_fields)
+        data = await get_shop_customers_list(shop_api_key, shop_domain_name, CustomerUrlParams(
+            ids=",".join(str(i) for i in ids),
+            fields=fetch_fields,
+            limit=len(ids),
+        ))
+        return data.get("customers")
+
+    return await get_cached_resources(shop_api_key, shop_domain_name, "customer", customer_ids, fields, list_by_ids)
+
+
+def parse_expand(expand: str | None) -> frozenset[str]:
+    expansions = parse_fields(expand) or frozenset()
+    unknown = expansions - set(ORDER_EXPANSIONS)
+    if unknown:
+        raise ValueError(f"expand must be one of: {', '.join(ORDER_EXPANSIONS)}")
+    return expansions
+
+
+async def expand_order_customers(shop_api_key: str, shop_domain_name: str, orders: list[dict], customer_fields: str = None) -> list[dict]:
+    # Every distinct customer on the page in one cache-first batch, rather than a lookup per order
+    customer_ids = [order["customer"]["id"] for order in orders if (order.get("customer") or {}).get("id")]
+    if not customer_ids:
+        return orders
+    data = await get_shop_customers_batch(shop_api_key, shop_domain_name, customer_ids, with_id_field(customer_fields))
+    customers = {customer["id"]: customer for customer in data["customers"]}
+    requested = parse_fields(customer_fields)
+
+    expanded = []
+    for order in orders:
+        customer = order.get("customer")
+        if customer and customer.get("id"):
+            # A customer the batch couldn't resolve keeps the summary embedded in the order
+            customer = project_fields(customers.get(customer["id"], customer), requested)
+            order = {**order, "customer": customer}
+        expanded.append(order)
+    return expanded
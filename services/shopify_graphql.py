@@ -0,0 +1,506 @@
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+from models.shopify_api import CustomerSearchUrlParams, CustomerUrlParams, OrderUrlParams
+from services import deadline
+from services.cache import parse_fields
+from services.deadline import DeadlineExceeded, detach, upstream_remaining, within_deadline
+from services.http_client import get_client
+from services.metrics import (
+    graphql_cost_available,
+    json_decode_duration,
+    shopify_request_duration,
+    shopify_retries,
+    span,
+)
+from services.rate_limit import (
+    Priority,
+    RETRYABLE_STATUS_CODES,
+    SHOPIFY_MAX_RETRIES,
+    get_cost_bucket,
+    retry_delay,
+)
+
+# Kept in step with the REST SHOPIFY_API_VERSION
+SHOPIFY_GRAPHQL_API_VERSION = os.getenv("SHOPIFY_GRAPHQL_API_VERSION", "2022-10")
+# Concurrent single-record lookups arriving within this window share one aliased query
+GRAPHQL_BATCH_WINDOW = float(os.getenv("GRAPHQL_BATCH_WINDOW", 0.005))
+GRAPHQL_BATCH_SIZE = int(os.getenv("GRAPHQL_BATCH_SIZE", 50))
+# Shopify rejects any single query estimated above this many cost points
+GRAPHQL_MAX_QUERY_COST = 1000
+
+GID_TYPES = {
+    "order": "Order",
+    "customer": "Customer",
+}
+
+
+class GraphQLError(Exception):
+    pass
+
+
+def to_gid(resource: str, resource_id: int) -> str:
+    return f"gid://shopify/{GID_TYPES[resource]}/{resource_id}"
+
+
+def from_gid(gid: str | None) -> int | None:
+    if not gid:
+        return None
+    return int(gid.rsplit("/", 1)[1])
+
+
+def lower(value):
+    return value.lower() if isinstance(value, str) else value
+
+
+def integer(value):
+    return int(value) if value is not None else None
+
+
+def joined(value):
+    return ", ".join(value) if isinstance(value, list) else value
+
+
+# Each REST field maps to a GraphQL selection and a converter that reads it
+# back out of the GraphQL node in its REST shape
+def scalar(name: str, convert=None):
+    return name, lambda node: convert(node.get(name)) if convert else node.get(name)
+
+
+def money(name: str):
+    def read(node: dict):
+        return ((node.get(name) or {}).get("shopMoney") or {}).get("amount")
+
+    return f"{name} {{ shopMoney {{ amount }} }}", read
+
+
+def nested(name: str, selection: str, convert):
+    return f"{name} {{ {selection} }}", lambda node: convert(node.get(name)) if node.get(name) is not None else None
+
+
+def fulfillment_status(value):
+    if value in (None, "UNFULFILLED"):
+        return None
+    return {"PARTIALLY_FULFILLED": "partial"}.get(value, lower(value))
+
+
+def marketing_consent(value: dict):
+    consent = {
+        "state": lower(value.get("marketingState")),
+        "opt_in_level": lower(value.get("marketingOptInLevel")),
+        "consent_updated_at": value.get("consentUpdatedAt"),
+    }
+    if "consentCollectedFrom" in value:
+        consent["consent_collected_from"] = value["consentCollectedFrom"]
+    return consent
+
+
+CUSTOMER_FIELD_MAP = {
+    "id": scalar("id", from_gid),
+    "email": scalar("email"),
+    "accepts_marketing": scalar("acceptsMarketing"),
+    "accepts_marketing_updated_at": scalar("acceptsMarketingUpdatedAt"),
+    "created_at": scalar("createdAt"),
+    "updated_at": scalar("updatedAt"),
+    "orders_count": scalar("numberOfOrders", integer),
+    "state": scalar("state", lower),
+    "total_spent": nested("amountSpent", "amount", lambda value: value.get("amount")),
+    "last_order_id": nested("lastOrder", "id", lambda value: from_gid(value.get("id"))),
+    "last_order_name": nested("lastOrder", "name", lambda value: value.get("name")),
+    "note": scalar("note"),
+    "verified_email": scalar("verifiedEmail"),
+    "tags": scalar("tags", joined),
+    "marketing_opt_in_level": scalar("marketingOptInLevel", lower),
+    "email_marketing_consent": nested(
+        "emailMarketingConsent",
+        "marketingState marketingOptInLevel consentUpdatedAt",
+        marketing_consent,
+    ),
+    "sms_marketing_consent": nested(
+        "smsMarketingConsent",
+        "marketingState marketingOptInLevel consentUpdatedAt consentCollectedFrom",
+        marketing_consent,
+    ),
+}
+
+ORDER_FIELD_MAP = {
+    "id": scalar("id", from_gid),
+    "name": scalar("name"),
+    "buyer_accepts_marketing": scalar("customerAcceptsMarketing"),
+    "cancel_reason": scalar("cancelReason", lower),
+    "cancelled_at": scalar("cancelledAt"),
+    "closed_at": scalar("closedAt"),
+    "confirmed": scalar("confirmed"),
+    "created_at": scalar("createdAt"),
+    "currency": scalar("currencyCode"),
+    "current_subtotal_price": money("currentSubtotalPriceSet"),
+    "current_total_discounts": money("currentTotalDiscountsSet"),
+    "current_total_duties_set": money("currentTotalDutiesSet"),
+    "current_total_price": money("currentTotalPriceSet"),
+    "current_total_tax": money("currentTotalTaxSet"),
+    "discount_codes": scalar("discountCodes", lambda codes: [{"code": code} for code in codes or []]),
+    "estimated_taxes": scalar("estimatedTaxes"),
+    "financial_status": scalar("displayFinancialStatus", lower),
+    "fulfillment_status": scalar("displayFulfillmentStatus", fulfillment_status),
+    "note": scalar("note"),
+    "processed_at": scalar("processedAt"),
+    "subtotal_price": money("subtotalPriceSet"),
+    "tags": scalar("tags", joined),
+    "taxes_included": scalar("taxesIncluded"),
+    "total_discounts": money("totalDiscountsSet"),
+    "total_outstanding": money("totalOutstandingSet"),
+    "total_price": money("totalPriceSet"),
+    "total_tax": money("totalTaxSet"),
+    "total_tip_received": money("totalTipReceivedSet"),
+    "total_weight": scalar("totalWeight", integer),
+    "updated_at": scalar("updatedAt"),
+    "refunds": nested(
+        "refunds",
+        "id createdAt note",
+        lambda refunds: [
+            {"id": from_gid(refund["id"]), "created_at": refund.get("createdAt"), "note": refund.get("note")}
+            for refund in refunds
+        ],
+    ),
+    # Orders with their customers come back from a single query
+    "customer": nested(
+        "customer",
+        " ".join(dict.fromkeys(selection for selection, _ in CUSTOMER_FIELD_MAP.values())),
+        lambda customer: convert_node("customer", customer, None),
+    ),
+}
+
+FIELD_MAPS = {
+    "order": ORDER_FIELD_MAP,
+    "customer": CUSTOMER_FIELD_MAP,
+}
+
+CUSTOMER_SORT_KEYS = {
+    "created_at": "CREATED_AT",
+    "id": "ID",
+    "name": "NAME",
+    "orders_count": "ORDERS_COUNT",
+    "total_spent": "TOTAL_SPENT",
+    "updated_at": "UPDATED_AT",
+}
+
+
+def mapped_fields(resource: str, fields: str | None) -> list[str]:
+    # REST fields without a GraphQL counterpart (e.g. source_url) are left out
+    field_map = FIELD_MAPS[resource]
+    requested = parse_fields(fields)
+    if requested is None:
+        return list(field_map)
+    return [field for field in field_map if field in requested or field == "id"]
+
+
+def selection(resource: str, fields: str | None) -> str:
+    field_map = FIELD_MAPS[resource]
+    return " ".join(dict.fromkeys(field_map[field][0] for field in mapped_fields(resource, fields)))
+
+
+def convert_node(resource: str, node: dict, fields: str | None) -> dict:
+    field_map = FIELD_MAPS[resource]
+    return {field: field_map[field][1](node) for field in mapped_fields(resource, fields)}
+
+
+def estimate_cost(resource: str, fields: str | None, count: int = 1) -> int:
+    # Each object costs a point, as does every nested object it selects
+    nested_objects = sum(1 for field in mapped_fields(resource, fields) if field in ("customer", "refunds"))
+    return count * (1 + nested_objects) + 1
+
+
+def search_value(value) -> str:
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def range_terms(filters, columns: list[str]) -> list[str]:
+    terms = []
+    for column in columns:
+        minimum = getattr(filters, f"{column}_min")
+        maximum = getattr(filters, f"{column}_max")
+        if minimum:
+            terms.append(f"{column}:>={search_value(minimum.isoformat())}")
+        if maximum:
+            terms.append(f"{column}:<={search_value(maximum.isoformat())}")
+    return terms
+
+
+def order_filters_to_search_query(filters: OrderUrlParams) -> str | None:
+    # None when a filter has no search syntax equivalent; callers fall back to REST
+    if filters.attribution_app_id or filters.financial_status.value == "unpaid":
+        return None
+    terms = range_terms(filters, ["created_at", "updated_at", "processed_at"])
+    if filters.financial_status.value != "any":
+        terms.append(f"financial_status:{filters.financial_status.value}")
+    if filters.fulfillment_status.value != "any":
+        terms.append(f"fulfillment_status:{filters.fulfillment_status.value}")
+    if filters.status.value != "any":
+        terms.append(f"status:{filters.status.value}")
+    if filters.ids:
+        ids = [i.strip() for i in filters.ids.split(",") if i.strip()]
+        if not all(i.isdigit() for i in ids):
+            return None
+        terms.append("(" + " OR ".join(f"id:{i}" for i in ids) + ")")
+    if filters.since_id:
+        terms.append(f"id:>{filters.since_id}")
+    return " AND ".join(terms)
+
+
+def customer_filters_to_search_query(filters: CustomerUrlParams) -> str:
+    terms = range_terms(filters, ["created_at", "updated_at"])
+    if filters.since_id:
+        terms.append(f"id:>{filters.since_id}")
+    return " AND ".join(terms)
+
+
+async def graphql_request(
+    shop_api_key: str,
+    shop_domain_name: str,
+    query: str,
+    variables: dict = None,
+    cost: int = 1,
+    priority: Priority = Priority.NORMAL,
+) -> dict:
+    client = get_client(shop_domain_name)
+    bucket = get_cost_bucket(shop_domain_name)
+    endpoint = f"/admin/api/{SHOPIFY_GRAPHQL_API_VERSION}/graphql.json"
+    headers = {
+        "X-Shopify-Access-Token": shop_api_key,
+        "Content-Type": "application/json",
+    }
+    payload = json.dumps({"query": query, "variables": variables or {}})
+    attempt = 0
+    while True:
+        await within_deadline(bucket.acquire(priority, cost))
+        started = time.perf_counter()
+        try:
+            with span("shopify.graphql", shop=shop_domain_name, cost=cost):
+                response = await within_deadline(client.post(endpoint, headers=headers, content=payload))
+        except (asyncio.CancelledError, DeadlineExceeded):
+            bucket.settle(cost)
+            raise
+        except httpx.TransportError:
+            bucket.settle(cost)
+            shopify_request_duration.observe(time.perf_counter() - started, method="POST", endpoint="graphql.json", status="error")
+            if attempt >= SHOPIFY_MAX_RETRIES:
+                raise
+            shopify_retries.inc(endpoint="graphql.json", reason="transport")
+            await deadline.sleep(retry_delay(attempt))
+            attempt += 1
+            continue
+
+        shopify_request_duration.observe(
+            time.perf_counter() - started, method="POST", endpoint="graphql.json", status=response.status_code
+        )
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            bucket.settle(cost)
+            if attempt >= SHOPIFY_MAX_RETRIES:
+                response.raise_for_status()
+            shopify_retries.inc(endpoint="graphql.json", reason=str(response.status_code))
+            await deadline.sleep(retry_delay(attempt))
+            attempt += 1
+            continue
+        response.raise_for_status()
+
+        with json_decode_duration.time(endpoint="graphql.json"):
+            body = response.json()
+        query_cost = body.get("extensions", {}).get("cost", {})
+        throttle_status = query_cost.get("throttleStatus")
+        bucket.settle(cost, throttle_status)
+        if throttle_status:
+            graphql_cost_available.set(throttle_status["currentlyAvailable"], shop=shop_domain_name)
+        errors = body.get("errors") or []
+        if any(error.get("extensions", {}).get("code") == "THROTTLED" for error in errors):
+            if attempt >= SHOPIFY_MAX_RETRIES:
+                raise GraphQLError("Throttled by Shopify")
+            shopify_retries.inc(endpoint="graphql.json", reason="throttled")
+            # Wait until the bucket has restored enough points for this query
+            cost = query_cost.get("requestedQueryCost", cost)
+            if throttle_status:
+                shortfall = cost - throttle_status["currentlyAvailable"]
+                bucket.block(max(0, shortfall) / throttle_status["restoreRate"])
+            else:
+                await deadline.sleep(retry_delay(attempt))
+            attempt += 1
+            continue
+        if errors and not body.get("data"):
+            raise GraphQLError("; ".join(error.get("message", str(error)) for error in errors))
+        return body.get("data") or {}
+
+
+async def get_nodes(
+    shop_api_key: str,
+    shop_domain_name: str,
+    lookups: list[tuple[str, int, str | None]],
+    priority: Priority = Priority.INTERACTIVE,
+) -> list[dict | None]:
+    # One aliased query for any mix of (resource, id, fields) lookups
+    parts = [
+        f"r{index}: {resource}(id: {json.dumps(to_gid(resource, resource_id))}) {{ {selection(resource, fields)} }}"
+        for index, (resource, resource_id, fields) in enumerate(lookups)
+    ]
+    cost = sum(estimate_cost(resource, fields) for resource, _, fields in lookups)
+    data = await graphql_request(
+        shop_api_key, shop_domain_name, "query { " + " ".join(parts) + " }", cost=cost, priority=priority
+    )
+    return [
+        convert_node(resource, data[f"r{index}"], fields) if data.get(f"r{index}") else None
+        for index, (resource, _, fields) in enumerate(lookups)
+    ]
+
+
+class GraphQLBatcher:
+    def __init__(self, shop_api_key: str, shop_domain_name: str):
+        self.shop_api_key = shop_api_key
+        self.shop_domain_name = shop_domain_name
+        self._pending: list[tuple[str, int, str | None, asyncio.Future]] = []
+        self._timer: asyncio.Task = None
+
+    async def load(self, resource: str, resource_id: int, fields: str = None) -> dict | None:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((resource, resource_id, fields, future))
+        if len(self._pending) >= GRAPHQL_BATCH_SIZE:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        # Each caller waits only as long as its own deadline allows; the future is
+        # its own, so giving up on it leaves the rest of the batch alone
+        left = upstream_remaining()
+        if left is None:
+            return await future
+        try:
+            return await asyncio.wait_for(future, max(0.0, left))
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("Request deadline exceeded") from None
+
+    async def _flush_later(self):
+        await asyncio.sleep(GRAPHQL_BATCH_WINDOW)
+        self._flush()
+
+    def _flush(self):
+        pending, self._pending, self._timer = self._pending, [], None
+        asyncio.create_task(self._run(pending))
+
+    async def _run(self, pending: list):
+        # The batch serves every caller in it, so it mustn't run on the deadline of whichever came first
+        detach()
+        try:
+            records = await get_nodes(
+                self.shop_api_key,
+                self.shop_domain_name,
+                [(resource, resource_id, fields) for resource, resource_id, fields, _ in pending],
+            )
+        except Exception as e:
+            for *_, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (*_, future), record in zip(pending, records):
+            if not future.done():
+                future.set_result(record)
+
+
+_batchers: dict[tuple[str, str], GraphQLBatcher] = {}
+
+
+def get_batcher(shop_api_key: str, shop_domain_name: str) -> GraphQLBatcher:
+    batcher = _batchers.get((shop_domain_name, shop_api_key))
+    if batcher is None:
+        batcher = GraphQLBatcher(shop_api_key, shop_domain_name)
+        _batchers[(shop_domain_name, shop_api_key)] = batcher
+    return batcher
+
+
+def drop_batchers(shop_domain_name: str):
+    for key in [key for key in _batchers if key[0] == shop_domain_name]:
+        del _batchers[key]
+
+
+async def get_resource(shop_api_key: str, shop_domain_name: str, resource: str, resource_id: int, fields: str = None) -> dict:
+    record = await get_batcher(shop_api_key, shop_domain_name).load(resource, resource_id, fields)
+    if record is None:
+        return {"errors": "Not Found"}
+    return {resource: record}
+
+
+async def get_resources(
+    shop_api_key: str,
+    shop_domain_name: str,
+    resource: str,
+    resource_ids: list[int],
+    fields: str = None,
+) -> list[dict]:
+    chunks = [resource_ids[i:i + GRAPHQL_BATCH_SIZE] for i in range(0, len(resource_ids), GRAPHQL_BATCH_SIZE)]
+    results = await asyncio.gather(*(
+        get_nodes(shop_api_key, shop_domain_name, [(resource, i, fields) for i in chunk], Priority.BULK)
+        for chunk in chunks
+    ))
+    return [record for records in results for record in records if record is not None]
+
+
+async def get_connection(
+    shop_api_key: str,
+    shop_domain_name: str,
+    resource: str,
+    fields: str | None,
+    limit: int,
+    arguments: str,
+    variables: dict,
+) -> list[dict]:
+    declarations = ", ".join(f"${name}: {kind}" for name, (kind, _) in variables.items())
+    query = (
+        f"query{f'({declarations})' if declarations else ''} {{ "
+        f"{resource}s(first: {limit}{arguments}) {{ edges {{ node {{ {selection(resource, fields)} }} }} }} }}"
+    )
+    cost = estimate_cost(resource, fields, limit)
+    if cost > GRAPHQL_MAX_QUERY_COST:
+        raise GraphQLError(f"Query cost {cost} exceeds {GRAPHQL_MAX_QUERY_COST}")
+    data = await graphql_request(
+        shop_api_key,
+        shop_domain_name,
+        query,
+        {name: value for name, (_, value) in variables.items()},
+        cost=cost,
+        priority=Priority.BULK,
+    )
+    edges = (data.get(f"{resource}s") or {}).get("edges", [])
+    return [convert_node(resource, edge["node"], fields) for edge in edges]
+
+
+async def get_orders(shop_api_key: str, shop_domain_name: str, filters: OrderUrlParams) -> dict | None:
+    search_query = order_filters_to_search_query(filters)
+    if search_query is None:
+        return None
+    orders = await get_connection(
+        shop_api_key,
+        shop_domain_name,
+        "order",
+        filters.fields,
+        filters.limit,
+        ", query: $query",
+        {"query": ("String", search_query)},
+    )
+    return {"orders": orders}
+
+
+async def get_customers(shop_api_key: str, shop_domain_name: str, filters: CustomerSearchUrlParams) -> dict | None:
+    arguments, variables = "", {}
+    if filters.query:
+        arguments += ", query: $query"
+        variables["query"] = ("String", filters.query)
+    if filters.order_field:
+        sort_key = CUSTOMER_SORT_KEYS.get(filters.order_field)
+        if sort_key is None:
+            return None
+        arguments += f", sortKey: {sort_key}, reverse: {'true' if filters.order_direction.value == 'DESC' else 'false'}"
+    customers = await get_connection(
+        shop_api_key, shop_domain_name, "customer", filters.fields, filters.limit, arguments, variables
+    )
+    return {"customers": customers}
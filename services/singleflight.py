@@ -0,0 +1,55 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Hashable
+
+from services.deadline import DeadlineExceeded, detach, upstream_remaining
+
+
+@dataclass
+class SingleFlightStats:
+    calls: int = 0
+    shared: int = 0
+
+    def as_dict(self) -> dict:
+        return {"calls": self.calls, "shared": self.shared}
+
+
+class SingleFlight:
+    def __init__(self):
+        self.stats = SingleFlightStats()
+        self._calls: dict[Hashable, asyncio.Task] = {}
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    async def _run(self, fn: Callable[[], Awaitable]):
+        # The call serves every caller, so it mustn't run on the deadline of whichever came first
+        detach()
+        return await fn()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        # Concurrent callers with the same key share one call and its result,
+        # which must therefore be treated as read-only
+        task = self._calls.get(key)
+        if task is None:
+            self.stats.calls += 1
+            task = asyncio.create_task(self._run(fn))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.stats.shared += 1
+        # Shielded so one caller going away doesn't cancel the call for the rest;
+        # each caller waits only as long as its own deadline allows
+        left = upstream_remaining()
+        if left is None:
+            return await asyncio.shield(task)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), max(0.0, left))
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("Request deadline exceeded") from None
+
+
+request_flights = SingleFlight()
@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import hashlib
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from models.models import Shop
+from services.cache import etag_cache, response_cache
+from services.http_client import close_client
+from services.jobs import job_runner
+from services.metrics import call_limit_headroom, graphql_cost_available
+from services.mirror import mirror
+from services.prefetch import prefetcher
+from services.rate_limit import drop_buckets
+from services.search_index import search_index
+from services.segments import segment_worker
+from services.shopify_graphql import drop_batchers
+
+MULTI_TENANT = os.getenv("MULTI_TENANT", "false").lower() == "true"
+TENANT_DATABASE_PATH = os.getenv("TENANT_DATABASE_PATH", "tenants.db")
+TENANT_INDEX_SIZE = int(os.getenv("TENANT_INDEX_SIZE", 10000))
+# Revoked keys stop working within this many seconds
+TENANT_INDEX_TTL = float(os.getenv("TENANT_INDEX_TTL", 300))
+# Shops without a request for this long give up their pools, buckets and cache entries
+TENANT_IDLE_TIMEOUT = float(os.getenv("TENANT_IDLE_TIMEOUT", 900))
+TENANT_REAP_INTERVAL = 60
+# Unknown tokens are remembered briefly so guessing can't hammer the store
+TENANT_NEGATIVE_TTL = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shops (
+    id INTEGER PRIMARY KEY,
+    shopify_domain TEXT NOT NULL UNIQUE,
+    shopify_token TEXT NOT NULL,
+    access_scopes TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS api_keys (
+    id INTEGER PRIMARY KEY,
+    key_hash TEXT NOT NULL UNIQUE,
+    shop_id INTEGER NOT NULL REFERENCES shops (id) ON DELETE CASCADE,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+"""
+
+
+def hash_key(key: str) -> str:
+    # Only digests are stored, so a leaked database can't be replayed as bearer tokens
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def utcnow() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class TenantStore:
+    def __init__(self, path: str = TENANT_DATABASE_PATH):
+        self.path = path
+        self._connection: sqlite3.Connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def _execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                return connection.execute(sql, params)
+
+    def find_shop(self, key: str) -> Shop | None:
+        row = self._execute(
+            "SELECT shops.id, shopify_domain, shopify_token, access_scopes, shops.created_at, shops.updated_at "
+            "FROM api_keys JOIN shops ON shops.id = api_keys.shop_id WHERE key_hash = ?",
+            (hash_key(key),),
+        ).fetchone()
+        if row is None:
+            return None
+        shop_id, domain, token, access_scopes, created_at, updated_at = row
+        return Shop(
+            id=shop_id,
+            shopify_domain=domain,
+            shopify_token=token,
+            access_scopes=access_scopes,
+            created_at=created_at,
+            updated_at=updated_at,
+        )
+
+    def add_shop(self, shopify_domain: str, shopify_token: str, access_scopes: str = None) -> int:
+        now = utcnow()
+        self._execute(
+            "INSERT INTO shops (shopify_domain, shopify_token, access_scopes, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (shopify_domain) DO UPDATE SET "
+            "shopify_token = excluded.shopify_token, access_scopes = excluded.access_scopes, "
+            "updated_at = excluded.updated_at",
+            (shopify_domain, shopify_token, access_scopes, now, now),
+        )
+        return self._execute("SELECT id FROM shops WHERE shopify_domain = ?", (shopify_domain,)).fetchone()[0]
+
+    def create_api_key(self, shop_id: int) -> str:
+        key = secrets.token_urlsafe(32)
+        now = utcnow()
+        self._execute(
+            "INSERT INTO api_keys (key_hash, shop_id, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (hash_key(key), shop_id, now, now),
+        )
+        return key
+
+    def revoke_api_key(self, key: str) -> bool:
+        return self._execute("DELETE FROM api_keys WHERE key_hash = ?", (hash_key(key),)).rowcount > 0
+
+
+class Tenants:
+    def __init__(self, store: TenantStore):
+        self.store = store
+        self._index: OrderedDict[str, tuple[float, Shop | None]] = OrderedDict()
+        self._last_seen: dict[str, float] = {}
+        self._reaper: asyncio.Task = None
+
+    async def resolve(self, token: str) -> Shop | None:
+        key_hash = hash_key(token)
+        item = self._index.get(key_hash)
+        if item is None or item[0] <= time.monotonic():
+            shop = await asyncio.to_thread(self.store.find_shop, token)
+            ttl = TENANT_INDEX_TTL if shop is not None else TENANT_NEGATIVE_TTL
+            item = (time.monotonic() + ttl, shop)
+            self._index[key_hash] = item
+            while len(self._index) > TENANT_INDEX_SIZE:
+                self._index.popitem(last=False)
+        self._index.move_to_end(key_hash)
+        shop = item[1]
+        if shop is not None:
+            self._last_seen[shop.shopify_domain] = time.monotonic()
+        return shop
+
+    async def evict(self, shop_domain_name: str):
+        self._last_seen.pop(shop_domain_name, None)
+        await close_client(shop_domain_name)
+        drop_buckets(shop_domain_name)
+        drop_batchers(shop_domain_name)
+        await mirror.stop_shop(shop_domain_name)
+        await segment_worker.stop_shop(shop_domain_name)
+        await job_runner.stop_shop(shop_domain_name)
+        await prefetcher.stop_shop(shop_domain_name)
+        await search_index.unload(shop_domain_name)
+        await response_cache.clear_shop(shop_domain_name)
+        etag_cache.clear_shop(shop_domain_name)
+        call_limit_headroom.remove(shop=shop_domain_name)
+        graphql_cost_available.remove(shop=shop_domain_name)
+
+    async def evict_idle(self, idle_timeout: float = TENANT_IDLE_TIMEOUT):
+        cutoff = time.monotonic() - idle_timeout
+        for shop_domain_name in [shop for shop, seen in self._last_seen.items() if seen < cutoff]:
+            await self.evict(shop_domain_name)
+
+    async def _run_reaper(self):
+        while True:
+            await asyncio.sleep(TENANT_REAP_INTERVAL)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                print("Tenant eviction error:", e)
+
+    def stats_dict(self) -> dict:
+        return {"indexed_tokens": len(self._index), "active_shops": len(self._last_seen)}
+
+    def start(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._run_reaper())
+
+    async def stop(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            await asyncio.gather(self._reaper, return_exceptions=True)
+            self._reaper = None
+
+
+tenants = Tenants(TenantStore())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the shops served in multi-tenant mode")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add_shop = commands.add_parser("add-shop", help="Register a shop and print a new API key for it")
+    add_shop.add_argument("shopify_domain")
+    add_shop.add_argument("shopify_token")
+    add_shop.add_argument("--access-scopes")
+    revoke = commands.add_parser("revoke", help="Revoke an API key")
+    revoke.add_argument("key")
+    args = parser.parse_args()
+
+    if args.command == "add-shop":
+        shop_id = tenants.store.add_shop(args.shopify_domain, args.shopify_token, args.access_scopes)
+        print(tenants.store.create_api_key(shop_id))
+    elif not tenants.store.revoke_api_key(args.key):
+        raise SystemExit("No such API key")
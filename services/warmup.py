@@ -0,0 +1,87 @@
+import asyncio
+import os
+import time
+
+from models.shopify_api import OrderUrlParams
+from services.cache import response_cache
+from services.deadline import detach
+from services.segments import segment_worker
+from services.shopify import CUSTOMER_FIELDS, ORDER_FIELDS, get_shop_customers_batch, get_shop_orders
+
+# Recent orders (and their customers) fetched into the cache before a worker reports ready; 0 skips
+WARMUP_ORDERS = int(os.getenv("WARMUP_ORDERS", 50))
+# A slow or failing Shopify delays readiness by at most this long; warming is best effort
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", 30))
+
+
+async def warm_shop(shop_api_key: str, shop_domain_name: str):
+    # The first call also opens the shop's connection pool
+    data = await get_shop_orders(shop_api_key, shop_domain_name, OrderUrlParams(
+        fields=ORDER_FIELDS,
+        limit=min(WARMUP_ORDERS, 250),
+        status="any",
+    ))
+    if "orders" not in data:
+        raise RuntimeError(f"Listing recent orders failed: {data.get('errors')}")
+    orders = data["orders"]
+    for order in orders:
+        await response_cache.set(shop_domain_name, "order", order["id"], ORDER_FIELDS, order)
+
+    customer_ids = list(dict.fromkeys(order["customer"]["id"] for order in orders if order.get("customer")))
+    if customer_ids:
+        await get_shop_customers_batch(shop_api_key, shop_domain_name, customer_ids, CUSTOMER_FIELDS)
+
+    # Top customers come from the segment snapshot, which the worker builds on its own
+    while segment_worker.enabled and segment_worker.get(shop_domain_name) is None:
+        await asyncio.sleep(0.1)
+
+
+class Readiness:
+    def __init__(self):
+        self.warmed = False
+        self.draining = False
+        self.warm_seconds = None
+        self.warm_error = None
+        self._task: asyncio.Task = None
+
+    @property
+    def ready(self) -> bool:
+        return self.warmed and not self.draining
+
+    async def _warm(self, shop_api_key: str, shop_domain_name: str):
+        detach()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(warm_shop(shop_api_key, shop_domain_name), WARMUP_TIMEOUT)
+        except Exception as e:
+            print("Warm-up failed:", e)
+            self.warm_error = str(e) or type(e).__name__
+        self.warm_seconds = round(time.monotonic() - started, 3)
+        self.warmed = True
+
+    def start(self, shop_api_key: str = None, shop_domain_name: str = None):
+        # Multi-tenant workers don't know which shops will call first, so there's nothing to warm
+        if WARMUP_ORDERS <= 0 or shop_domain_name is None:
+            self.warmed = True
+            return
+        self._task = asyncio.create_task(self._warm(shop_api_key, shop_domain_name))
+
+    async def drain(self):
+        # From here on the load balancer sees 503 and routes new requests elsewhere,
+        # while the server finishes the ones already in flight
+        self.draining = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def as_dict(self) -> dict:
+        return {
+            "ready": self.ready,
+            "warmed": self.warmed,
+            "draining": self.draining,
+            "warm_seconds": self.warm_seconds,
+            "warm_error": self.warm_error,
+        }
+
+
+readiness = Readiness()
@@ -0,0 +1,174 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from services.cache import response_cache
+from services.mirror import mirror, timestamp
+
+SHOPIFY_WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+# Webhooks keep these entries current, so they can live much longer than polled ones
+WEBHOOK_CACHE_TTL = float(os.getenv("WEBHOOK_CACHE_TTL", 3600))
+# Shopify delivers at least once; remember this many delivery ids to skip repeats
+WEBHOOK_SEEN_IDS = 1000
+# A delivery that fails to apply is retried with doubling delays before it's given up on
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 3))
+WEBHOOK_RETRY_DELAY = float(os.getenv("WEBHOOK_RETRY_DELAY", 1))
+
+WEBHOOK_TOPICS = {
+    "orders/create": "order",
+    "orders/updated": "order",
+    "orders/cancelled": "order",
+    "customers/create": "customer",
+    "customers/update": "customer",
+    # Delete payloads carry just the id
+    "orders/delete": "order",
+    "customers/delete": "customer",
+}
+
+
+def sign_webhook(body: bytes, secret: str) -> str:
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+def verify_webhook(body: bytes, signature: str | None, secret: str | None = SHOPIFY_WEBHOOK_SECRET) -> bool:
+    if not secret or not signature:
+        return False
+    return hmac.compare_digest(sign_webhook(body, secret), signature)
+
+
+@dataclass
+class WebhookEvent:
+    shop: str
+    topic: str
+    payload: dict
+    webhook_id: str = None
+
+    @property
+    def resource(self) -> str:
+        return WEBHOOK_TOPICS[self.topic]
+
+    @property
+    def deleted(self) -> bool:
+        return self.topic.endswith("/delete")
+
+
+@dataclass
+class WebhookStats:
+    received: int = 0
+    applied: int = 0
+    duplicates: int = 0
+    outdated: int = 0
+    dropped: int = 0
+    retried: int = 0
+    failed: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "received": self.received,
+            "applied": self.applied,
+            "duplicates": self.duplicates,
+            "outdated": self.outdated,
+            "dropped": self.dropped,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+class WebhookProcessor:
+    def __init__(self, queue_size: int = WEBHOOK_QUEUE_SIZE):
+        self.stats = WebhookStats()
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._seen: OrderedDict[str, None] = OrderedDict()
+        self._worker: asyncio.Task = None
+
+    def enqueue(self, event: WebhookEvent) -> bool:
+        self.stats.received += 1
+        if event.webhook_id:
+            if event.webhook_id in self._seen:
+                self.stats.duplicates += 1
+                return True
+            self._seen[event.webhook_id] = None
+            while len(self._seen) > WEBHOOK_SEEN_IDS:
+                self._seen.popitem(last=False)
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Refusing lets Shopify redeliver later instead of blocking requests now
+            self.stats.dropped += 1
+            self._seen.pop(event.webhook_id, None)
+            return False
+        return True
+
+    async def delete(self, event: WebhookEvent):
+        record_id = event.payload["id"]
+        await response_cache.delete(event.shop, event.resource, record_id)
+        if mirror.enabled:
+            if event.resource == "order":
+                await mirror.delete_orders(event.shop, [record_id])
+            else:
+                await mirror.delete_customers(event.shop, [record_id])
+        self.stats.applied += 1
+
+    async def apply(self, event: WebhookEvent):
+        if event.deleted:
+            return await self.delete(event)
+        record = event.payload
+        cached = await response_cache.peek(event.shop, event.resource, record["id"], "updated_at")
+        cached_at = timestamp(cached.get("updated_at")) if cached else None
+        updated_at = timestamp(record.get("updated_at"))
+        if cached_at and updated_at and cached_at > updated_at:
+            # Deliveries can arrive out of order; never overwrite newer data
+            self.stats.outdated += 1
+            return
+        await response_cache.set(event.shop, event.resource, record["id"], None, record, ttl=WEBHOOK_CACHE_TTL)
+        if mirror.enabled:
+            if event.resource == "order":
+                await mirror.upsert_orders(event.shop, [record])
+            else:
+                await mirror.upsert_customers(event.shop, [record])
+        self.stats.applied += 1
+
+    async def apply_with_retries(self, event: WebhookEvent):
+        for attempt in range(WEBHOOK_MAX_ATTEMPTS):
+            try:
+                return await self.apply(event)
+            except Exception as e:
+                print("Webhook error:", e)
+                if attempt + 1 < WEBHOOK_MAX_ATTEMPTS:
+                    self.stats.retried += 1
+                    await asyncio.sleep(WEBHOOK_RETRY_DELAY * 2 ** attempt)
+        self.stats.failed += 1
+        # The change is lost, so at least stop serving the record it replaced;
+        # the next lookup fetches it from Shopify instead
+        self._seen.pop(event.webhook_id, None)
+        try:
+            await response_cache.delete(event.shop, event.resource, event.payload["id"])
+        except Exception as e:
+            print("Webhook error:", e)
+
+    async def _run(self):
+        while True:
+            event = await self._queue.get()
+            try:
+                await self.apply_with_retries(event)
+            finally:
+                self._queue.task_done()
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+
+webhook_processor = WebhookProcessor()
@@ -0,0 +1,9 @@
+import os
+
+# server.main reads its settings at import, so they have to be in place first
+os.environ.setdefault("HOST", "http://localhost:8000")
+os.environ.setdefault("SHOP_NAME", "Test Shop")
+os.environ.setdefault("SHOP_DOMAIN_NAME", "test-shop.myshopify.com")
+os.environ.setdefault("SHOP_API_KEY", "shpat_test")
+os.environ.setdefault("BEARER_TOKEN", "test-token")
+os.environ.setdefault("SHOPIFY_WEBHOOK_SECRET", "test-webhook-secret")
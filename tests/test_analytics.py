@@ -0,0 +1,88 @@
+from array import array
+from datetime import datetime, timezone
+
+import pytest
+
+from services.analytics import OrderColumns, from_cents, parse_metrics, percentile, time_bucket, to_cents
+
+
+def at(value: str) -> float:
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+
+
+def columns(orders: list[dict], field: str = "total_price") -> OrderColumns:
+    table = OrderColumns(field)
+    for order in orders:
+        table.append(order)
+    return table
+
+
+def test_money_uses_each_currencys_minor_units():
+    assert to_cents("19.99") == 1999
+    assert to_cents("0.005") == 1
+    assert to_cents("1500", "JPY") == 1500
+    assert to_cents("1.2345", "KWD") == 1235
+    assert to_cents(None) == to_cents("") == 0
+    assert from_cents(1999) == "19.99"
+    assert from_cents(1500, "JPY") == "1500"
+    assert from_cents(1235, "kwd") == "1.235"
+    assert from_cents(-5) == "-0.05"
+
+
+def test_sums_are_exact_where_floats_drift():
+    table = columns([{"total_price": "0.10", "currency": "USD"}] * 3)
+    assert table.aggregate("none", "sum")[0]["sum"] == "0.30"
+
+
+def test_metrics_are_parsed():
+    assert parse_metrics("count, SUM,median,p95") == (["count", "sum"], [50, 95])
+    for metric in ("p0", "p101", "mode"):
+        with pytest.raises(ValueError):
+            parse_metrics(metric)
+
+
+def test_percentiles_are_nearest_rank():
+    values = array("q", [100, 200, 300, 400])
+    assert [percentile(values, rank) for rank in (1, 25, 50, 51, 100)] == [100, 100, 200, 300, 400]
+    assert percentile(array("q", [700]), 99) == 700
+
+
+def test_time_buckets_roll_over_weeks_and_months():
+    assert time_bucket(at("2023-01-31T23:59:59"), "day") == "2023-01-31"
+    assert time_bucket(at("2023-02-01T00:00:00"), "month") == "2023-02"
+    # ISO weeks: Jan 1st 2023 is a Sunday, so it belongs to the last week of 2022
+    assert time_bucket(at("2023-01-01T12:00:00"), "week") == "2022-W52"
+    assert time_bucket(at("2023-01-02T00:00:00"), "week") == "2023-W01"
+
+
+def test_groups_are_split_by_currency():
+    table = columns([
+        {"created_at": "2023-05-01T10:00:00Z", "total_price": "10.00", "currency": "USD", "financial_status": "paid"},
+        {"created_at": "2023-05-01T11:00:00Z", "total_price": "20.01", "currency": "USD", "financial_status": "paid"},
+        {"created_at": "2023-05-01T12:00:00Z", "total_price": "3000", "currency": "JPY", "financial_status": "paid"},
+        {"created_at": "2023-05-02T12:00:00Z", "total_price": "1.500", "currency": "KWD", "financial_status": "refunded"},
+    ])
+    by_status = table.aggregate("financial_status", "count,sum,avg,min,max,median")
+    assert [(group["key"], group["currency"], group["count"]) for group in by_status] == [
+        ("paid", "USD", 2), ("paid", "JPY", 1), ("refunded", "KWD", 1),
+    ]
+    usd, jpy, kwd = by_status
+    assert (usd["sum"], usd["avg"], usd["min"], usd["max"]) == ("30.01", "15.01", "10.00", "20.01")
+    assert usd["percentiles"] == {"p50": "10.00"}
+    assert (jpy["sum"], jpy["avg"]) == ("3000", "3000")
+    assert kwd["sum"] == "1.500"
+
+    by_day = table.aggregate("day", "sum")
+    assert [(group["key"], group["currency"]) for group in by_day] == [
+        ("2023-05-01", "USD"), ("2023-05-01", "JPY"), ("2023-05-02", "KWD"),
+    ]
+
+
+def test_tags_count_an_order_once_per_tag():
+    table = columns([
+        {"total_price": "5.00", "currency": "USD", "tags": "vip, wholesale"},
+        {"total_price": "7.00", "currency": "USD", "tags": "vip"},
+        {"total_price": "1.00", "currency": "USD"},
+    ])
+    groups = {group["key"]: (group["count"], group["sum"]) for group in table.aggregate("tag", "sum")}
+    assert groups == {"vip": (2, "12.00"), "wholesale": (1, "5.00"), "(none)": (1, "1.00")}
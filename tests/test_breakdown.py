@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from models.shopify_api import CustomerCountUrlParams, OrderCountUrlParams
+from services import breakdown
+from services.breakdown import ORDER_DIMENSIONS, date_buckets, get_orders_count_breakdown, plan_buckets
+from services.cache import response_cache
+
+SHOP = "breakdown-test.myshopify.com"
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def test_week_buckets_follow_iso_weeks_and_clip_to_the_range():
+    # Wednesday to the Monday after next
+    buckets = date_buckets(datetime(2023, 1, 4, 12), datetime(2023, 1, 16, 10), "week")
+    assert buckets == [
+        ("2023-W01", utc(2023, 1, 4, 12), utc(2023, 1, 8, 23, 59, 59)),
+        ("2023-W02", utc(2023, 1, 9), utc(2023, 1, 15, 23, 59, 59)),
+        ("2023-W03", utc(2023, 1, 16), utc(2023, 1, 16, 10)),
+    ]
+
+
+def test_month_buckets_roll_over_short_months_and_years():
+    buckets = date_buckets(utc(2023, 1, 31), utc(2023, 3, 1), "month")
+    assert [(key, end) for key, _, end in buckets] == [
+        ("2023-01", utc(2023, 1, 31, 23, 59, 59)),
+        ("2023-02", utc(2023, 2, 28, 23, 59, 59)),
+        ("2023-03", utc(2023, 3, 1)),
+    ]
+    assert [key for key, _, _ in date_buckets(utc(2023, 12, 15), utc(2024, 1, 15), "month")] == ["2023-12", "2024-01"]
+
+
+def test_an_inclusive_max_on_a_boundary_opens_one_more_bucket():
+    # Shopify's *_max is inclusive, so midnight itself belongs to the next day
+    buckets = date_buckets(utc(2023, 5, 1), utc(2023, 5, 2), "day")
+    assert buckets == [
+        ("2023-05-01", utc(2023, 5, 1), utc(2023, 5, 1, 23, 59, 59)),
+        ("2023-05-02", utc(2023, 5, 2), utc(2023, 5, 2)),
+    ]
+    # Consecutive buckets neither overlap nor leave a second out
+    for (_, _, end), (_, start, _) in zip(buckets, buckets[1:]):
+        assert (start - end).total_seconds() == 1
+
+
+def test_ranges_are_checked_and_the_bucket_count_is_limited(monkeypatch):
+    monkeypatch.setattr(breakdown, "MAX_BREAKDOWN_BUCKETS", 3)
+    assert len(date_buckets(utc(2023, 5, 1), utc(2023, 5, 3, 12), "day")) == 3
+    with pytest.raises(ValueError, match="limited to 3 buckets"):
+        date_buckets(utc(2023, 5, 1), utc(2023, 5, 4), "day")
+    with pytest.raises(ValueError, match="needs a start date"):
+        date_buckets(None, utc(2023, 5, 4), "day")
+    with pytest.raises(ValueError, match="before the end date"):
+        date_buckets(utc(2023, 5, 4), utc(2023, 5, 1), "day")
+
+
+def test_status_dimensions_plan_one_bucket_per_value():
+    filters = OrderCountUrlParams(status="any", created_at_min=datetime(2023, 5, 1))
+    plan = plan_buckets(filters, ORDER_DIMENSIONS, "status", "created_at")
+    assert [bucket for bucket, _ in plan] == [{"key": status.value} for status in ORDER_DIMENSIONS["status"]]
+    for bucket, bucket_filters in plan:
+        assert bucket_filters.status.value == bucket["key"]
+        assert bucket_filters.created_at_min == filters.created_at_min
+    # The filters the request came with are left alone
+    assert filters.status.value == "any"
+
+
+def test_date_dimensions_plan_bounded_filters_and_reject_bad_arguments():
+    filters = CustomerCountUrlParams(updated_at_min=datetime(2023, 5, 1), updated_at_max=datetime(2023, 5, 2, 6))
+    plan = plan_buckets(filters, {}, "day", "updated_at")
+    assert [bucket for bucket, _ in plan] == [
+        {"key": "2023-05-01", "start": "2023-05-01T00:00:00+00:00", "end": "2023-05-01T23:59:59+00:00"},
+        {"key": "2023-05-02", "start": "2023-05-02T00:00:00+00:00", "end": "2023-05-02T06:00:00+00:00"},
+    ]
+    assert plan[1][1].updated_at_min == utc(2023, 5, 2)
+    assert plan[1][1].updated_at_max == utc(2023, 5, 2, 6)
+    with pytest.raises(ValueError, match="dimension must be one of"):
+        plan_buckets(filters, {}, "financial_status", "updated_at")
+    with pytest.raises(ValueError, match="date_field must be one of"):
+        plan_buckets(filters, {}, "day", "processed_at")
+
+
+def test_overlapping_ranges_reuse_each_others_buckets(monkeypatch):
+    fetched = []
+
+    async def get_shop_orders_count(shop_api_key, shop_domain_name, filters):
+        fetched.append(filters.created_at_min.day)
+        return {"count": filters.created_at_min.day}
+
+    monkeypatch.setattr(breakdown, "get_shop_orders_count", get_shop_orders_count)
+
+    def request(first_day: int, last_day: int):
+        filters = OrderCountUrlParams(created_at_min=utc(2023, 5, first_day), created_at_max=utc(2023, 5, last_day, 23, 59, 59))
+        return get_orders_count_breakdown("shpat_test", SHOP, filters, "day")
+
+    async def scenario():
+        try:
+            first = await request(1, 3)
+            second = await request(2, 4)
+        finally:
+            await response_cache.clear_shop(SHOP)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first["total"] == 1 + 2 + 3
+    assert [bucket["count"] for bucket in second["buckets"]] == [2, 3, 4]
+    # Only the 4th was new to the second request
+    assert sorted(fetched) == [1, 2, 3, 4]
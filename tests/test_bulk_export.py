@@ -0,0 +1,126 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+from services import bulk_export, shopify_graphql
+from services.bulk_export import BulkExport, BulkExporter, read_columnar
+from services.cache import response_cache
+from services.mirror import Mirror
+from services.rate_limit import CallLimitBucket
+
+SHOP = "bulk-test.myshopify.com"
+
+
+def customer_line(customer_id, email: str) -> str:
+    return json.dumps({
+        "id": f"gid://shopify/Customer/{customer_id}",
+        "email": email,
+        "updatedAt": f"2023-05-0{customer_id}T10:00:00Z",
+    })
+
+
+class FakeShopify:
+    # Runs the bulk operation over GraphQL, RUNNING on the first poll and then
+    # COMPLETED, and serves its result file as JSON lines
+    RESULT_URL = "https://storage.example/result.jsonl"
+
+    def __init__(self, lines: list[str]):
+        self.lines = lines
+        self.queries: list[dict] = []
+        self.polls = 0
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        if str(request.url) == self.RESULT_URL:
+            return httpx.Response(200, text="\n".join(self.lines) + "\n")
+        body = json.loads(request.content)
+        self.queries.append(body)
+        if "bulkOperationRunQuery" in body["query"]:
+            operation = {"id": "gid://shopify/BulkOperation/1", "status": "CREATED"}
+            return httpx.Response(200, json={"data": {"bulkOperationRunQuery": {"bulkOperation": operation, "userErrors": []}}})
+        self.polls += 1
+        done = self.polls > 1
+        return httpx.Response(200, json={"data": {"node": {
+            "id": "gid://shopify/BulkOperation/1",
+            "status": "COMPLETED" if done else "RUNNING",
+            "errorCode": None,
+            "objectCount": str(len(self.lines)),
+            "url": self.RESULT_URL if done else None,
+        }}})
+
+
+def use(monkeypatch, fake: FakeShopify):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(fake.handler), base_url=f"https://{SHOP}")
+    bucket = CallLimitBucket(capacity=1000, leak_rate=10000, reserve=0)
+    monkeypatch.setattr(bulk_export, "get_client", lambda shop_domain_name: client)
+    monkeypatch.setattr(shopify_graphql, "get_client", lambda shop_domain_name: client)
+    monkeypatch.setattr(shopify_graphql, "get_cost_bucket", lambda shop_domain_name: bucket)
+    monkeypatch.setattr(bulk_export, "BULK_POLL_INTERVAL", 0)
+
+
+LINES = [
+    customer_line(1, "a@example.com"),
+    "{not json",
+    customer_line(2, "b@example.com"),
+    customer_line("x", "bad-id@example.com"),
+    customer_line(3, "c@example.com"),
+]
+
+
+def test_a_result_file_is_written_as_columns_and_read_back(tmp_path, monkeypatch):
+    monkeypatch.setattr(bulk_export, "BULK_ROW_GROUP_SIZE", 2)
+    fake = FakeShopify(LINES)
+    use(monkeypatch, fake)
+    exporter = BulkExporter(str(tmp_path))
+    export = BulkExport(id="export-1", shop=SHOP, resource="customer", search_query="updated_at:>'2023-01-01'")
+
+    async def scenario():
+        await exporter._run("shpat_test", export)
+        return await response_cache.peek(SHOP, "customer", 2)
+
+    cached = asyncio.run(scenario())
+    assert export.status == "COMPLETED", export.error
+    assert (export.records, export.invalid, export.object_count) == (3, 2, 5)
+    assert fake.polls == 2
+    assert fake.queries[0]["variables"]["query"].startswith('{ customers(query: "updated_at:>\'2023-01-01\'")')
+    # Without the mirror the file is the export's only copy
+    assert cached is None
+
+    groups = list(read_columnar(export.path, ["id", "email"]))
+    assert groups == [
+        {"id": [1, 2], "email": ["a@example.com", "b@example.com"]},
+        {"id": [3], "email": ["c@example.com"]},
+    ]
+
+
+def test_a_full_export_fills_the_mirror(tmp_path, monkeypatch):
+    use(monkeypatch, FakeShopify(LINES))
+    store = Mirror(str(tmp_path / "mirror.db"), enabled=True)
+    monkeypatch.setattr(bulk_export, "mirror", store)
+    exporter = BulkExporter(str(tmp_path))
+    export = BulkExport(id="export-2", shop=SHOP, resource="customer")
+
+    async def scenario():
+        await exporter._run("shpat_test", export)
+        return await store.get_customer_records(SHOP, [1, 2, 3]), await store.is_fresh(SHOP, "customers")
+
+    records, fresh = asyncio.run(scenario())
+    assert export.status == "COMPLETED", export.error
+    assert {customer_id: record["email"] for customer_id, record in records.items()} == {
+        1: "a@example.com",
+        2: "b@example.com",
+        3: "c@example.com",
+    }
+    assert fresh
+
+
+def test_finished_exports_are_evicted_after_their_ttl(monkeypatch):
+    exporter = BulkExporter()
+    finished = BulkExport(id="old", shop=SHOP, resource="order", status="COMPLETED", finished_at=time.time() - 120)
+    running = BulkExport(id="running", shop=SHOP, resource="order", status="RUNNING")
+    exporter.exports = {"old": finished, "running": running}
+    monkeypatch.setattr(bulk_export, "BULK_EXPORT_TTL", 60)
+
+    assert exporter.get("old") is None
+    assert exporter.get("running") is running
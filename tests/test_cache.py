@@ -0,0 +1,318 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from services import cache
+from services.cache import (
+    MemoryCacheBackend,
+    RedisCacheBackend,
+    RedisConnection,
+    ResponseCache,
+    decode_value,
+    encode_value,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class FakeRedis:
+    # Just enough of a Redis server for the cache backend: GET, SET (PX, NX),
+    # DEL, SCAN and the delete-if EVAL over RESP, with expiry on a clock the test moves
+    def __init__(self):
+        self.clock = FakeClock()
+        self.data: dict[bytes, tuple[bytes, float | None]] = {}
+        self.commands: list[list[bytes]] = []
+        self.raw = bytearray()
+        self.url = None
+        self._server = None
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"redis://127.0.0.1:{port}/0"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def _live(self, key: bytes):
+        item = self.data.get(key)
+        if item is not None and item[1] is not None and item[1] <= self.clock.now:
+            del self.data[key]
+            return None
+        return item
+
+    async def _read_command(self, reader: asyncio.StreamReader) -> list[bytes] | None:
+        line = await reader.readline()
+        if not line:
+            return None
+        self.raw += line
+        args = []
+        for _ in range(int(line[1:-2])):
+            header = await reader.readline()
+            value = await reader.readexactly(int(header[1:-2]) + 2)
+            self.raw += header + value
+            args.append(value[:-2])
+        return args
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while True:
+            args = await self._read_command(reader)
+            if args is None:
+                break
+            self.commands.append(args)
+            writer.write(self.reply(args[0].upper(), args[1:]))
+            await writer.drain()
+        writer.close()
+
+    def reply(self, command: bytes, args: list[bytes]) -> bytes:
+        if command == b"GET":
+            item = self._live(args[0])
+            return b"$-1\r\n" if item is None else b"$%d\r\n%s\r\n" % (len(item[0]), item[0])
+        if command == b"SET":
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            if b"NX" in options and self._live(key) is not None:
+                return b"$-1\r\n"
+            expires_at = None
+            if b"PX" in options:
+                expires_at = self.clock.now + int(options[options.index(b"PX") + 1]) / 1000
+            self.data[key] = (value, expires_at)
+            return b"+OK\r\n"
+        if command == b"DEL":
+            deleted = sum(self.data.pop(key, None) is not None for key in args)
+            return b":%d\r\n" % deleted
+        if command == b"SCAN":
+            prefix = args[args.index(b"MATCH") + 1].rstrip(b"*")
+            keys = [key for key in self.data if key.startswith(prefix)]
+            body = b"".join(b"$%d\r\n%s\r\n" % (len(key), key) for key in keys)
+            return b"*2\r\n$1\r\n0\r\n*%d\r\n%s" % (len(keys), body)
+        if command == b"EVAL" and args[0] == cache.DELETE_IF_SCRIPT.encode():
+            key, value = args[2], args[3]
+            item = self._live(key)
+            if item is None or item[0] != value:
+                return b":0\r\n"
+            del self.data[key]
+            return b":1\r\n"
+        return b"-ERR unknown command\r\n"
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_values_round_trip_and_large_ones_are_compressed():
+    small = {"id": 1, "name": "#1001"}
+    large = {"id": 2, "note": "x" * 4000}
+    assert encode_value(small).startswith(b"j")
+    assert encode_value(large).startswith(b"z")
+    assert len(encode_value(large)) < 4000
+    assert decode_value(encode_value(small)) == small
+    assert decode_value(encode_value(large)) == large
+
+
+def test_redis_commands_are_resp_encoded():
+    async def scenario():
+        async with FakeRedis() as redis:
+            backend = RedisCacheBackend(redis.url, pool_size=1)
+            await backend.execute("SET", "key", b"a\r\nb", "PX", 1500)
+            await backend.close()
+            return bytes(redis.raw)
+
+    assert run(scenario()) == b"*5\r\n$3\r\nSET\r\n$3\r\nkey\r\n$4\r\na\r\nb\r\n$2\r\nPX\r\n$4\r\n1500\r\n"
+
+
+def test_redis_replies_are_decoded():
+    async def scenario():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"+OK\r\n:42\r\n$5\r\nhello\r\n$-1\r\n*2\r\n$1\r\n0\r\n*1\r\n$1\r\nk\r\n-ERR nope\r\n")
+        connection = RedisConnection(reader, writer=None)
+        replies = [await connection._read_reply() for _ in range(5)]
+        with pytest.raises(cache.RedisError):
+            await connection._read_reply()
+        return replies
+
+    assert run(scenario()) == ["OK", 42, b"hello", None, [b"0", [b"k"]]]
+
+
+def test_redis_backend_expires_entries_after_their_ttl():
+    async def scenario():
+        async with FakeRedis() as redis:
+            backend = RedisCacheBackend(redis.url, pool_size=2)
+            await backend.set("order:1", {"id": 1}, ttl=60)
+            fresh = await backend.get("order:1")
+            redis.clock.now += 59
+            still_fresh = await backend.get("order:1")
+            redis.clock.now += 2
+            expired = await backend.get("order:1")
+            set_command = redis.commands[0]
+            await backend.close()
+            return fresh, still_fresh, expired, set_command
+
+    fresh, still_fresh, expired, set_command = run(scenario())
+    assert fresh == still_fresh == {"id": 1}
+    assert expired is None
+    assert set_command[3:] == [b"PX", b"60000"]
+
+
+def test_redis_add_only_sets_missing_keys():
+    async def scenario():
+        async with FakeRedis() as redis:
+            backend = RedisCacheBackend(redis.url)
+            first = await backend.add("lock", "a", ttl=5)
+            second = await backend.add("lock", "b", ttl=5)
+            redis.clock.now += 6
+            after_expiry = await backend.add("lock", "c", ttl=5)
+            await backend.close()
+            return first, second, after_expiry
+
+    assert run(scenario()) == (True, False, True)
+
+
+def test_redis_clear_shop_only_deletes_that_shop():
+    async def scenario():
+        async with FakeRedis() as redis:
+            response_cache = ResponseCache(RedisCacheBackend(redis.url))
+            await response_cache.set("a.myshopify.com", "order", 1, None, {"id": 1})
+            await response_cache.set("b.myshopify.com", "order", 1, None, {"id": 1})
+            await response_cache.clear_shop("a.myshopify.com")
+            result = (
+                await response_cache.get("a.myshopify.com", "order", 1),
+                await response_cache.get("b.myshopify.com", "order", 1),
+            )
+            await response_cache.close()
+            return result
+
+    assert run(scenario()) == (None, {"id": 1})
+
+
+def test_refresh_lock_lets_one_caller_fetch_and_the_others_wait_for_it():
+    async def scenario():
+        async with FakeRedis() as redis:
+            response_cache = ResponseCache(RedisCacheBackend(redis.url))
+            fetches = []
+
+            async def lookup():
+                async with response_cache.refresh("shop", "order", 1, "id,name") as refresh:
+                    if refresh.record is not None:
+                        return refresh.record
+                    fetches.append(1)
+                    await asyncio.sleep(0.1)
+                    record = {"id": 1, "name": "#1001"}
+                    await response_cache.set("shop", "order", 1, "id,name", record)
+                    return record
+
+            results = await asyncio.gather(lookup(), lookup(), lookup())
+            lock_left = await response_cache.backend.get(response_cache._key("shop", "order", 1) + ":lock")
+            await response_cache.close()
+            return results, fetches, response_cache.stats.lock_waits, lock_left
+
+    results, fetches, lock_waits, lock_left = run(scenario())
+    assert results == [{"id": 1, "name": "#1001"}] * 3
+    assert len(fetches) == 1
+    assert lock_waits == 2
+    assert lock_left is None
+
+
+def test_a_timed_out_refresh_leaves_the_next_holders_lock_alone():
+    async def scenario():
+        async with FakeRedis() as redis:
+            response_cache = ResponseCache(RedisCacheBackend(redis.url))
+            lock_key = response_cache._key("shop", "order", 1) + ":lock"
+            async with response_cache.refresh("shop", "order", 1) as refresh:
+                assert refresh.record is None
+                # The fetch outlives the lock, and another worker takes it over
+                redis.clock.now += cache.CACHE_LOCK_TIMEOUT + 1
+                taken_over = await response_cache.backend.add(lock_key, "other-worker", cache.CACHE_LOCK_TIMEOUT)
+            lock_left = await response_cache.backend.get(lock_key)
+            await response_cache.close()
+            return taken_over, lock_left
+
+    assert run(scenario()) == (True, "other-worker")
+
+
+def test_memory_backend_only_deletes_a_key_that_still_holds_the_value():
+    async def scenario():
+        backend = MemoryCacheBackend()
+        await backend.set("lock", "a", ttl=5)
+        mismatched = await backend.delete_if("lock", "b")
+        kept = await backend.get("lock")
+        matched = await backend.delete_if("lock", "a")
+        return mismatched, kept, matched, await backend.get("lock")
+
+    assert run(scenario()) == (False, "a", True, None)
+
+
+def test_an_entry_serves_any_subset_of_its_fields():
+    async def scenario():
+        response_cache = ResponseCache(MemoryCacheBackend())
+        await response_cache.set("shop", "order", 1, "id,name,total_price", {"id": 1, "name": "#1001", "total_price": "9.00"})
+        return (
+            await response_cache.get("shop", "order", 1, "name,id"),
+            await response_cache.get("shop", "order", 1, "id,email"),
+            await response_cache.get("shop", "order", 1),
+            response_cache.stats.as_dict(),
+        )
+
+    subset, wider, unfiltered, stats = run(scenario())
+    assert subset == {"id": 1, "name": "#1001"}
+    assert wider is None
+    assert unfiltered is None
+    assert (stats["hits"], stats["misses"], stats["partial_misses"]) == (1, 2, 2)
+
+
+def test_a_full_entry_serves_every_field_set():
+    async def scenario():
+        response_cache = ResponseCache(MemoryCacheBackend())
+        await response_cache.set("shop", "customer", 7, None, {"id": 7, "email": "a@example.com", "tags": "vip"})
+        return await response_cache.get("shop", "customer", 7, "tags"), await response_cache.fetch_fields("shop", "customer", 7, "email")
+
+    record, fetch_fields = run(scenario())
+    assert record == {"tags": "vip"}
+    assert fetch_fields is None
+
+
+def test_fetch_fields_widens_to_what_is_cached():
+    async def scenario():
+        response_cache = ResponseCache(MemoryCacheBackend())
+        await response_cache.set("shop", "order", 1, "id,name", {"id": 1, "name": "#1001"})
+        return await response_cache.fetch_fields("shop", "order", 1, "total_price")
+
+    assert run(scenario()) == "id,name,total_price"
+
+
+def test_memory_backend_evicts_the_least_recently_used_entry():
+    async def scenario():
+        backend = MemoryCacheBackend(max_entries=2)
+        await backend.set("a", 1, ttl=60)
+        await backend.set("b", 2, ttl=60)
+        # Reading "a" makes "b" the least recently used
+        await backend.get("a")
+        await backend.set("c", 3, ttl=60)
+        return [await backend.get(key) for key in ("a", "b", "c")], backend.stats.evictions
+
+    values, evictions = run(scenario())
+    assert values == [1, None, 3]
+    assert evictions == 1
+
+
+def test_memory_backend_expires_entries(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, "time", SimpleNamespace(monotonic=clock.monotonic))
+
+    async def scenario():
+        backend = MemoryCacheBackend()
+        await backend.set("a", 1, ttl=60)
+        clock.now += 59
+        fresh = await backend.get("a")
+        clock.now += 2
+        return fresh, await backend.get("a"), backend.stats.expirations
+
+    assert run(scenario()) == (1, None, 1)
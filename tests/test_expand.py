@@ -0,0 +1,61 @@
+import asyncio
+import copy
+
+import pytest
+
+from services import shopify
+from services.shopify import expand_order_customers, parse_expand
+
+SHOP = "expand-test.myshopify.com"
+CUSTOMERS = {
+    7: {"id": 7, "email": "ann@example.com", "orders_count": 3, "tags": "vip"},
+    8: {"id": 8, "email": "ben@example.com", "orders_count": 1, "tags": ""},
+}
+
+
+def test_expand_accepts_known_expansions_only():
+    assert parse_expand(None) == frozenset()
+    assert parse_expand("customer") == frozenset({"customer"})
+    assert parse_expand(" customer , customer") == frozenset({"customer"})
+    with pytest.raises(ValueError, match="expand must be one of: customer"):
+        parse_expand("customer,line_items")
+
+
+def test_customers_are_fetched_in_one_batch_and_replace_the_summaries(monkeypatch):
+    batches = []
+
+    async def get_shop_customers_batch(shop_api_key, shop_domain_name, customer_ids, fields=None):
+        batches.append((customer_ids, fields))
+        return {"customers": [CUSTOMERS[i] for i in customer_ids if i in CUSTOMERS], "errors": []}
+
+    monkeypatch.setattr(shopify, "get_shop_customers_batch", get_shop_customers_batch)
+    orders = [
+        {"id": 1, "customer": {"id": 7, "email": "old@example.com"}},
+        {"id": 2, "customer": {"id": 9, "email": "gone@example.com"}},
+        {"id": 3, "customer": None},
+        {"id": 4, "customer": {"id": 7, "email": "old@example.com"}},
+        {"id": 5},
+    ]
+    originals = copy.deepcopy(orders)
+
+    expanded = asyncio.run(expand_order_customers("shpat_test", SHOP, orders, "email,orders_count"))
+    assert batches == [([7, 9, 7], "email,id,orders_count")]
+    assert expanded == [
+        {"id": 1, "customer": {"email": "ann@example.com", "orders_count": 3}},
+        # Not resolved: the summary embedded in the order stays, cut down to the fields asked for
+        {"id": 2, "customer": {"email": "gone@example.com"}},
+        {"id": 3, "customer": None},
+        {"id": 4, "customer": {"email": "ann@example.com", "orders_count": 3}},
+        {"id": 5},
+    ]
+    # The orders passed in may be shared with other requests, so they're left as they were
+    assert orders == originals
+
+
+def test_orders_without_customers_skip_the_batch(monkeypatch):
+    async def get_shop_customers_batch(*args, **kwargs):
+        raise AssertionError("No customers to fetch")
+
+    monkeypatch.setattr(shopify, "get_shop_customers_batch", get_shop_customers_batch)
+    orders = [{"id": 1, "customer": None}, {"id": 2}]
+    assert asyncio.run(expand_order_customers("shpat_test", SHOP, orders)) is orders
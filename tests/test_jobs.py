@@ -0,0 +1,29 @@
+import pytest
+
+from services.jobs import JOB_PAGE_SIZE, normalize_params
+from services.shopify import DEFAULT_CUSTOMER_FIELDS, DEFAULT_ORDER_FIELDS
+
+
+def test_omitted_fields_default_to_the_endpoints_fields():
+    orders, _ = normalize_params("orders", {})
+    customers, _ = normalize_params("customers", {"query": "vip"})
+    assert set(orders.fields.split(",")) == set(DEFAULT_ORDER_FIELDS.split(","))
+    assert set(customers.fields.split(",")) == set(DEFAULT_CUSTOMER_FIELDS.split(","))
+
+
+def test_spellings_of_the_same_query_share_a_key():
+    _, omitted = normalize_params("orders", {"status": "open"})
+    _, reordered = normalize_params("orders", {"fields": ",".join(reversed(DEFAULT_ORDER_FIELDS.split(","))), "limit": 5})
+    _, narrower = normalize_params("orders", {"fields": "id,name"})
+    assert omitted == reordered
+    assert omitted != narrower
+
+
+def test_listings_page_at_the_job_page_size():
+    filters, _ = normalize_params("orders", {"limit": 5})
+    assert filters.limit == JOB_PAGE_SIZE
+
+
+def test_unknown_resources_are_rejected():
+    with pytest.raises(ValueError):
+        normalize_params("products", {})
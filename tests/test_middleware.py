@@ -0,0 +1,106 @@
+import asyncio
+import gzip
+
+import brotli
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from server import middleware
+from server.middleware import ConditionalMiddleware, accepted_encodings, etag_matches
+
+LARGE = {"orders": [{"id": i, "name": f"#{1000 + i}"} for i in range(200)]}
+
+app = FastAPI()
+app.add_middleware(ConditionalMiddleware)
+
+
+@app.get("/large")
+async def large():
+    return LARGE
+
+
+@app.get("/small")
+async def small():
+    return {"id": 1}
+
+
+@app.get("/stream")
+async def stream():
+    return StreamingResponse(iter([b"a" * 2000, b"b" * 2000]), media_type="application/x-ndjson")
+
+
+def get(path: str, **headers) -> tuple[httpx.Response, bytes]:
+    # Returns the body as sent; httpx would otherwise decode it for us
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            request = client.build_request("GET", path, headers={"Accept-Encoding": "identity", **headers})
+            response = await client.send(request, stream=True)
+            raw = b"".join([chunk async for chunk in response.aiter_raw()])
+            await response.aclose()
+            return response, raw
+
+    return asyncio.run(scenario())
+
+
+def test_accept_encoding_is_parsed_with_qualities():
+    assert accepted_encodings("gzip, br;q=0.8, deflate;q=0") == {"gzip", "br"}
+    assert accepted_encodings("identity") == {"identity"}
+    assert accepted_encodings("br;q=nonsense") == set()
+
+
+def test_etags_compare_weakly():
+    assert etag_matches('W/"abc"', 'W/"abc"')
+    assert etag_matches('"other", "abc"', 'W/"abc"')
+    assert etag_matches("*", 'W/"abc"')
+    assert not etag_matches("", 'W/"abc"')
+    assert not etag_matches('W/"other"', 'W/"abc"')
+
+
+def test_a_matching_etag_gets_a_304():
+    response, raw = get("/large")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+    assert response.headers["Vary"] == "Accept-Encoding"
+
+    not_modified, raw = get("/large", **{"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert raw == b""
+    assert not_modified.headers["ETag"] == etag
+
+    changed, _ = get("/large", **{"If-None-Match": 'W/"stale"'})
+    assert changed.status_code == 200
+
+
+def test_the_preferred_encoding_is_negotiated():
+    identity, plain = get("/large")
+    assert "Content-Encoding" not in identity.headers
+
+    br, raw = get("/large", **{"Accept-Encoding": "gzip, br"})
+    assert br.headers["Content-Encoding"] == "br"
+    assert brotli.decompress(raw) == plain
+    assert int(br.headers["Content-Length"]) == len(raw) < len(plain)
+
+    gzipped, raw = get("/large", **{"Accept-Encoding": "gzip, br;q=0"})
+    assert gzipped.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(raw) == plain
+    # The ETag names the content, whatever encoding it was sent in
+    assert identity.headers["ETag"] == br.headers["ETag"] == gzipped.headers["ETag"]
+
+
+def test_gzip_is_used_when_brotli_is_missing(monkeypatch):
+    monkeypatch.setattr(middleware, "brotli", None)
+    response, _ = get("/large", **{"Accept-Encoding": "gzip, br"})
+    assert response.headers["Content-Encoding"] == "gzip"
+
+
+def test_small_and_streamed_bodies_are_left_alone():
+    small, _ = get("/small", **{"Accept-Encoding": "gzip, br"})
+    assert "Content-Encoding" not in small.headers
+    assert "ETag" in small.headers
+
+    streamed, raw = get("/stream", **{"Accept-Encoding": "gzip, br"})
+    assert "Content-Encoding" not in streamed.headers
+    assert "ETag" not in streamed.headers
+    assert raw == b"a" * 2000 + b"b" * 2000
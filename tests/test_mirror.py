@@ -0,0 +1,89 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from models.shopify_api import OrderCountUrlParams, OrderUrlParams
+from services import webhooks
+from services.mirror import Mirror
+from services.webhooks import WebhookEvent, WebhookProcessor
+
+SHOP = "mirror-test.myshopify.com"
+ORDERS = [
+    {"id": 1, "created_at": "2023-05-01T10:00:00Z"},
+    {"id": 2, "created_at": "2023-05-02T10:00:00Z", "closed_at": "2023-05-03T10:00:00Z"},
+    {"id": 3, "created_at": "2023-05-03T10:00:00Z", "cancelled_at": "2023-05-04T10:00:00Z"},
+    {"id": 4, "created_at": "2023-05-04T10:00:00Z", "cancelled_at": "2023-05-05T10:00:00Z", "closed_at": "2023-05-05T10:00:00Z"},
+]
+
+
+def iso(value: float) -> str:
+    return datetime.fromtimestamp(value, timezone.utc).isoformat()
+
+
+def count(mirror: Mirror, status: str) -> int:
+    return mirror._count_orders(SHOP, OrderCountUrlParams(status=status))
+
+
+def test_order_status_filters_match_shopify(tmp_path):
+    mirror = Mirror(str(tmp_path / "mirror.db"), enabled=True)
+    asyncio.run(mirror.upsert_orders(SHOP, ORDERS))
+    assert count(mirror, "any") == 4
+    assert count(mirror, "open") == 1
+    # Closed means archived, whether or not the order was also cancelled
+    assert count(mirror, "closed") == 2
+
+
+def test_delete_webhooks_remove_records_from_the_mirror(tmp_path, monkeypatch):
+    mirror = Mirror(str(tmp_path / "mirror.db"), enabled=True)
+    monkeypatch.setattr(webhooks, "mirror", mirror)
+    processor = WebhookProcessor()
+    deleted = []
+
+    async def on_delete(shop, ids):
+        deleted.append((shop, ids))
+
+    mirror.add_customer_delete_hook(on_delete)
+
+    async def scenario():
+        await mirror.upsert_orders(SHOP, ORDERS)
+        await mirror.upsert_customers(SHOP, [{"id": 7}, {"id": 8}])
+        await processor.apply(WebhookEvent(shop=SHOP, topic="orders/delete", payload={"id": 2}))
+        await processor.apply(WebhookEvent(shop=SHOP, topic="customers/delete", payload={"id": 7}))
+        return await mirror.get_customer_records(SHOP, [7, 8])
+
+    assert list(asyncio.run(scenario())) == [8]
+    assert count(mirror, "any") == 3
+    assert deleted == [(SHOP, [7])]
+    assert processor.stats.applied == 2
+
+
+def test_a_record_changed_mid_sync_is_fetched_by_the_next_sync(tmp_path):
+    mirror = Mirror(str(tmp_path / "mirror.db"), enabled=True)
+    store = {1: {"id": 1, "updated_at": time.time() - 100}}
+    watermarks = []
+
+    async def records(watermark):
+        watermarks.append(watermark)
+        # Paged by id, so a change to a record on an earlier page isn't seen until the next sync
+        record_id = 0
+        while any(i > record_id for i in store):
+            record_id = min(i for i in store if i > record_id)
+            record = store[record_id]
+            if watermark is None or record["updated_at"] >= watermark:
+                yield {**record, "updated_at": iso(record["updated_at"])}
+            if record_id == 1 and len(watermarks) == 1:
+                # Order 1 changes after its page was read; order 2 appears later on
+                store[1] = {"id": 1, "updated_at": time.time(), "note": "changed"}
+                store[2] = {"id": 2, "updated_at": time.time() + 5}
+
+    async def upsert(shop, batch):
+        await mirror.upsert_orders(shop, batch)
+
+    async def scenario():
+        await mirror._sync(SHOP, "orders", records, upsert)
+        await mirror._sync(SHOP, "orders", records, upsert)
+        return await mirror.run(mirror._order_records, SHOP, OrderUrlParams(status="any"))
+
+    orders = asyncio.run(scenario())
+    assert watermarks[1] <= store[1]["updated_at"]
+    assert {order["id"]: order.get("note") for order in orders} == {1: "changed", 2: None}
@@ -0,0 +1,42 @@
+import asyncio
+
+import httpx
+
+from server import main
+from services.tenants import Tenants, TenantStore
+
+
+def get(path: str, token: str = None) -> httpx.Response:
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            headers = {"Authorization": f"Bearer {token}"} if token else {}
+            return await client.get(path, headers=headers)
+
+    return asyncio.run(scenario())
+
+
+def test_multi_tenant_stats_need_the_operator_token(monkeypatch):
+    monkeypatch.setattr(main, "MULTI_TENANT", True)
+    monkeypatch.setattr(main, "OPERATOR_TOKEN", "operator-secret")
+    for path in ("/metrics", "/cache/stats"):
+        assert get(path).status_code == 401
+        assert get(path, "a-shops-token").status_code == 401
+        assert get(path, "operator-secret").status_code == 200
+
+
+def test_multi_tenant_stats_are_off_without_an_operator_token(monkeypatch):
+    monkeypatch.setattr(main, "MULTI_TENANT", True)
+    monkeypatch.setattr(main, "OPERATOR_TOKEN", None)
+    assert get("/metrics", "anything").status_code == 401
+
+
+def test_a_valid_shop_token_is_not_an_operator_token(monkeypatch, tmp_path):
+    store = TenantStore(str(tmp_path / "tenants.db"))
+    shop_key = store.create_api_key(store.add_shop("tenant.myshopify.com", "shpat_tenant"))
+    monkeypatch.setattr(main, "tenants", Tenants(store))
+    monkeypatch.setattr(main, "MULTI_TENANT", True)
+    monkeypatch.setattr(main, "OPERATOR_TOKEN", "operator-secret")
+    assert asyncio.run(main.tenants.resolve(shop_key)) is not None
+    for path in ("/metrics", "/cache/stats"):
+        assert get(path, shop_key).status_code == 401
@@ -0,0 +1,54 @@
+import asyncio
+
+from services.cache import response_cache
+from services.prefetch import Prefetcher
+
+SHOP = "prefetch-test.myshopify.com"
+
+
+def prefetcher_with(monkeypatch, release: asyncio.Event = None):
+    prefetcher = Prefetcher(enabled=True)
+    monkeypatch.setattr(prefetcher, "has_headroom", lambda shop: True)
+
+    async def fetch_batch(shop_api_key, shop, ids, fields):
+        if release is not None:
+            await release.wait()
+        records = [{"id": i, "email": f"{i}@example.com", "tags": "vip"} for i in ids]
+        for record in records:
+            await response_cache.set(shop, "customer", record["id"], fields, record)
+        return {"customers": records}
+
+    return prefetcher, fetch_batch
+
+
+def test_a_lookup_served_from_the_prefetched_entry_is_a_hit(monkeypatch):
+    prefetcher, fetch_batch = prefetcher_with(monkeypatch)
+
+    async def scenario():
+        await prefetcher.fetch("shpat_test", SHOP, "customer", [1, 2], "id,email,tags", fetch_batch)
+        await prefetcher.record_lookup(SHOP, "customer", 1, "email")
+        # Wants a field the prefetch didn't fetch, so Shopify serves it anyway
+        await prefetcher.record_lookup(SHOP, "customer", 2, "email,note")
+        await response_cache.clear_shop(SHOP)
+
+    asyncio.run(scenario())
+    stats = prefetcher.stats.as_dict()
+    assert (stats["fetched"], stats["hits"], stats["wasted"]) == (2, 1, 1)
+    assert stats["wasted_calls"] == 0
+
+
+def test_a_lookup_during_the_prefetch_is_not_a_hit(monkeypatch):
+    release = asyncio.Event()
+    prefetcher, fetch_batch = prefetcher_with(monkeypatch, release)
+
+    async def scenario():
+        task = asyncio.create_task(prefetcher.fetch("shpat_test", SHOP, "customer", [3], "id,email", fetch_batch))
+        await asyncio.sleep(0)
+        await prefetcher.record_lookup(SHOP, "customer", 3, "email")
+        release.set()
+        await task
+        await response_cache.clear_shop(SHOP)
+
+    asyncio.run(scenario())
+    assert prefetcher.stats.hits == 0
+    assert prefetcher.stats.fetched == 1
@@ -0,0 +1,122 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from services import rate_limit
+from services.rate_limit import CallLimitBucket, Priority, parse_call_limit, parse_retry_after, retry_delay
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+async def settle():
+    # Lets the dispatcher run until it is waiting again
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_headers_are_parsed():
+    assert parse_call_limit("39/40") == (39, 40)
+    assert parse_call_limit("garbage") is None
+    assert parse_call_limit(None) is None
+    assert parse_retry_after("2.5") == 2.5
+    assert parse_retry_after("-1") == 0.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") is None
+
+
+def test_retry_delay_honours_retry_after_and_caps_the_backoff(monkeypatch):
+    monkeypatch.setattr(rate_limit.random, "uniform", lambda low, high: high)
+    assert retry_delay(0, retry_after=3) == 3
+    assert retry_delay(0) == rate_limit.SHOPIFY_RETRY_BACKOFF
+    assert retry_delay(2) == rate_limit.SHOPIFY_RETRY_BACKOFF * 4
+    assert retry_delay(50) == rate_limit.SHOPIFY_RETRY_BACKOFF_MAX
+
+
+def test_the_bucket_leaks_at_its_rate(clock):
+    bucket = CallLimitBucket(capacity=10, leak_rate=2, reserve=2)
+    bucket.used = 10
+    clock.now += 1.5
+    assert bucket.available == 3
+    clock.now += 10
+    assert bucket.available == 10
+
+
+def test_the_reserve_is_only_for_interactive_calls(clock):
+    bucket = CallLimitBucket(capacity=10, leak_rate=2, reserve=2)
+    bucket.used = 8
+    assert bucket._delay(Priority.INTERACTIVE) == 0
+    assert bucket._delay(Priority.NORMAL) == 0.5
+    assert bucket._delay(Priority.BULK) == 0.5
+    assert not bucket.try_acquire()
+    assert bucket.spare == 0
+    clock.now += 1
+    assert bucket.spare == 2
+    assert bucket.try_acquire()
+    assert bucket.in_flight == 1
+
+
+def test_queued_calls_are_granted_in_priority_order(clock):
+    bucket = CallLimitBucket(capacity=4, leak_rate=2, reserve=1)
+    granted = []
+
+    async def call(priority: Priority):
+        await bucket.acquire(priority)
+        granted.append(priority)
+
+    async def scenario():
+        bucket.used = 4
+        tasks = [asyncio.create_task(call(priority)) for priority in (Priority.BULK, Priority.NORMAL, Priority.INTERACTIVE)]
+        await settle()
+        assert granted == []
+        # A queued call holds back try_acquire even with budget to spare
+        assert not bucket.try_acquire()
+
+        # One call has leaked: enough for the interactive call, which may use the reserve
+        clock.now += 0.5
+        bucket._wakeup.set()
+        await settle()
+        assert granted == [Priority.INTERACTIVE]
+
+        clock.now += 10
+        bucket._wakeup.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert granted == [Priority.INTERACTIVE, Priority.NORMAL, Priority.BULK]
+
+
+def test_retry_after_blocks_every_caller_until_it_passes(clock):
+    bucket = CallLimitBucket(capacity=40, leak_rate=20, reserve=5)
+    bucket.block(2)
+    assert bucket._delay(Priority.INTERACTIVE) == 2
+    assert bucket.spare == 0
+    assert not bucket.try_acquire()
+    clock.now += 1
+    assert bucket._delay(Priority.INTERACTIVE) == 1
+    clock.now += 1
+    # The block also filled the bucket, and it has leaked 40 calls since
+    assert bucket._delay(Priority.INTERACTIVE) == 0
+    assert bucket.available == 40
+
+
+def test_shopify_headers_correct_the_count_for_calls_in_flight(clock):
+    bucket = CallLimitBucket(capacity=40, leak_rate=2, reserve=5)
+    assert bucket.try_acquire()
+    assert bucket.try_acquire()
+    bucket.release({rate_limit.CALL_LIMIT_HEADER: "30/80"})
+    assert bucket.capacity == 80
+    assert bucket.used == 31
+    assert bucket.in_flight == 1
@@ -0,0 +1,132 @@
+import asyncio
+import json
+
+from services import search_index
+from services.mirror import Mirror
+from services.search_index import (
+    EXACT,
+    FUZZY,
+    INFIX,
+    PREFIX,
+    CustomerIndex,
+    SearchIndex,
+    parse_query,
+    tokenize,
+)
+
+SHOP = "search-test.myshopify.com"
+CUSTOMERS = [
+    {"id": 1, "first_name": "Anna", "last_name": "Müller", "email": "anna@example.com", "tags": "vip, wholesale",
+     "orders_count": 5, "total_spent": "250.00", "created_at": "2023-01-01T00:00:00Z", "updated_at": "2023-05-01T00:00:00Z"},
+    {"id": 2, "first_name": "Ben", "last_name": "Johnson", "email": "ben@mail.test", "tags": "newsletter",
+     "orders_count": 2, "total_spent": "40.00", "created_at": "2023-02-01T00:00:00Z", "updated_at": "2023-05-02T00:00:00Z"},
+    {"id": 3, "first_name": "Annabel", "last_name": "Smith", "email": "annabel@example.com", "tags": "",
+     "orders_count": None, "total_spent": None, "created_at": "2023-03-01T00:00:00Z", "updated_at": "2023-05-03T00:00:00Z"},
+    {"id": 4, "first_name": "Carl", "last_name": "Anderson", "email": "carl@shop.test", "note": "Ask for Anna",
+     "orders_count": 9, "total_spent": "900.00", "created_at": "2023-04-01T00:00:00Z", "updated_at": "2023-05-04T00:00:00Z"},
+]
+
+
+def build(customers: list[dict] = CUSTOMERS) -> CustomerIndex:
+    index = CustomerIndex()
+    for customer in customers:
+        index.add_customer(customer)
+    return index
+
+
+def search(index: CustomerIndex, query: str, order_field: str = "id", descending: bool = False, limit: int = 10) -> list[int]:
+    return index.search(parse_query(query), order_field, descending, limit)
+
+
+def test_text_is_tokenized_without_case_or_accents():
+    assert tokenize("Müller-Smith, VIP") == ("muller", "smith", "vip")
+    assert tokenize(None) == ()
+    assert tokenize(42) == ("42",)
+
+
+def test_queries_parse_into_field_restricted_tokens():
+    assert parse_query('tag:vip "Anna Smith"') == [(("tags",), "vip"), (None, "anna"), (None, "smith")]
+    assert parse_query("name:ben") == [(("first_name", "last_name"), "ben")]
+    assert parse_query(None) == []
+    # Syntax only Shopify can evaluate
+    assert parse_query("anna OR ben") is None
+    assert parse_query("-vip") is None
+    assert parse_query("country:US") is None
+
+
+def test_tokens_match_exactly_by_prefix_by_infix_and_by_typo():
+    index = build()
+    assert index.match("anna") == {"anna": EXACT, "annabel": PREFIX}
+    assert index.match("nders") == {"anderson": INFIX}
+    fuzzy = index.match("jonson")
+    assert list(fuzzy) == ["johnson"]
+    assert FUZZY * search_index.FUZZY_THRESHOLD <= fuzzy["johnson"] < FUZZY
+    # Typos are only tried when nothing matches as typed
+    assert index.match("johnso") == {"johnson": PREFIX}
+
+
+def test_every_term_must_match_and_fields_restrict_where():
+    index = build()
+    assert search(index, "anna") == [1, 3, 4]
+    assert search(index, "anna example") == [1, 3]
+    assert search(index, "first_name:anna") == [1, 3]
+    assert search(index, "tag:vip") == [1]
+    assert search(index, "nobody") == []
+
+
+def test_results_are_ordered_by_the_sort_field_then_relevance():
+    index = build()
+    # Orders count descending; a customer without one comes last either way
+    assert search(index, "", "orders_count", descending=True) == [4, 1, 2, 3]
+    assert search(index, "", "orders_count") == [2, 1, 4, 3]
+    assert search(index, "", "total_spent", descending=True, limit=2) == [4, 1]
+    # Equal sort values fall back to relevance: Anna's first name outweighs Carl's note
+    tied = build([{**customer, "orders_count": 1} for customer in CUSTOMERS])
+    assert search(tied, "anna", "orders_count") == [1, 3, 4]
+
+
+def test_an_index_round_trips_through_its_saved_form():
+    index = build()
+    index.remove(2)
+    restored = CustomerIndex.from_dict(json.loads(json.dumps(index.to_dict())))
+    assert len(restored) == 3
+    assert restored.watermark == index.watermark
+    for query, order_field in [("anna", "id"), ("nders", "id"), ("", "orders_count"), ("ben", "id")]:
+        assert search(restored, query, order_field) == search(index, query, order_field)
+    assert sorted(restored.postings) == sorted(index.postings)
+
+
+def test_updates_replace_a_customers_terms_and_removals_drop_them():
+    index = build()
+    index.add_customer({**CUSTOMERS[1], "email": "benjamin@example.org"})
+    assert search(index, "benjamin") == [2]
+    assert search(index, "mail") == []
+    assert "mail" not in index.vocabulary
+
+    index.remove(2)
+    assert search(index, "ben") == []
+    assert "johnson" not in index.postings
+    assert not any("johnson" in terms for terms in index.grams.values())
+    assert len(index) == 3
+
+
+def test_changes_made_while_an_index_loads_are_not_lost(tmp_path, monkeypatch):
+    store = Mirror(str(tmp_path / "mirror.db"), enabled=True)
+    monkeypatch.setattr(search_index, "mirror", store)
+    index = SearchIndex(str(tmp_path / "index"), enabled=True)
+    get_customers_since = store.get_customers_since
+
+    async def racing_catch_up(shop, updated_at):
+        # The catch-up reads the mirror, and then a webhook lands before it's indexed
+        customers = await get_customers_since(shop, updated_at)
+        await store.upsert_customers(shop, [{**CUSTOMERS[0], "email": "anna@new.example"}])
+        await store.delete_customers(shop, [2])
+        return customers
+
+    async def scenario():
+        await store.upsert_customers(SHOP, CUSTOMERS)
+        monkeypatch.setattr(store, "get_customers_since", racing_catch_up)
+        loaded = await index.get_index(SHOP)
+        return search(loaded, "new"), search(loaded, "ben"), index._changes
+
+    assert asyncio.run(scenario()) == ([1], [], {})
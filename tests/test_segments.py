@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from services import segments
+from services.segments import (
+    CustomerMetrics,
+    SegmentSnapshot,
+    SegmentWorker,
+    ShopSegments,
+    quintile_scores,
+    segment_for,
+)
+
+SHOP = "segments-test.myshopify.com"
+
+
+def order(order_id: int, customer_id: int, total_price: str, **extra) -> dict:
+    return {
+        "id": order_id,
+        "customer": {"id": customer_id},
+        "created_at": f"2023-05-01T10:00:{order_id % 60:02d}Z",
+        "updated_at": f"2023-05-01T10:00:{order_id % 60:02d}Z",
+        "total_price": total_price,
+        **extra,
+    }
+
+
+def seeded(customer_id: int = 1, last_order_id: int = 100) -> CustomerMetrics:
+    metrics = CustomerMetrics()
+    metrics.seed({"id": customer_id, "orders_count": 1, "total_spent": "10.00", "last_order_id": last_order_id})
+    return metrics
+
+
+def test_scores_and_the_rfm_grid():
+    assert list(quintile_scores([1, 1, 1, 2, 9])) == [1, 1, 1, 4, 5]
+    assert segment_for(5, 5) == "champions"
+    assert segment_for(5, 1) == "new"
+    assert segment_for(4, 1) == "promising"
+    assert segment_for(1, 5) == "cant_lose"
+    assert segment_for(1, 1) == "hibernating"
+    assert segment_for(3, 3) == "need_attention"
+
+
+def test_fold_adds_new_orders_and_skips_ones_already_counted():
+    metrics = seeded()
+    assert metrics.fold(order(101, 1, "7.00"))
+    assert not metrics.fold(order(101, 1, "7.00"))
+    assert not metrics.fold(order(99, 1, "3.00"))
+    assert not metrics.fold(order(102, 1, "5.00", cancelled_at="2023-05-02T00:00:00Z"))
+    assert not metrics.fold({"id": 103, "total_price": "1.00"})
+    row = metrics.rows[1]
+    assert (metrics.orders_count[row], metrics.spent_cents[row], metrics.last_order_ids[row]) == (2, 1700, 101)
+
+
+def test_fold_fills_in_the_date_of_the_seeded_last_order():
+    metrics = seeded()
+    assert metrics.fold(order(100, 1, "10.00"))
+    row = metrics.rows[1]
+    assert metrics.orders_count[row] == 1
+    assert metrics.last_order_at[row] > 0
+
+
+def listing(orders, fail_after: int = None):
+    def iter_shop_orders(shop_api_key, shop_domain_name, filters):
+        async def pages():
+            for i, record in enumerate(orders):
+                if fail_after is not None and i == fail_after:
+                    raise RuntimeError("connection reset")
+                yield record
+
+        return pages()
+
+    return iter_shop_orders
+
+
+def test_a_pass_listed_newest_first_folds_every_new_order(monkeypatch):
+    # Two new orders for one customer in the same pass, as /orders.json lists them
+    monkeypatch.setattr(segments, "iter_shop_orders", listing([order(102, 1, "5.00"), order(101, 1, "7.00")]))
+    state = ShopSegments(metrics=seeded(), watermark=1.0)
+    assert asyncio.run(SegmentWorker(enabled=True).fold_orders("shpat_test", SHOP, state))
+    row = state.metrics.rows[1]
+    assert (state.metrics.orders_count[row], state.metrics.spent_cents[row]) == (3, 2200)
+    assert state.watermark > 1.0
+
+
+def test_a_failed_pass_folds_nothing_and_keeps_its_watermark(monkeypatch):
+    monkeypatch.setattr(segments, "iter_shop_orders", listing([order(102, 1, "5.00"), order(101, 1, "7.00")], fail_after=1))
+    state = ShopSegments(metrics=seeded(), watermark=1.0)
+    with pytest.raises(RuntimeError):
+        asyncio.run(SegmentWorker(enabled=True).fold_orders("shpat_test", SHOP, state))
+    assert state.watermark == 1.0
+    assert state.metrics.orders_count[state.metrics.rows[1]] == 1
+
+
+def test_snapshots_rank_customers_within_segments():
+    metrics = CustomerMetrics()
+    for customer_id, orders_count, spent in [(1, 10, "500.00"), (2, 1, "20.00"), (3, 0, "0.00"), (4, 3, "90.00")]:
+        metrics.seed({"id": customer_id, "orders_count": orders_count, "total_spent": spent, "last_order_id": customer_id * 10 if orders_count else None})
+        metrics.set_last_order_at(customer_id * 10, 1_700_000_000.0 + customer_id, customer_id)
+    snapshot = SegmentSnapshot(metrics, 1_700_000_000.0)
+
+    top = snapshot.top("total_spent", limit=2)
+    assert [customer["id"] for customer in top["customers"]] == [1, 4]
+    assert top["customers"][0]["total_spent"] == "500.00"
+    assert snapshot.top("orders_count", segment="prospects")["customers"][0]["id"] == 3
+    counts = {item["segment"]: item["count"] for item in snapshot.segments_dict()["segments"]}
+    assert sum(counts.values()) == 4
+    assert counts["prospects"] == 1
+    with pytest.raises(ValueError):
+        snapshot.top("name")
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import signal
+import socket
+
+import httpx
+import pytest
+from gunicorn import glogging
+from gunicorn.config import Config as GunicornConfig
+from uvicorn import Config
+
+from server import serve
+from server.serve import DrainingServer, Worker
+from services.warmup import readiness
+
+
+@pytest.fixture(autouse=True)
+def fresh_readiness(monkeypatch):
+    monkeypatch.setattr(readiness, "warmed", True)
+    monkeypatch.setattr(readiness, "draining", False)
+    monkeypatch.setattr(serve, "SHUTDOWN_DRAIN_DELAY", 0.05)
+
+
+async def app(scope, receive, send):
+    if scope["type"] != "http":
+        return
+    await send({"type": "http.response.start", "status": 200 if readiness.ready else 503, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+def test_the_first_signal_drains_before_the_server_exits():
+    async def scenario():
+        server = DrainingServer(Config(app=app))
+        server.handle_exit(signal.SIGTERM, None)
+        draining = (server.should_exit, readiness.draining, readiness.ready)
+        await asyncio.sleep(0.1)
+        return draining, server.should_exit
+
+    assert asyncio.run(scenario()) == ((False, True, False), True)
+
+
+def test_a_second_signal_or_a_quick_shutdown_exits_at_once(monkeypatch):
+    async def scenario():
+        server = DrainingServer(Config(app=app))
+        server.handle_exit(signal.SIGTERM, None)
+        server.handle_exit(signal.SIGTERM, None)
+        second = server.should_exit
+
+        readiness.draining = False
+        quick = DrainingServer(Config(app=app))
+        quick.handle_exit(signal.SIGQUIT, None)
+        return second, quick.should_exit
+
+    assert asyncio.run(scenario()) == (True, True)
+
+    monkeypatch.setattr(serve, "SHUTDOWN_DRAIN_DELAY", 0)
+    readiness.draining = False
+    server = DrainingServer(Config(app=app))
+    server.handle_exit(signal.SIGTERM, None)
+    assert server.should_exit
+    assert not readiness.draining
+
+
+def test_a_worker_keeps_serving_while_it_drains():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    port = listener.getsockname()[1]
+    cfg = GunicornConfig()
+    worker = Worker(0, os.getpid(), [listener], app=None, timeout=30, cfg=cfg, log=glogging.Logger(cfg))
+    worker.wsgi = app
+
+    async def ready(client: httpx.AsyncClient) -> int:
+        return (await client.get(f"http://127.0.0.1:{port}/ready")).status_code
+
+    async def scenario():
+        serving = asyncio.create_task(worker.serve())
+        async with httpx.AsyncClient() as client:
+            for _ in range(100):
+                try:
+                    before = await ready(client)
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.01)
+            # The server's own SIGTERM handler, as gunicorn's arbiter would trigger it
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.sleep(0.01)
+            during = await ready(client)
+        await asyncio.wait_for(serving, 5)
+        return before, during
+
+    try:
+        assert asyncio.run(scenario()) == (200, 503)
+    finally:
+        listener.close()
@@ -0,0 +1,158 @@
+import asyncio
+
+import httpx
+import pytest
+
+from services import deadline, http_client, shopify
+from services.rate_limit import CallLimitBucket, SHOPIFY_MAX_RETRIES
+
+
+class FakeShopify:
+    # Answers each request with the next queued response; an exception is raised instead
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests: list[httpx.Request] = []
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        response = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+
+    async def sleep(seconds: float):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(deadline, "sleep", sleep)
+    return sleeps
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    # Leaks fast enough that a full bucket never holds a test up
+    bucket = CallLimitBucket(capacity=40, leak_rate=10000, reserve=5)
+    monkeypatch.setattr(shopify, "get_bucket", lambda shop_domain_name: bucket)
+    return bucket
+
+
+def use(monkeypatch, fake: FakeShopify):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(fake.handler), base_url="https://test.myshopify.com")
+    monkeypatch.setattr(shopify, "get_client", lambda shop_domain_name: client)
+
+
+def request(endpoint: str = "/orders.json", method: str = "GET") -> httpx.Response:
+    return asyncio.run(shopify.authenticated_api_response("shpat_test", "client-test.myshopify.com", endpoint, method))
+
+
+def test_server_errors_are_retried_with_backoff(monkeypatch, sleeps, bucket):
+    fake = FakeShopify(httpx.Response(503), httpx.Response(502), httpx.Response(200, json={"orders": []}))
+    use(monkeypatch, fake)
+    response = request()
+    assert response.json() == {"orders": []}
+    assert len(fake.requests) == 3
+    assert len(sleeps) == 2
+    assert fake.requests[0].headers["X-Shopify-Access-Token"] == "shpat_test"
+
+
+def test_retry_after_is_honoured(monkeypatch, sleeps, bucket):
+    fake = FakeShopify(httpx.Response(503, headers={"Retry-After": "1.5"}), httpx.Response(200, json={}))
+    use(monkeypatch, fake)
+    assert request().status_code == 200
+    assert sleeps == [1.5]
+
+
+def test_a_429_blocks_the_bucket_instead_of_sleeping(monkeypatch, sleeps, bucket):
+    fake = FakeShopify(httpx.Response(429, headers={"Retry-After": "0.01"}), httpx.Response(200, json={}))
+    use(monkeypatch, fake)
+    assert request().status_code == 200
+    assert sleeps == []
+    assert bucket.blocked_until > 0
+    assert len(fake.requests) == 2
+
+
+def test_retries_give_up_after_the_limit(monkeypatch, sleeps, bucket):
+    fake = FakeShopify(httpx.Response(500))
+    use(monkeypatch, fake)
+    with pytest.raises(httpx.HTTPStatusError):
+        request()
+    assert len(fake.requests) == SHOPIFY_MAX_RETRIES + 1
+    assert bucket.in_flight == 0
+
+
+def test_dropped_connections_are_only_replayed_for_gets(monkeypatch, sleeps, bucket):
+    fake = FakeShopify(httpx.ConnectError("reset"), httpx.Response(200, json={}))
+    use(monkeypatch, fake)
+    assert request().status_code == 200
+    assert len(fake.requests) == 2
+
+    fake = FakeShopify(httpx.ConnectError("reset"), httpx.Response(201, json={}))
+    use(monkeypatch, fake)
+    with pytest.raises(httpx.ConnectError):
+        request(method="POST")
+    assert len(fake.requests) == 1
+    assert bucket.in_flight == 0
+
+
+def test_server_errors_are_only_retried_for_gets_but_429s_for_every_method(monkeypatch, sleeps, bucket):
+    fake = FakeShopify(httpx.Response(502), httpx.Response(201, json={}))
+    use(monkeypatch, fake)
+    assert request(method="POST").status_code == 502
+    assert len(fake.requests) == 1
+    assert sleeps == []
+
+    fake = FakeShopify(httpx.Response(429, headers={"Retry-After": "0.01"}), httpx.Response(201, json={}))
+    use(monkeypatch, fake)
+    assert request(method="POST").status_code == 201
+    assert len(fake.requests) == 2
+
+
+def test_call_limit_headers_update_the_bucket(monkeypatch, sleeps, bucket):
+    fake = FakeShopify(httpx.Response(200, json={}, headers={"X-Shopify-Shop-Api-Call-Limit": "12/80"}))
+    use(monkeypatch, fake)
+    request()
+    assert bucket.capacity == 80
+    assert 0 <= bucket.used <= 12
+
+
+def test_each_shop_gets_one_pooled_client(monkeypatch):
+    monkeypatch.setattr(http_client, "SHOPIFY_BASE_URL", None)
+
+    async def scenario():
+        first = http_client.get_client("a.myshopify.com")
+        again = http_client.get_client("a.myshopify.com")
+        other = http_client.get_client("b.myshopify.com")
+        await http_client.close_client("a.myshopify.com")
+        reopened = http_client.get_client("a.myshopify.com")
+        result = (first is again, first is other, first.is_closed, reopened is first, str(other.base_url))
+        await http_client.close_clients()
+        return result
+
+    assert asyncio.run(scenario()) == (True, False, True, False, "https://b.myshopify.com")
+    assert http_client._clients == {}
+
+
+def test_a_failed_ids_chunk_is_reported_against_its_ids(monkeypatch):
+    single_lookups = []
+
+    async def list_by_ids(ids, fetch_fields):
+        if 2 in ids:
+            raise httpx.ConnectError("reset")
+        return [{"id": i, "name": f"#{1000 + i}"} for i in ids]
+
+    async def get_cached_resource(*args):
+        single_lookups.append(args)
+        return {}
+
+    monkeypatch.setattr(shopify, "SHOPIFY_IDS_PER_REQUEST", 2)
+    monkeypatch.setattr(shopify, "get_cached_resource", get_cached_resource)
+    data = asyncio.run(shopify.get_cached_resources(
+        "shpat_test", "chunks-test.myshopify.com", "order", [1, 2, 3, 4], "id,name", list_by_ids
+    ))
+    assert [order["id"] for order in data["orders"]] == [3, 4]
+    assert data["errors"] == [{"id": 1, "detail": "reset"}, {"id": 2, "detail": "reset"}]
+    assert single_lookups == []
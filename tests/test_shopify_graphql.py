@@ -0,0 +1,189 @@
+import asyncio
+import json
+import re
+from datetime import datetime
+
+import httpx
+import pytest
+
+from models.shopify_api import OrderUrlParams
+from services import deadline, shopify_graphql
+from services.deadline import DeadlineExceeded, deadline_scope
+from services.rate_limit import CallLimitBucket
+from services.shopify_graphql import GraphQLBatcher, convert_node, get_nodes, graphql_request, order_filters_to_search_query
+
+NODE = re.compile(r'(r\d+): (order|customer)\(id: "gid://shopify/\w+/(\d+)"\)')
+COST = {
+    "requestedQueryCost": 10,
+    "actualQueryCost": 5,
+    "throttleStatus": {"maximumAvailable": 1000.0, "currentlyAvailable": 990, "restoreRate": 50.0},
+}
+
+
+class RecordingBucket(CallLimitBucket):
+    def __init__(self):
+        super().__init__(capacity=1000, leak_rate=10000, reserve=0)
+        self.blocks = []
+
+    def block(self, seconds: float):
+        # Recorded rather than honoured, so a throttled retry doesn't hold the test up
+        self.blocks.append(seconds)
+
+
+class FakeGraphQL:
+    # Answers aliased node lookups for any id below 100; responses queued up front go first
+    def __init__(self, *responses, delay: float = 0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.queries: list[str] = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        query = json.loads(request.content)["query"]
+        self.queries.append(query)
+        await asyncio.sleep(self.delay)
+        if self.responses:
+            return self.responses.pop(0)
+        data = {
+            alias: {"id": f"gid://shopify/{resource.capitalize()}/{node_id}", "name": f"#{node_id}"}
+            if int(node_id) < 100 else None
+            for alias, resource, node_id in NODE.findall(query)
+        }
+        return httpx.Response(200, json={"data": data, "extensions": {"cost": COST}})
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    bucket = RecordingBucket()
+    monkeypatch.setattr(shopify_graphql, "get_cost_bucket", lambda shop_domain_name: bucket)
+    return bucket
+
+
+@pytest.fixture(autouse=True)
+def no_margin(monkeypatch):
+    monkeypatch.setattr(deadline, "DEADLINE_FALLBACK_MARGIN", 0)
+
+
+def use(monkeypatch, fake: FakeGraphQL):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(fake.handler), base_url="https://test.myshopify.com")
+    monkeypatch.setattr(shopify_graphql, "get_client", lambda shop_domain_name: client)
+
+
+def test_nodes_are_converted_to_their_rest_shape():
+    node = {
+        "id": "gid://shopify/Order/12",
+        "currencyCode": "EUR",
+        "totalPriceSet": {"shopMoney": {"amount": "10.50"}},
+        "displayFinancialStatus": "PARTIALLY_REFUNDED",
+        "displayFulfillmentStatus": "PARTIALLY_FULFILLED",
+        "tags": ["gift", "vip"],
+        "totalWeight": "250",
+        "customer": {
+            "id": "gid://shopify/Customer/7",
+            "numberOfOrders": "3",
+            "amountSpent": {"amount": "30.0"},
+            "lastOrder": {"id": "gid://shopify/Order/12", "name": "#1012"},
+        },
+    }
+    fields = "id,currency,total_price,financial_status,fulfillment_status,tags,total_weight,customer,source_url"
+    assert convert_node("order", node, fields) == {
+        "id": 12,
+        "currency": "EUR",
+        "financial_status": "partially_refunded",
+        "fulfillment_status": "partial",
+        "tags": "gift, vip",
+        "total_price": "10.50",
+        "total_weight": 250,
+        "customer": {
+            "id": 7,
+            "email": None,
+            "accepts_marketing": None,
+            "accepts_marketing_updated_at": None,
+            "created_at": None,
+            "updated_at": None,
+            "orders_count": 3,
+            "state": None,
+            "total_spent": "30.0",
+            "last_order_id": 12,
+            "last_order_name": "#1012",
+            "note": None,
+            "verified_email": None,
+            "tags": None,
+            "marketing_opt_in_level": None,
+            "email_marketing_consent": None,
+            "sms_marketing_consent": None,
+        },
+    }
+    assert convert_node("order", {"id": "gid://shopify/Order/1", "displayFulfillmentStatus": "UNFULFILLED"}, "fulfillment_status") == {
+        "id": 1,
+        "fulfillment_status": None,
+    }
+
+
+def test_order_filters_become_a_search_query():
+    filters = OrderUrlParams(
+        created_at_min=datetime(2023, 1, 1),
+        updated_at_max=datetime(2023, 2, 1, 12, 30),
+        financial_status="paid",
+        fulfillment_status="shipped",
+        status="any",
+        ids="3, 4",
+        since_id=2,
+    )
+    assert order_filters_to_search_query(filters) == (
+        "created_at:>='2023-01-01T00:00:00' AND updated_at:<='2023-02-01T12:30:00' AND financial_status:paid "
+        "AND fulfillment_status:shipped AND (id:3 OR id:4) AND id:>2"
+    )
+    assert order_filters_to_search_query(OrderUrlParams()) == "status:open"
+
+
+def test_order_filters_without_a_search_equivalent_fall_back_to_rest():
+    assert order_filters_to_search_query(OrderUrlParams(financial_status="unpaid")) is None
+    assert order_filters_to_search_query(OrderUrlParams(attribution_app_id="current")) is None
+    assert order_filters_to_search_query(OrderUrlParams(ids="1,abc")) is None
+
+
+def test_lookups_share_one_aliased_query(monkeypatch, bucket):
+    fake = FakeGraphQL()
+    use(monkeypatch, fake)
+    lookups = [("order", 1, "id,name"), ("customer", 2, "id"), ("order", 500, "id,name")]
+    records = asyncio.run(get_nodes("shpat_test", "test.myshopify.com", lookups))
+    assert records == [{"id": 1, "name": "#1"}, {"id": 2}, None]
+    assert len(fake.queries) == 1
+    assert NODE.findall(fake.queries[0]) == [("r0", "order", "1"), ("r1", "customer", "2"), ("r2", "order", "500")]
+
+
+def test_throttled_queries_wait_for_the_bucket_to_restore(monkeypatch, bucket):
+    throttle_status = {"maximumAvailable": 1000.0, "currentlyAvailable": 100, "restoreRate": 10000.0}
+    throttled = {
+        "errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+        "extensions": {"cost": {**COST, "requestedQueryCost": 400, "throttleStatus": throttle_status}},
+    }
+    fake = FakeGraphQL(httpx.Response(200, json=throttled))
+    use(monkeypatch, fake)
+    data = asyncio.run(graphql_request("shpat_test", "test.myshopify.com", 'query { r0: order(id: "gid://shopify/Order/1") { id } }', cost=5))
+    assert data == {"r0": {"id": "gid://shopify/Order/1", "name": "#1"}}
+    assert len(fake.queries) == 2
+    # 300 points short, restoring at 10000 a second
+    assert bucket.blocks == [0.03]
+    # The cost reported in the final response is the bucket's state
+    assert bucket.capacity == 1000.0
+    assert bucket.leak_rate == 50.0
+    assert bucket.in_flight == 0
+
+
+def test_a_batch_outlives_the_deadline_of_the_caller_that_started_it(monkeypatch, bucket):
+    fake = FakeGraphQL(delay=0.1)
+    use(monkeypatch, fake)
+    batcher = GraphQLBatcher("shpat_test", "test.myshopify.com")
+
+    async def impatient():
+        with deadline_scope(0.05):
+            return await batcher.load("order", 1, "id,name")
+
+    async def scenario():
+        return await asyncio.gather(impatient(), batcher.load("order", 2, "id,name"), return_exceptions=True)
+
+    first, second = asyncio.run(scenario())
+    assert isinstance(first, DeadlineExceeded)
+    assert second == {"id": 2, "name": "#2"}
+    assert len(fake.queries) == 1
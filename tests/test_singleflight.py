@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from services import deadline
+from services.deadline import DeadlineExceeded, deadline_scope, remaining
+from services.singleflight import SingleFlight
+
+
+@pytest.fixture(autouse=True)
+def no_margin(monkeypatch):
+    monkeypatch.setattr(deadline, "DEADLINE_FALLBACK_MARGIN", 0)
+
+
+def test_concurrent_callers_share_one_call():
+    flights = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"id": 1}
+
+    async def scenario():
+        return await asyncio.gather(*(flights.do("key", fetch) for _ in range(3)))
+
+    assert asyncio.run(scenario()) == [{"id": 1}] * 3
+    assert len(calls) == 1
+    assert flights.stats.as_dict() == {"calls": 1, "shared": 2}
+
+
+def test_the_call_runs_without_the_first_callers_deadline():
+    flights = SingleFlight()
+
+    async def fetch():
+        return remaining()
+
+    async def scenario():
+        with deadline_scope(5):
+            return await flights.do("key", fetch)
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_each_caller_gives_up_at_its_own_deadline():
+    flights = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.2)
+        return "done"
+
+    async def impatient():
+        with deadline_scope(0.05):
+            return await flights.do("key", fetch)
+
+    async def patient():
+        await asyncio.sleep(0.01)
+        with deadline_scope(5):
+            return await flights.do("key", fetch)
+
+    async def scenario():
+        return await asyncio.gather(impatient(), patient(), return_exceptions=True)
+
+    first, second = asyncio.run(scenario())
+    # The first caller's deadline neither fails the call nor the caller who joined it
+    assert isinstance(first, DeadlineExceeded)
+    assert second == "done"
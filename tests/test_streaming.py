@@ -0,0 +1,111 @@
+import asyncio
+
+import httpx
+import orjson
+import pytest
+
+from server import main
+from services import shopify
+from services.rate_limit import CallLimitBucket
+from services.shopify import iter_pages
+
+SHOP = "stream-test.myshopify.com"
+
+
+class PagedShopify:
+    # Serves pages of orders, each linking to the next through a page_info cursor;
+    # a page listed in hold never answers, until the request is cancelled
+    def __init__(self, pages: list[list[dict]], hold: set[int] = ()):
+        self.pages = pages
+        self.hold = hold
+        self.requested: list[str] = []
+        self.cancelled: list[int] = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requested.append(request.url.params.get("page_info", ""))
+        number = int(request.url.params.get("page_info") or 0)
+        if number in self.hold:
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                self.cancelled.append(number)
+                raise
+        headers = {}
+        if number + 1 < len(self.pages):
+            next_url = request.url.copy_set_param("page_info", str(number + 1))
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return httpx.Response(200, json={"orders": self.pages[number]}, headers=headers)
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    bucket = CallLimitBucket(capacity=40, leak_rate=10000, reserve=5)
+    monkeypatch.setattr(shopify, "get_bucket", lambda shop_domain_name: bucket)
+    return bucket
+
+
+def use(monkeypatch, fake: PagedShopify):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(fake.handler), base_url=f"https://{SHOP}")
+    monkeypatch.setattr(shopify, "get_client", lambda shop_domain_name: client)
+
+
+def test_pages_are_followed_through_the_link_header(monkeypatch, bucket):
+    fake = PagedShopify([[{"id": 1}, {"id": 2}], [{"id": 3}], [{"id": 4}]])
+    use(monkeypatch, fake)
+
+    async def scenario():
+        return [page async for page in iter_pages("shpat_test", SHOP, "/admin/api/2023-01/orders.json?limit=2", "orders")]
+
+    assert asyncio.run(scenario()) == [[{"id": 1}, {"id": 2}], [{"id": 3}], [{"id": 4}]]
+    assert fake.requested == ["", "1", "2"]
+    assert bucket.in_flight == 0
+
+
+def test_stopping_early_cancels_the_prefetched_page(monkeypatch, bucket):
+    fake = PagedShopify([[{"id": 1}], [{"id": 2}]], hold={1})
+    use(monkeypatch, fake)
+
+    async def scenario():
+        pages = iter_pages("shpat_test", SHOP, "/admin/api/2023-01/orders.json", "orders")
+        first = await pages.__anext__()
+        # Let the prefetch reach Shopify before the caller walks away
+        await asyncio.sleep(0.01)
+        await pages.aclose()
+        await asyncio.sleep(0.01)
+        # Checked before asyncio.run cancels whatever is left on the way out
+        return first, list(fake.cancelled)
+
+    assert asyncio.run(scenario()) == ([{"id": 1}], [1])
+    assert fake.requested == ["", "1"]
+    assert bucket.in_flight == 0
+
+
+def test_ndjson_reports_a_failure_in_band():
+    async def records():
+        yield {"id": 1}
+        yield {"id": 2}
+        raise httpx.HTTPStatusError("Server error", request=None, response=None)
+
+    async def scenario():
+        return [line async for line in main.ndjson_lines(records())]
+
+    assert [orjson.loads(line) for line in asyncio.run(scenario())] == [
+        {"id": 1},
+        {"id": 2},
+        {"error": "Server error"},
+    ]
+
+
+def test_orders_stream_as_ndjson(monkeypatch, bucket):
+    fake = PagedShopify([[{"id": 1}, {"id": 2}], [{"id": 3}]])
+    use(monkeypatch, fake)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/orders/stream?status=any", headers={"Authorization": "Bearer test-token"})
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [orjson.loads(line) for line in response.text.splitlines()] == [{"id": 1}, {"id": 2}, {"id": 3}]
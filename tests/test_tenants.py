@@ -0,0 +1,130 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from services import tenants as tenants_module
+from services.cache import response_cache
+from services.tenants import TENANT_INDEX_TTL, TENANT_NEGATIVE_TTL, Tenants, TenantStore
+
+SHOP = "tenant-test.myshopify.com"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class CountingStore(TenantStore):
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.lookups = 0
+
+    def find_shop(self, key: str):
+        self.lookups += 1
+        return super().find_shop(key)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(tenants_module, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CountingStore(str(tmp_path / "tenants.db"))
+
+
+def test_a_resolved_key_is_served_from_the_index_until_its_ttl(clock, store):
+    key = store.create_api_key(store.add_shop(SHOP, "shpat_test"))
+    tenants = Tenants(store)
+
+    async def scenario():
+        first = await tenants.resolve(key)
+        store.revoke_api_key(key)
+        clock.now += TENANT_INDEX_TTL - 1
+        # Revocation only shows once the indexed entry expires
+        still_indexed = await tenants.resolve(key)
+        clock.now += 2
+        return first, still_indexed, await tenants.resolve(key)
+
+    first, still_indexed, revoked = asyncio.run(scenario())
+    assert first.shopify_domain == SHOP
+    assert first.shopify_token == "shpat_test"
+    assert still_indexed == first
+    assert revoked is None
+    assert store.lookups == 2
+
+
+def test_unknown_tokens_are_remembered_briefly(clock, store):
+    shop_id = store.add_shop(SHOP, "shpat_test")
+    tenants = Tenants(store)
+
+    async def scenario():
+        results = [await tenants.resolve("guess") for _ in range(3)]
+        lookups = store.lookups
+        clock.now += TENANT_NEGATIVE_TTL + 1
+        results.append(await tenants.resolve("guess"))
+        return results, lookups
+
+    results, lookups = asyncio.run(scenario())
+    assert results == [None] * 4
+    assert lookups == 1
+    assert store.lookups == 2
+
+    # A key issued after a miss is found once the miss expires
+    key = store.create_api_key(shop_id)
+    assert asyncio.run(tenants.resolve(key)).shopify_domain == SHOP
+
+
+def test_the_index_keeps_the_most_recently_used_tokens(clock, store, monkeypatch):
+    monkeypatch.setattr(tenants_module, "TENANT_INDEX_SIZE", 2)
+    shop_id = store.add_shop(SHOP, "shpat_test")
+    keys = [store.create_api_key(shop_id) for _ in range(3)]
+    tenants = Tenants(store)
+
+    async def scenario():
+        await tenants.resolve(keys[0])
+        await tenants.resolve(keys[1])
+        await tenants.resolve(keys[0])
+        await tenants.resolve(keys[2])
+        lookups = store.lookups
+        # keys[1] was the least recently used, so it's looked up again; keys[0] isn't
+        await tenants.resolve(keys[0])
+        await tenants.resolve(keys[1])
+        return lookups
+
+    assert asyncio.run(scenario()) == 3
+    assert store.lookups == 4
+    assert tenants.stats_dict()["indexed_tokens"] == 2
+
+
+def test_idle_shops_are_evicted_and_active_ones_kept(clock, store):
+    idle_key = store.create_api_key(store.add_shop("idle.myshopify.com", "shpat_idle"))
+    active_key = store.create_api_key(store.add_shop("active.myshopify.com", "shpat_active"))
+    tenants = Tenants(store)
+
+    async def scenario():
+        await tenants.resolve(idle_key)
+        await tenants.resolve(active_key)
+        for shop in ("idle.myshopify.com", "active.myshopify.com"):
+            await response_cache.set(shop, "order", 1, None, {"id": 1})
+        clock.now += 600
+        await tenants.resolve(active_key)
+        clock.now += 400
+        await tenants.evict_idle(idle_timeout=900)
+        cached = (
+            await response_cache.peek("idle.myshopify.com", "order", 1),
+            await response_cache.peek("active.myshopify.com", "order", 1),
+        )
+        await response_cache.clear_shop("active.myshopify.com")
+        return cached
+
+    assert asyncio.run(scenario()) == (None, {"id": 1})
+    assert tenants.stats_dict()["active_shops"] == 1
+    assert list(tenants._last_seen) == ["active.myshopify.com"]
@@ -0,0 +1,90 @@
+import asyncio
+
+import httpx
+import pytest
+
+from server import main
+from services import warmup
+from services.warmup import Readiness
+
+SHOP = "warmup-test.myshopify.com"
+
+
+def test_nothing_to_warm_is_ready_at_once(monkeypatch):
+    readiness = Readiness()
+    readiness.start()
+    assert readiness.ready
+
+    monkeypatch.setattr(warmup, "WARMUP_ORDERS", 0)
+    readiness = Readiness()
+    readiness.start("shpat_test", SHOP)
+    assert readiness.ready
+    assert readiness._task is None
+
+
+def test_a_failed_or_slow_warm_up_still_becomes_ready(monkeypatch):
+    monkeypatch.setattr(warmup, "WARMUP_TIMEOUT", 0.05)
+
+    async def failing(shop_api_key, shop_domain_name):
+        raise RuntimeError("Listing recent orders failed")
+
+    async def hanging(shop_api_key, shop_domain_name):
+        await asyncio.Event().wait()
+
+    async def scenario(warm_shop):
+        monkeypatch.setattr(warmup, "warm_shop", warm_shop)
+        readiness = Readiness()
+        readiness.start("shpat_test", SHOP)
+        waiting = readiness.ready
+        await readiness._task
+        return waiting, readiness
+
+    waiting, failed = asyncio.run(scenario(failing))
+    assert not waiting
+    assert failed.ready
+    assert failed.warm_error == "Listing recent orders failed"
+
+    _, timed_out = asyncio.run(scenario(hanging))
+    assert timed_out.ready
+    assert timed_out.warm_error == "TimeoutError"
+
+
+def test_draining_cancels_the_warm_up_and_stays_unready(monkeypatch):
+    cancelled = []
+
+    async def hanging(shop_api_key, shop_domain_name):
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.append(shop_domain_name)
+            raise
+
+    monkeypatch.setattr(warmup, "warm_shop", hanging)
+
+    async def scenario():
+        readiness = Readiness()
+        readiness.start("shpat_test", SHOP)
+        await asyncio.sleep(0.01)
+        await readiness.drain()
+        return readiness
+
+    readiness = asyncio.run(scenario())
+    assert cancelled == [SHOP]
+    assert readiness.draining
+    assert not readiness.warmed
+    assert not readiness.ready
+
+
+@pytest.mark.parametrize("draining, status_code", [(False, 200), (True, 503)])
+def test_ready_endpoint_reports_draining(monkeypatch, draining, status_code):
+    monkeypatch.setattr(main.readiness, "warmed", True)
+    monkeypatch.setattr(main.readiness, "draining", draining)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/ready")
+
+    response = asyncio.run(scenario())
+    assert response.status_code == status_code
+    assert response.json()["draining"] is draining
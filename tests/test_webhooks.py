@@ -0,0 +1,121 @@
+import asyncio
+import json
+
+import httpx
+
+from server import main
+from services import webhooks
+from services.cache import response_cache
+from services.webhooks import (
+    SHOPIFY_WEBHOOK_SECRET,
+    WebhookEvent,
+    WebhookProcessor,
+    sign_webhook,
+    verify_webhook,
+)
+
+SHOP = "webhooks-test.myshopify.com"
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def post(body: bytes, headers: dict) -> httpx.Response:
+    transport = httpx.ASGITransport(app=main.webhooks)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.post("/shopify", content=body, headers=headers)
+
+
+def deliver(body: bytes, signature: str = None, **headers) -> httpx.Response:
+    headers = {
+        "X-Shopify-Topic": "orders/updated",
+        "X-Shopify-Shop-Domain": SHOP,
+        "X-Shopify-Hmac-Sha256": signature or sign_webhook(body, SHOPIFY_WEBHOOK_SECRET),
+        **headers,
+    }
+    return run(post(body, {k: v for k, v in headers.items() if v is not None}))
+
+
+def test_signatures_are_checked_against_the_secret():
+    body = b'{"id": 1}'
+    assert verify_webhook(body, sign_webhook(body, "secret"), "secret")
+    assert not verify_webhook(body, sign_webhook(body, "other"), "secret")
+    assert not verify_webhook(b'{"id": 2}', sign_webhook(body, "secret"), "secret")
+    assert not verify_webhook(body, None, "secret")
+    assert not verify_webhook(body, sign_webhook(body, "secret"), None)
+
+
+def test_route_queues_signed_deliveries_and_rejects_the_rest(monkeypatch):
+    processor = WebhookProcessor()
+    monkeypatch.setattr(main, "webhook_processor", processor)
+    body = json.dumps({"id": 1, "updated_at": "2023-05-01T10:00:00Z"}).encode()
+
+    assert deliver(body).json() == {"status": "queued"}
+    assert deliver(body, signature=sign_webhook(body, "wrong")).status_code == 401
+    assert deliver(body, **{"X-Shopify-Hmac-Sha256": None}).status_code == 401
+    assert deliver(body, **{"X-Shopify-Topic": "products/update"}).json() == {"status": "ignored"}
+    assert processor.stats.received == 1
+    assert processor._queue.get_nowait().shop == SHOP
+
+
+def test_route_rejects_malformed_payloads_and_missing_shops(monkeypatch):
+    processor = WebhookProcessor()
+    monkeypatch.setattr(main, "webhook_processor", processor)
+
+    assert deliver(b"not json").status_code == 400
+    assert deliver(b"[1, 2]").status_code == 400
+    assert deliver(b'{"id": 1}', **{"X-Shopify-Shop-Domain": None}).status_code == 400
+    assert processor.stats.received == 0
+
+
+def test_repeated_webhook_ids_are_only_queued_once():
+    processor = WebhookProcessor()
+    event = WebhookEvent(shop=SHOP, topic="orders/updated", payload={"id": 1}, webhook_id="delivery-1")
+    assert processor.enqueue(event)
+    assert processor.enqueue(event)
+    assert processor.enqueue(WebhookEvent(shop=SHOP, topic="orders/updated", payload={"id": 1}, webhook_id="delivery-2"))
+    assert processor._queue.qsize() == 2
+    assert processor.stats.duplicates == 1
+
+
+def test_a_delivery_older_than_the_cached_record_is_skipped():
+    processor = WebhookProcessor()
+    newer = {"id": 2, "name": "#1002", "updated_at": "2023-05-01T12:00:00Z"}
+    older = {"id": 2, "name": "#1002 (old)", "updated_at": "2023-05-01T11:00:00Z"}
+
+    async def scenario():
+        await processor.apply(WebhookEvent(shop=SHOP, topic="orders/updated", payload=newer))
+        await processor.apply(WebhookEvent(shop=SHOP, topic="orders/updated", payload=older))
+        record = await response_cache.peek(SHOP, "order", 2)
+        await response_cache.clear_shop(SHOP)
+        return record
+
+    assert run(scenario()) == newer
+    assert processor.stats.applied == 1
+    assert processor.stats.outdated == 1
+
+
+def test_a_failing_delivery_is_retried_then_invalidates_the_cached_record(monkeypatch):
+    processor = WebhookProcessor()
+    attempts = []
+
+    async def apply(event):
+        attempts.append(event)
+        raise RuntimeError("mirror unavailable")
+
+    monkeypatch.setattr(processor, "apply", apply)
+    monkeypatch.setattr(webhooks, "WEBHOOK_RETRY_DELAY", 0)
+    event = WebhookEvent(shop=SHOP, topic="orders/updated", payload={"id": 3}, webhook_id="delivery-3")
+
+    async def scenario():
+        await response_cache.set(SHOP, "order", 3, None, {"id": 3, "name": "#1003"})
+        processor.enqueue(event)
+        await processor.apply_with_retries(await processor._queue.get())
+        return await response_cache.peek(SHOP, "order", 3)
+
+    assert run(scenario()) is None
+    assert len(attempts) == webhooks.WEBHOOK_MAX_ATTEMPTS
+    assert processor.stats.retried == webhooks.WEBHOOK_MAX_ATTEMPTS - 1
+    assert processor.stats.failed == 1
+    assert "delivery-3" not in processor._seen